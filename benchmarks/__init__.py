@@ -0,0 +1,3 @@
+"""
+Offline benchmarks, see `python -m benchmarks --help`.
+"""
@@ -0,0 +1,272 @@
+"""
+Offline benchmarks of the bot's hot paths - startup, airdrop joins, airdrop resolution and role tips - run against
+the stand-ins in `benchmarks.fakes` and an in-memory mongomock-motor database, so no network access is needed.
+Results are written as JSON, to compare between versions:
+
+    python -m benchmarks --output results.json
+
+mongomock-motor isn't one of the bot's requirements, it has to be installed separately. It has no indexes and
+blocks the event loop while it works, so for representative database timings point `--mongo-uri` at a local
+MongoDB instead - the benchmarks use (and drop) their own database on it.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import subprocess
+from eth_account import Account
+from eth_utils import to_checksum_address
+from typing import Optional
+
+# the bot reads its identity from the environment on setup, a throwaway key is enough for a fake chain
+BENCHMARK_KEY: str = '0x' + '42' * 32
+os.environ['SPENDING_PRIVATE_KEY'] = BENCHMARK_KEY
+os.environ['SPENDING_ADDRESS'] = Account.from_key(BENCHMARK_KEY).address
+os.environ['DB_NAME'] = 'airdrop_benchmarks'
+os.environ.pop('PAYOUT_WORKER', None)
+
+import discord
+import lib.db
+from lib import CONFIG, DATABASE, CRYPTO, NotificationQueue, AirdropManager, Airdrop, ENTRANT_WRITES
+from lib.rpc import RPCPool
+from .fakes import FakeNode, FakeDiscordHTTP, FakeBot, FakeUser, FakeRole, FakeChannel, FakeMessage, FakeInteraction
+
+GUILD_ID: int = 900000000000000000
+CHANNEL_ID: int = 900000000000000001
+FIRST_USER_ID: int = 100000000000000000
+
+
+class Environment:
+    def __init__(self, args: argparse.Namespace):
+        self.args: argparse.Namespace = args
+        self.node: FakeNode = FakeNode(latency=args.rpc_latency)
+        self.http: FakeDiscordHTTP = FakeDiscordHTTP(latency=args.discord_latency,
+                                                     rate_limit_chance=args.rate_limit_chance,
+                                                     retry_after=args.retry_after)
+        self.client = self._database_client(args.mongo_uri)
+        self.bot: FakeBot = FakeBot(self.http, DATABASE, CRYPTO)
+        self.channel: FakeChannel = FakeChannel(self.http, CHANNEL_ID, GUILD_ID)
+        self.bot.add_channel(self.channel)
+        self.manager: AirdropManager = AirdropManager(self.bot)  # noqa
+        self.notifications: NotificationQueue = NotificationQueue(self.bot)  # noqa
+        self.bot.notifications = self.notifications
+        self.user_ids: list[int] = [FIRST_USER_ID + i for i in range(args.users)]
+        self._next_id: int = 800000000000000000
+
+    @staticmethod
+    def _database_client(uri: Optional[str]):
+        if uri:
+            from motor.motor_asyncio import AsyncIOMotorClient
+            return AsyncIOMotorClient(uri)
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit('Without --mongo-uri, the benchmarks need mongomock-motor: `pip install mongomock-motor`')
+        return AsyncMongoMockClient()
+
+    def next_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    async def start(self) -> None:
+        await self.node.start()
+        CRYPTO.rpc = RPCPool(self.node.url)
+        lib.db._DatabaseClient = lambda: self.client
+        CONFIG.check_query_plans = False
+        await self.client.drop_database(os.environ['DB_NAME'])
+        # registered before startup, so loading them is part of what's measured
+        await self.client[os.environ['DB_NAME']].users.insert_many([
+            {'_id': user_id, 'address': (address := to_checksum_address(f'0x{user_id:040x}')),
+             'address_key': address.lower()} for user_id in self.user_ids
+        ])
+
+    async def stop(self) -> None:
+        await CRYPTO.payouts.stop()
+        await CRYPTO.close()
+        await self.node.stop()
+        await self.client.drop_database(os.environ['DB_NAME'])
+
+    async def create_airdrop(self, entrants: list[int]) -> Airdrop:
+        airdrop: Airdrop = Airdrop(GUILD_ID, CHANNEL_ID, self.next_id(), self.args.amount, int(time.time()) + 3600)
+        await DATABASE.db.airdrops.insert_one(airdrop.to_db_dict())
+        await DATABASE.update_airdrop_entrants(airdrop.message_id, added=entrants)
+        await self.manager.update()
+        return self.manager.get_airdrop(airdrop.message_id)
+
+
+async def bench_startup(env: Environment) -> dict:
+    """
+    The steps of `AirdropBot.setup_hook`, in the same order and with the same concurrency.
+    """
+
+    timings: dict[str, float] = {}
+
+    async def timed(name: str, step) -> None:
+        started_at: float = time.perf_counter()
+        await step
+        timings[name] = time.perf_counter() - started_at
+
+    async def database() -> None:
+        await timed('database connection', DATABASE.connect())
+        await asyncio.gather(timed('database setup', DATABASE.setup()),
+                             timed('registered users', DATABASE.load_registered_users()))
+
+    started_at: float = time.perf_counter()
+    await asyncio.gather(database(), timed('crypto setup', CRYPTO.setup()))
+    return {'seconds': time.perf_counter() - started_at, 'steps': timings,
+            'registered_users': len(DATABASE.registered_users)}
+
+
+async def bench_joins(env: Environment, count: int) -> dict:
+    """
+    A burst of clicks on one airdrop's join button. The joins are written out once the burst is over and timed
+    on their own, so the join rate reflects answering the interactions.
+    """
+
+    airdrop: Airdrop = await env.create_airdrop([])
+    message: FakeMessage = env.channel.get_partial_message(airdrop.message_id)
+    interactions: list[FakeInteraction] = [FakeInteraction(env.http, FakeUser(env.http, user_id), message)
+                                           for user_id in env.user_ids[:count]]
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(env.args.join_concurrency)
+
+    async def join(interaction: FakeInteraction) -> None:
+        async with semaphore:
+            await airdrop.join(interaction)  # noqa
+
+    window: float = ENTRANT_WRITES.window
+    ENTRANT_WRITES.window = 3600
+    started_at: float = time.perf_counter()
+    try:
+        await asyncio.gather(*[join(interaction) for interaction in interactions])
+    finally:
+        ENTRANT_WRITES.window = window
+    seconds: float = time.perf_counter() - started_at
+    flush_started_at: float = time.perf_counter()
+    await ENTRANT_WRITES.flush(airdrop.message_id)
+    stored: int = await DATABASE.db.airdrop_entrants.count_documents({'airdrop': airdrop.message_id})
+    return {'joins': len(interactions), 'seconds': seconds, 'joins_per_second': len(interactions) / seconds,
+            'flush_seconds': time.perf_counter() - flush_started_at, 'stored_entrants': stored}
+
+
+async def bench_resolve(env: Environment, entrants: int) -> dict:
+    airdrop: Airdrop = await env.create_airdrop(env.user_ids[:entrants])
+    transactions: int = env.node.nonce
+    requests: int = env.http.total_requests
+    started_at: float = time.perf_counter()
+    await env.manager.resolve(airdrop)
+    resolved_at: float = time.perf_counter()
+    await env.notifications.join()
+    return {'entrants': entrants, 'seconds': resolved_at - started_at,
+            'notified_seconds': time.perf_counter() - started_at,
+            'transactions': env.node.nonce - transactions, 'discord_requests': env.http.total_requests - requests}
+
+
+async def bench_role_tip(env: Environment, size: int) -> dict:
+    """
+    What `/tip role` does once confirmed: look the members up, pay them through the queue and DM each of them.
+    """
+
+    role: FakeRole = FakeRole(env.next_id(), [FakeUser(env.http, user_id) for user_id in env.user_ids[:size]])
+    transactions: int = env.node.nonce
+    progress_updates: int = 0
+
+    async def progress(_: int, __: int) -> None:
+        nonlocal progress_updates
+        progress_updates += 1
+
+    started_at: float = time.perf_counter()
+    addresses: dict = await DATABASE.get_role_addresses(role)  # noqa
+    looked_up_at: float = time.perf_counter()
+    tx_hashes: list[Optional[str]] = await CRYPTO.group_payout(addresses, CRYPTO.to_contract_value(env.args.amount),
+                                                               f'tip:{role.id}', progress)
+    paid_at: float = time.perf_counter()
+    for member, tx_hash in zip(addresses, tx_hashes):
+        if tx_hash:
+            env.notifications.send(member.id, discord.Embed(title='Tip received', description=tx_hash))
+    await env.notifications.join()
+    return {'members': size, 'seconds': paid_at - started_at, 'lookup_seconds': looked_up_at - started_at,
+            'notified_seconds': time.perf_counter() - started_at, 'sent': sum(1 for tx in tx_hashes if tx),
+            'transactions': env.node.nonce - transactions, 'progress_updates': progress_updates}
+
+
+async def wait_for_payout_lease(timeout: float = 10) -> None:
+    deadline: float = time.monotonic() + timeout
+    while not CRYPTO.payouts.lease.held:
+        if time.monotonic() > deadline:
+            raise RuntimeError('The payout lease was never acquired')
+        await asyncio.sleep(0.05)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> dict:
+    env: Environment = Environment(args)
+    await env.start()
+    try:
+        results: dict = {'startup': await bench_startup(env)}
+        CRYPTO.payouts.start()
+        env.notifications.start()
+        await wait_for_payout_lease()
+        results['joins'] = await bench_joins(env, min(args.joins, args.users))
+        results['resolve'] = [await bench_resolve(env, size) for size in args.entrants if size <= args.users]
+        results['role_tip'] = [await bench_role_tip(env, size) for size in args.role_sizes if size <= args.users]
+        results['discord'] = {'requests': env.http.requests, 'rate_limited': env.http.rate_limited}
+        results['rpc'] = {'http_requests': env.node.requests, 'calls': env.node.calls}
+    finally:
+        await env.stop()
+    return {'revision': git_revision(), 'python': platform.python_version(), 'timestamp': time.time(),
+            'parameters': vars(args), 'results': results}
+
+
+def parse_args() -> argparse.Namespace:
+    def sizes(value: str) -> list[int]:
+        return [int(size) for size in value.split(',') if size]
+
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__,
+                                                              formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000, help='registered users in the database')
+    parser.add_argument('--joins', type=int, default=5000, help='clicks on the join button of a single airdrop')
+    parser.add_argument('--join-concurrency', type=int, default=200, help='joins handled at the same time')
+    parser.add_argument('--entrants', type=sizes, default=[10, 100, 1000], help='airdrop sizes to resolve')
+    parser.add_argument('--role-sizes', type=sizes, default=[10, 100, 1000], help='role sizes to tip')
+    parser.add_argument('--amount', type=float, default=100, help='amount of every airdrop and tip')
+    parser.add_argument('--rpc-latency', type=float, default=0.02, help='seconds added to every RPC request')
+    parser.add_argument('--discord-latency', type=float, default=0.05, help='seconds every Discord request takes')
+    parser.add_argument('--rate-limit-chance', type=float, default=0.01,
+                        help='probability of a Discord request being rate limited')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='the Retry-After of rate limited requests')
+    parser.add_argument('--mongo-uri', help='a MongoDB to run against, instead of the in-memory mongomock-motor')
+    parser.add_argument('--output', help='file to write the results to, instead of stdout')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args: argparse.Namespace = parse_args()
+    logging.basicConfig(level=logging.WARNING, format='[%(levelname)s:%(name)s]: %(message)s')
+    if os.name != 'nt':
+        try:
+            __import__('uvloop').install()
+        except ImportError:
+            pass
+    results: dict = asyncio.run(run(args))
+    output: str = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+"""
+Local stand-ins for the services the bot talks to, so the benchmarks run offline and are repeatable:
+a JSON-RPC node served over HTTP, and a Discord HTTP layer with configurable latency and rate limits,
+reached through the handful of Discord objects the airdrop and payout code paths touch.
+The database is mongomock-motor, which needs no stand-in of its own.
+"""
+
+import rlp
+import random
+import asyncio
+import itertools
+import discord
+import logging
+from aiohttp import web
+from eth_utils import keccak
+from typing import Any, Optional
+
+__all__: tuple = ('FakeNode', 'FakeDiscordHTTP', 'FakeBot', 'FakeUser', 'FakeRole', 'FakeChannel', 'FakeMessage',
+                  'FakeInteraction')
+
+BALANCE_OF_SELECTOR: str = '0x70a08231'
+DECIMALS_SELECTOR: str = '0x313ce567'
+ALLOWANCE_SELECTOR: str = '0xdd62ed3e'
+
+
+class _NodeError(Exception):
+    pass
+
+
+class FakeNode:
+    def __init__(self, latency: float = 0.0, chain_id: int = 80001, balance: int = 10 ** 36):
+        """
+        A JSON-RPC server answering the calls the bot makes, with `latency` seconds added to every HTTP request.
+        Sent transactions wait in a pool until every lower nonce was used, and are then "mined" right away -
+        unless `auto_mine` is turned off, in which case they're only mined by `mine()`.
+        The transactions with a nonce in `reverting` are mined with a failed receipt, every `balanceOf`
+        returns `balance` and every `allowance` returns `allowance`. While `http_status` is set, every HTTP request
+        is answered with just that status instead, e.g. 429 to act rate limited.
+        """
+
+        self.latency: float = latency
+        self.chain_id: int = chain_id
+        self.balance: int = balance
+        self.allowance: int = balance
+        self.auto_mine: bool = True
+        self.reverting: set[int] = set()
+        self.rejection: Optional[str] = None  # an error every sent transaction is refused with
+        self.http_status: Optional[int] = None
+        self.nonce: int = 0  # the transaction count of the sender, i.e. how many of its transactions were mined
+        self.block: int = 1
+        self.pool: dict[int, str] = {}  # nonce -> hash of the transactions waiting to be mined
+        self.transactions: dict[str, str] = {}  # hash -> raw transaction of everything ever sent
+        self.receipts: dict[str, dict] = {}
+        self.requests: int = 0
+        self.calls: int = 0
+        self.method_calls: dict[str, int] = {}
+        self.url: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    @staticmethod
+    def transaction_nonce(raw: str) -> int:
+        return int.from_bytes(rlp.decode(bytes.fromhex(raw[2:]))[0], 'big')
+
+    def _pending_count(self) -> int:
+        count: int = self.nonce
+        while count in self.pool:
+            count += 1
+        return count
+
+    def mine(self) -> int:
+        """
+        Mine the pooled transactions that aren't waiting for a lower nonce.
+
+        :return: How many were mined
+        """
+
+        mined: int = 0
+        while (tx_hash := self.pool.pop(self.nonce, None)) is not None:
+            self.receipts[tx_hash] = {'transactionHash': tx_hash, 'blockNumber': hex(self.block),
+                                      'status': '0x0' if self.nonce in self.reverting else '0x1'}
+            self.nonce += 1
+            self.block += 1
+            mined += 1
+        return mined
+
+    def _send(self, raw: str) -> str:
+        tx_hash: str = '0x' + keccak(hexstr=raw).hex()
+        nonce: int = self.transaction_nonce(raw)
+        if tx_hash in self.transactions:
+            raise _NodeError('already known')
+        if nonce < self.nonce:
+            raise _NodeError('nonce too low')
+        if self.rejection is not None:
+            raise _NodeError(self.rejection)
+        self.transactions[tx_hash] = raw
+        self.pool[nonce] = tx_hash  # replaces whatever was pooled with the same nonce
+        if self.auto_mine:
+            self.mine()
+        return tx_hash
+
+    def _result(self, method: str, params: list) -> Any:
+        if method == 'eth_chainId':
+            return hex(self.chain_id)
+        if method == 'eth_blockNumber':
+            return hex(self.block)
+        if method == 'eth_getTransactionCount':
+            return hex(self._pending_count() if params[1] == 'pending' else self.nonce)
+        if method == 'eth_gasPrice':
+            return hex(30 * 10 ** 9)
+        if method == 'eth_call':
+            data: str = params[0]['data']
+            result: int = 18 if data.startswith(DECIMALS_SELECTOR) else \
+                self.allowance if data.startswith(ALLOWANCE_SELECTOR) else self.balance
+            return '0x' + hex(result)[2:].zfill(64)
+        if method == 'eth_sendRawTransaction':
+            return self._send(params[0])
+        if method == 'eth_getTransactionReceipt':
+            return self.receipts.get(params[0])
+        raise KeyError(method)
+
+    def _handle(self, request: dict) -> dict:
+        self.calls += 1
+        self.method_calls[request['method']] = self.method_calls.get(request['method'], 0) + 1
+        try:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'result': self._result(request['method'],
+                                                                               request.get('params', []))}
+        except _NodeError as e:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': {'code': -32000, 'message': str(e)}}
+        except KeyError:
+            return {'jsonrpc': '2.0', 'id': request['id'],
+                    'error': {'code': -32601, 'message': f'Method {request["method"]} not found'}}
+
+    async def _view(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body: Any = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.http_status is not None:
+            return web.Response(status=self.http_status)
+        if isinstance(body, list):
+            return web.json_response([self._handle(item) for item in body])
+        return web.json_response(self._handle(body))
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app: web.Application = web.Application()
+        app.router.add_post('/', self._view)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site: web.TCPSite = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.url = f'http://{host}:{site._server.sockets[0].getsockname()[1]}/'  # noqa
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class _FakeResponse:
+    def __init__(self, status: int, reason: str, headers: dict):
+        self.status: int = status
+        self.reason: str = reason
+        self.headers: dict = headers
+
+
+class FakeDiscordHTTP:
+    def __init__(self,
+                 latency: float = 0.05,
+                 rate_limit_chance: float = 0.0,
+                 retry_after: float = 0.5,
+                 library_retries: int = 3,
+                 seed: int = 0):
+        """
+        Every Discord API call made by the fakes goes through `request`, which takes `latency` seconds and is
+        rate limited with a `rate_limit_chance` probability. Like the library does, a rate limited request
+        waits `retry_after` seconds and is retried `library_retries` times before the 429 is raised to the caller.
+        """
+
+        self.latency: float = latency
+        self.rate_limit_chance: float = rate_limit_chance
+        self.retry_after: float = retry_after
+        self.library_retries: int = library_retries
+        self.requests: dict[str, int] = {}
+        self.rate_limited: int = 0
+        self._random: random.Random = random.Random(seed)
+
+    async def request(self, route: str) -> None:
+        for attempt in range(self.library_retries + 1):
+            self.requests[route] = self.requests.get(route, 0) + 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self._random.random() >= self.rate_limit_chance:
+                return
+            self.rate_limited += 1
+            if attempt < self.library_retries:
+                await asyncio.sleep(self.retry_after)
+        raise discord.HTTPException(_FakeResponse(429, 'Too Many Requests', {'Retry-After': str(self.retry_after)}),
+                                    {'code': 0, 'message': 'You are being rate limited.'})
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+
+class _FakeAsset:
+    url: str = 'https://cdn.discordapp.com/embed/avatars/0.png'
+
+
+class FakeUser:
+    def __init__(self, http: FakeDiscordHTTP, id_: int):
+        self.http: FakeDiscordHTTP = http
+        self.id: int = id_
+        self.avatar: _FakeAsset = _FakeAsset()
+        self.display_avatar: _FakeAsset = self.avatar
+        self.mention: str = f'<@{id_}>'
+
+    async def send(self, *_, **__) -> None:
+        await self.http.request('POST /users/@me/channels')
+        await self.http.request('POST /channels/{dm}/messages')
+
+
+class FakeRole:
+    def __init__(self, id_: int, members: list[FakeUser]):
+        self.id: int = id_
+        self.members: list[FakeUser] = members
+        self.mention: str = f'<@&{id_}>'
+
+
+class FakeMessage:
+    def __init__(self, http: FakeDiscordHTTP, id_: int, channel: 'FakeChannel'):
+        self.http: FakeDiscordHTTP = http
+        self.id: int = id_
+        self.channel: FakeChannel = channel
+        self.guild: discord.Object = discord.Object(channel.guild_id)
+
+    async def edit(self, *_, **__) -> None:
+        await self.http.request('PATCH /channels/{channel}/messages/{message}')
+
+    async def pin(self, *_, **__) -> None:
+        await self.http.request('PUT /channels/{channel}/pins/{message}')
+
+    async def unpin(self, *_, **__) -> None:
+        await self.http.request('DELETE /channels/{channel}/pins/{message}')
+
+
+class FakeChannel:
+    def __init__(self, http: FakeDiscordHTTP, id_: int, guild_id: int):
+        self.http: FakeDiscordHTTP = http
+        self.id: int = id_
+        self.guild_id: int = guild_id
+        self._message_ids: itertools.count = itertools.count(id_ + 1)
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        return FakeMessage(self.http, message_id, self)
+
+    async def send(self, *_, **__) -> FakeMessage:
+        await self.http.request('POST /channels/{channel}/messages')
+        return FakeMessage(self.http, next(self._message_ids), self)
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        await self.http.request('GET /channels/{channel}/messages/{message}')
+        return FakeMessage(self.http, message_id, self)
+
+
+class _FakeInteractionResponse:
+    def __init__(self, http: FakeDiscordHTTP):
+        self.http: FakeDiscordHTTP = http
+        self._done: bool = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def send_message(self, *_, **__) -> None:
+        await self.http.request('POST /interactions/{interaction}/{token}/callback')
+        self._done = True
+
+
+class FakeInteraction:
+    def __init__(self, http: FakeDiscordHTTP, user: FakeUser, message: FakeMessage):
+        self.user: FakeUser = user
+        self.message: FakeMessage = message
+        self.response: _FakeInteractionResponse = _FakeInteractionResponse(http)
+
+
+class FakeBot:
+    def __init__(self, http: FakeDiscordHTTP, db, crypto):
+        """
+        The parts of `AirdropBot` the airdrop manager, airdrops and notification queue use, backed by `http`.
+        The user cache is always empty, so every DM looks its recipient up through the API like a cold cache would.
+        """
+
+        self.http: FakeDiscordHTTP = http
+        self.db = db
+        self.crypto = crypto
+        self.user: FakeUser = FakeUser(http, 1)
+        self.logger: logging.Logger = logging.getLogger('benchmarks.bot')
+        self.notifications = None
+        self._channels: dict[int, FakeChannel] = {}
+
+    def owns_guild(self, _: int) -> bool:
+        return True
+
+    def add_channel(self, channel: FakeChannel) -> None:
+        self._channels[channel.id] = channel
+
+    def get_channel(self, channel_id: int) -> FakeChannel:
+        return self._channels[channel_id]
+
+    async def fetch_channel(self, channel_id: int) -> FakeChannel:
+        await self.http.request('GET /channels/{channel}')
+        return self._channels[channel_id]
+
+    def get_user(self, _: int) -> Optional[FakeUser]:
+        return None
+
+    async def fetch_user(self, user_id: int) -> FakeUser:
+        await self.http.request('GET /users/{user}')
+        return FakeUser(self.http, user_id)
@@ -1,16 +1,44 @@
 import os
+import time
+import asyncio
 import discord
 import logging
 import importlib
 from discord.commands import SlashCommandGroup
-from lib import DATABASE, CONFIG, CRYPTO, DatabaseInterface, AirdropManager
+from typing import Optional, Awaitable
+from lib import (DATABASE, CONFIG, CRYPTO, DatabaseInterface, AirdropManager, NotificationQueue, ENTRANT_WRITES,
+                 MetricsServer, INTERACTION_ACK_SECONDS, QUEUE_DEPTH, LIVE_AIRDROPS, AIRDROP_ENTRANTS)
 
 
 INTENTS: discord.Intents = discord.Intents.default()
 INTENTS.members = True  # noqa
+# the shards this process runs - without them, one process runs every shard, as many as Discord recommends
+SHARD_COUNT: Optional[int] = int(CONFIG.env('SHARD_COUNT')) if CONFIG.env('SHARD_COUNT') else None
+SHARD_IDS: Optional[list[int]] = [int(i) for i in CONFIG.env('SHARD_IDS').split(',')] if CONFIG.env('SHARD_IDS') else None
 
 
-class AirdropBot(discord.Bot):
+def observe_ack(interaction: discord.Interaction, type_: str) -> None:
+    INTERACTION_ACK_SECONDS.observe(time.time() - interaction.created_at.timestamp(), type=type_)
+
+
+class AirdropContext(discord.ApplicationContext):
+    """
+    An application context that records how long commands take to be acknowledged.
+    """
+
+    async def respond(self, *args, **kwargs):
+        acked: bool = self.interaction.response.is_done()
+        response = await super().respond(*args, **kwargs)
+        if not acked:
+            observe_ack(self.interaction, 'command')
+        return response
+
+    async def defer(self, *args, **kwargs):
+        await super().defer(*args, **kwargs)
+        observe_ack(self.interaction, 'command')
+
+
+class AirdropBot(discord.AutoShardedBot):
     def __init__(self, *args, **kwargs):
         self.config: CONFIG = CONFIG
         self.config.reload()
@@ -20,9 +48,22 @@ class AirdropBot(discord.Bot):
         self.db: DatabaseInterface = DATABASE
         self.crypto = CRYPTO
         self.airdrop_manager: AirdropManager = AirdropManager(self)
+        self.notifications: NotificationQueue = NotificationQueue(self)
+        self.metrics: Optional[MetricsServer] = MetricsServer() if CONFIG.metrics_enabled else None
+        self._started_at: Optional[float] = None
+        self._setup_task: Optional[asyncio.Task] = None
         self._load_cogs()
         self._load_groups()
 
+    def owns_guild(self, guild_id: int) -> bool:
+        """
+        Whether this process runs the shard of a guild, and so owns its airdrops.
+        """
+
+        if self.shard_ids is None:  # every shard runs in this process
+            return True
+        return (guild_id >> 22) % self.shard_count in self.shard_ids
+
     def _configure_logging(self):
         logging.basicConfig(level=logging.INFO, format='[%(levelname)s:%(name)s]: %(message)s')
         logging.getLogger('asyncio').setLevel(logging.WARNING)
@@ -42,9 +83,80 @@ class AirdropBot(discord.Bot):
                 self.add_application_command(group)
                 self.logger.log(logging.INFO, f'Loaded commands.groups.{filename[:-3]}')
 
+    async def setup_hook(self) -> None:
+        """
+        Connect to the database and the node and load what the bot needs from them.
+        Steps that don't depend on each other run concurrently, and how long each took is logged at the end.
+        """
+
+        timings: dict[str, float] = {}
+
+        async def timed(name: str, step: Awaitable) -> None:
+            started_at: float = time.perf_counter()
+            await step
+            timings[name] = time.perf_counter() - started_at
+
+        async def database() -> None:
+            await timed('database connection', self.db.connect())
+            await asyncio.gather(timed('database setup', self.db.setup()),
+                                 timed('registered users', self.db.load_registered_users()))
+
+        started_at: float = time.perf_counter()
+        steps: list[Awaitable] = [database(), timed('crypto setup', self.crypto.setup())]
+        if self.metrics is not None:
+            self._register_gauges()
+            steps.append(timed('metrics server', self.metrics.start()))
+        await asyncio.gather(*steps)
+        self.crypto.payouts.start()
+        report: str = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings.items())
+        self.logger.log(logging.INFO, f'Set up in {time.perf_counter() - started_at:.2f}s ({report})')
+
+    def _register_gauges(self) -> None:
+        QUEUE_DEPTH.set_function(lambda: self.notifications.depth, queue='notifications')
+        QUEUE_DEPTH.set_function(lambda: ENTRANT_WRITES.pending, queue='entrant_writes')
+        QUEUE_DEPTH.set_function(lambda: self.db.db.payout_jobs.count_documents({'status': 'queued'}), queue='payouts')
+        LIVE_AIRDROPS.set_function(lambda: self.airdrop_manager.live)
+        AIRDROP_ENTRANTS.set_function(lambda: self.airdrop_manager.entrant_total)
+
+    async def wait_until_set_up(self) -> None:
+        if self._setup_task is not None:
+            await asyncio.shield(self._setup_task)
+
+    def _on_setup_done(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and (error := task.exception()) is not None:
+            self.logger.log(logging.CRITICAL, f'Setup failed, shutting down: {error!r}')
+            asyncio.create_task(self.close())
+
+    async def start(self, token: str, *, reconnect: bool = True):
+        # setting up runs alongside the gateway connection instead of before it,
+        # anything that needs it waits for it through `wait_until_set_up()`
+        self._started_at = time.perf_counter()
+        await self.login(token)
+        self._setup_task = asyncio.create_task(self.setup_hook())
+        self._setup_task.add_done_callback(self._on_setup_done)
+        await self.connect(reconnect=reconnect)
+
+    async def get_application_context(self, interaction: discord.Interaction, cls=None):
+        return await super().get_application_context(interaction, cls=cls or AirdropContext)
+
+    async def process_application_commands(self, *args, **kwargs):
+        await self.wait_until_set_up()
+        await super().process_application_commands(*args, **kwargs)
+
+    async def close(self):
+        await ENTRANT_WRITES.flush_all()
+        await super().close()
+        await self.crypto.payouts.stop()
+        await self.crypto.close()
+        if self.metrics is not None:
+            await self.metrics.stop()
+
     async def on_ready(self):
+        await self.wait_until_set_up()
+        self.notifications.start()
         await self.airdrop_manager.setup()
-        self.logger.log(logging.INFO, f'Logged in as {self.user}')
+        self.logger.log(logging.INFO, f'Logged in as {self.user}, '
+                                      f'{time.perf_counter() - self._started_at:.2f}s after starting')
 
 
-bot = AirdropBot(debug_guild=CONFIG.debug_guild, owner_ids=CONFIG.admins)
+bot = AirdropBot(debug_guild=CONFIG.debug_guild, owner_ids=CONFIG.admins, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
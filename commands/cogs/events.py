@@ -1,9 +1,11 @@
 import logging
 import discord
 from discord.ext import commands
-from bot import AirdropBot
+from bot import AirdropBot, observe_ack
 from lib import AirDropInteractionType, Airdrop
 
+INTERACTION_TYPES: dict[str, AirDropInteractionType] = {ait.value: ait for ait in AirDropInteractionType}
+
 
 class EventHandler(commands.Cog):
     def __init__(self, bot: AirdropBot):
@@ -14,11 +16,13 @@ class EventHandler(commands.Cog):
     @commands.Cog.listener()
     async def on_interaction(self, interaction: discord.Interaction):
         try:
+            await self.bot.wait_until_set_up()
             if interaction.is_component() and (custom_id := interaction.data.get('custom_id')):
-                if custom_id in [ait.value for ait in AirDropInteractionType]:
-                    if (type_ := AirDropInteractionType(custom_id)) is AirDropInteractionType.JOIN:
+                if (type_ := INTERACTION_TYPES.get(custom_id)) is not None:
+                    if type_ is AirDropInteractionType.JOIN:
                         airdrop: Airdrop = self.bot.airdrop_manager.get_airdrop(interaction.message.id)
                         await airdrop.join(interaction)
+                        observe_ack(interaction, 'join')
                     else:
                         self.bot.logger.log(logging.WARNING, f'Unknown long-lasting interaction type: {type_}')
         except discord.NotFound:
@@ -1,6 +1,6 @@
 import discord
 from discord.enums import SlashCommandOptionType
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord.commands import ApplicationContext, Option
 from pytimeparse.timeparse import timeparse
 from lib import CONFIG, invalid_duration, ConfirmView, Airdrop, AirdropNotFound
@@ -11,15 +11,6 @@ from typing import Union, Optional
 class OwnerFacingCommands(commands.Cog):
     def __init__(self, bot: AirdropBot):
         self.bot: AirdropBot = bot
-        self.airdrop_worker_loop.start()
-
-    @tasks.loop(seconds=10)
-    async def airdrop_worker_loop(self):
-        await self.bot.airdrop_manager.frame()
-
-    @airdrop_worker_loop.before_loop
-    async def __wait(self):
-        await self.bot.wait_until_ready()
 
     @discord.command(name='airdrop',
                      description=f'Create an {CONFIG.token_symbol} airdrop, in the current or specified channel.')
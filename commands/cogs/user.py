@@ -1,9 +1,9 @@
 import discord
 from discord.ext import commands
 from discord.commands import ApplicationContext, Option
-from lib import ETH_ADDRESS_RE
+from lib import ETH_ADDRESS_RE, checksum_address, AddressAlreadyRegistered
 from bot import AirdropBot
-from lib.reusable_responses import invalid_address
+from lib.reusable_responses import invalid_address, address_already_registered
 
 
 class UserFacingCommands(commands.Cog):
@@ -14,13 +14,15 @@ class UserFacingCommands(commands.Cog):
     async def register_command(self,
                                ctx: ApplicationContext,
                                address: Option(str, 'The ETH address you wish to associate with your account')):
-        if not (match := ETH_ADDRESS_RE.match(address)):
+        if not ETH_ADDRESS_RE.match(address):
             await invalid_address(ctx)
             return
-        has_prefix: bool = bool(match.groupdict().get('prefix'))
-        if not has_prefix:
-            address: str = '0x' + address
-        await self.bot.db.register_user(ctx.author.id, address)
+        address: str = checksum_address(address)
+        try:
+            await self.bot.db.register_user(ctx.author.id, address)
+        except AddressAlreadyRegistered:
+            await address_already_registered(ctx)
+            return
         embed: discord.Embed = discord.Embed(
             title='Success!',
             color=discord.Color.green(),
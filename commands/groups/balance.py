@@ -26,7 +26,8 @@ async def balance_command(ctx: ApplicationContext,
                                                f' of `{shorten_address(address)}`',
                                          url=CRYPTO.explorer(address, 'address'),
                                          color=0xec850a,
-                                         description=f'```c\n{await CRYPTO.get_erc20_balance(address)}'
+                                         description=f'```c\n'
+                                                     f'{CRYPTO.to_human_value(await CRYPTO.cached_erc20_balance(address))}'
                                                      f' {CONFIG.token_symbol}```')
     embed.set_footer(text='You can tap the title to view the address on blockchain explorer!',
                      icon_url=ctx.bot.user.avatar.url)
@@ -52,7 +53,8 @@ async def balance_command(ctx: ApplicationContext,
     embed: discord.Embed = discord.Embed(title=f':money_with_wings:  {user_str} {CONFIG.token_symbol} balance',
                                          url=CRYPTO.explorer(address, 'address'),
                                          color=0xec850a,
-                                         description=f'```c\n{await CRYPTO.get_erc20_balance(address)}'
+                                         description=f'```c\n'
+                                                     f'{CRYPTO.to_human_value(await CRYPTO.cached_erc20_balance(address))}'
                                                      f' {CONFIG.token_symbol}```')
     embed.set_footer(text='You can tap the title to view the address on blockchain explorer!',
                      icon_url=ctx.bot.user.avatar.url)
@@ -1,10 +1,13 @@
+import time
+import asyncio
 import discord
 from discord.enums import SlashCommandOptionType
 from discord.commands import SlashCommandGroup, Option, ApplicationContext
 from lib.types import EthereumAddress, TxHash
 from lib import (CONFIG, tip_notification, CRYPTO, ConfirmView,
-                 shorten_address, ETH_ADDRESS_RE, invalid_address, insufficient_funds, BalanceTooLow)
-from typing import Optional
+                 shorten_address, ETH_ADDRESS_RE, invalid_address, insufficient_funds, payout_failed, payout_pending,
+                 BalanceTooLow, checksum_address)
+from typing import Optional, Union
 
 __all__ = ('tip',)
 
@@ -12,32 +15,57 @@ tip: SlashCommandGroup = SlashCommandGroup(name="tip",
                                            description='Commands for sending users, roles and addresses a tip!')
 
 
+async def _reserve(ctx: ApplicationContext, source: str, amount: float) -> bool:
+    """
+    Set the tip aside before deferring, so a tip that can't be afforded is refused privately -
+    the follow-ups to a public defer can't be ephemeral.
+    """
+
+    try:
+        CRYPTO.reserve(source, CRYPTO.to_contract_value(amount))
+    except BalanceTooLow:
+        await insufficient_funds(ctx, amount)
+        return False
+    return True
+
+
 @tip.command(name='user', description='Send a tip to a user')
 @discord.is_owner()
 async def tip_user_command(ctx: ApplicationContext,
                            user: Option(discord.Member, description='The user to send the tip to'),
                            amount: Option(SlashCommandOptionType.number, description='The amount of the tip')):
-    associated_address: Optional[EthereumAddress] = await ctx.bot.db.get_user_address(user.id)
-    if not associated_address:
-        embed = discord.Embed(title='Oh no!',
-                              description=f'{user.mention} **hasn\'t set their address yet!**',
-                              color=discord.Color.red())
-        embed.set_footer(text='Tell them to use the register command!', icon_url=ctx.bot.user.avatar.url)
-        await ctx.respond(embed=embed)
+    source: str = f'tip:{ctx.interaction.id}'
+    if not await _reserve(ctx, source, amount):
         return
     try:
-        tx_hash: TxHash = await CRYPTO.transfer_erc20(associated_address, CRYPTO.to_contract_value(amount))
-    except BalanceTooLow:
-        await insufficient_funds(ctx, amount)
-        return
-    embed = discord.Embed(title=':rocket:  Tip sent!',
-                          description=f'{user.mention} **has been tipped** `{amount}{CONFIG.token_symbol}`!',
-                          color=discord.Color.green(),
-                          url=CRYPTO.explorer(tx_hash))
-    embed.add_field(name='Transaction Hash', value=f'```c\n{tx_hash}```')
-    embed.set_footer(text='I notified them via DMs, see ya!', icon_url=ctx.bot.user.avatar.url)
-    await tip_notification(ctx, user, amount, tx_hash)
-    await ctx.respond(embed=embed)
+        await ctx.defer()  # the payout is waited for, which can take longer than Discord waits for a response
+        associated_address: Optional[EthereumAddress] = await ctx.bot.db.get_user_address(user.id)
+        if not associated_address:
+            embed = discord.Embed(title='Oh no!',
+                                  description=f'{user.mention} **hasn\'t set their address yet!**',
+                                  color=discord.Color.red())
+            embed.set_footer(text='Tell them to use the register command!', icon_url=ctx.bot.user.avatar.url)
+            await ctx.respond(embed=embed)
+            return
+        try:
+            job, = await CRYPTO.payouts.pay(source, [(user.id, associated_address, CRYPTO.to_contract_value(amount))])
+        except asyncio.TimeoutError:
+            await payout_pending(ctx)
+            return
+        if job['status'] != 'sent':
+            await payout_failed(ctx)
+            return
+        tx_hash: TxHash = job['tx_hash']
+        embed = discord.Embed(title=':rocket:  Tip sent!',
+                              description=f'{user.mention} **has been tipped** `{amount}{CONFIG.token_symbol}`!',
+                              color=discord.Color.green(),
+                              url=CRYPTO.explorer(tx_hash))
+        embed.add_field(name='Transaction Hash', value=f'```c\n{tx_hash}```')
+        embed.set_footer(text='I notified them via DMs, see ya!', icon_url=ctx.bot.user.avatar.url)
+        tip_notification(ctx, user, amount, tx_hash)
+        await ctx.respond(embed=embed)
+    finally:
+        CRYPTO.ledger.release(source)  # already released once the payout finished, unless it never started
 
 
 @tip.command(name='role', description='Send a tip to a role')
@@ -47,25 +75,34 @@ async def tip_role_command(ctx: ApplicationContext,
                                         description='The role to send the tip to. '
                                                     'The amount will be split evenly between all members of the role'),
                            amount: Option(SlashCommandOptionType.number, description='The amount of the tip')):
-    if not await CRYPTO.can_afford(CRYPTO.to_contract_value(amount)):
-        await insufficient_funds(ctx, amount)
+    source: str = f'tip:{ctx.interaction.id}'
+    if not await _reserve(ctx, source, amount):
         return
+    try:
+        await _tip_role(ctx, role, amount, source)
+    finally:
+        CRYPTO.ledger.release(source)  # already released once the payout finished, unless it never started
+
+
+async def _tip_role(ctx: ApplicationContext, role: discord.Role, amount: float, source: str) -> None:
+    # the replies are public from here on, as follow-ups to a public defer
+    await ctx.defer()  # looking up a large role can take longer than Discord waits for a response
     addresses: dict[discord.Member, EthereumAddress] = await ctx.bot.db.get_role_addresses(role)
-    split: float = amount / len(addresses)
     if not role.members:
         embed = discord.Embed(title='Nah uh!',
                               description=f'{role.mention} **has no members!**',
                               color=discord.Color.red())
         embed.set_footer(text='Give the role to some people first!', icon_url=ctx.bot.user.avatar.url)
-        await ctx.respond(embed=embed, ephemeral=True)
+        await ctx.respond(embed=embed)
         return
     if not addresses:
         embed = discord.Embed(title='Oh no!',
                               description=f'None of the users in {role.mention} have an address set!!',
                               color=discord.Color.red())
         embed.set_footer(text='Tell them to use the register command!', icon_url=ctx.bot.user.avatar.url)
-        await ctx.respond(embed=embed, ephemeral=True)
+        await ctx.respond(embed=embed)
         return
+    split: float = amount / len(addresses)
     if len(addresses) != len(role.members):
         embed = discord.Embed(title='Here\'s the thing...',
                               description=f'Out of {len(role.members)} members of {role.mention}, **only {len(addresses)} have set their addresses!**',
@@ -78,16 +115,44 @@ async def tip_role_command(ctx: ApplicationContext,
             embed_cancelled: discord.Embed = discord.Embed(title=':small_red_triangle_down:  Not this time then!',
                                                            description=f'**No transactions** were made!',
                                                            color=0xE2586D)
-            await ctx.respond(embed=embed_cancelled, ephemeral=True)
+            await ctx.respond(embed=embed_cancelled)
+            return
+    embed: discord.Embed = discord.Embed(title=':hourglass_flowing_sand:  Sending the tip...',
+                                         description=f'`0/{len(addresses)}` members of {role.mention} tipped so far',
+                                         color=discord.Color.blurple())
+    response: Union[discord.Interaction, discord.WebhookMessage] = await ctx.respond(embed=embed)
+    edit = response.edit_original_message if isinstance(response, discord.Interaction) else response.edit
+    last_edit: float = time.monotonic()
+
+    async def show_progress(done: int, total: int) -> None:
+        nonlocal last_edit
+        if done == total or time.monotonic() - last_edit < (CONFIG.progress_edit_interval or 1.5):
             return
-    tx_hashes: list[TxHash] = await CRYPTO.group_payout(addresses.values(), CRYPTO.to_contract_value(split))
-    embed: discord.Embed = discord.Embed(title=':rocket:  Tip sent!',
-                                         description=f'{len(addresses)} members of {role.mention} **have been tipped** `{split}{CONFIG.token_symbol} each`!',
-                                         color=discord.Color.green())
+        last_edit = time.monotonic()
+        embed.description = f'`{done}/{total}` members of {role.mention} tipped so far'
+        try:
+            await edit(embed=embed)
+        except discord.HTTPException:  # the counter is cosmetic, the payout carries on regardless
+            pass
+
+    try:
+        tx_hashes: list[Optional[TxHash]] = await CRYPTO.group_payout(addresses, CRYPTO.to_contract_value(amount),
+                                                                      source, show_progress)
+    except asyncio.TimeoutError:
+        await edit(embed=discord.Embed(title=':hourglass_flowing_sand:  Still sending...',
+                                       description=f'The tip to {role.mention} **is queued**, but hasn\'t been sent'
+                                                   f' to everyone yet. The rest will be sent as soon as possible!',
+                                       color=discord.Color.blurple()))
+        return
+    sent: int = sum(1 for tx in tx_hashes if tx)
+    embed = discord.Embed(title=':rocket:  Tip sent!',
+                          description=f'{sent} members of {role.mention} **have been tipped** `{split}{CONFIG.token_symbol} each`!',
+                          color=discord.Color.green())
     embed.set_footer(text='I notified them via DMs, see ya!', icon_url=ctx.bot.user.avatar.url)
-    await ctx.respond(embed=embed)
+    await edit(embed=embed)
     for (member, address), tx in zip(addresses.items(), tx_hashes):
-        await tip_notification(ctx, member, split, tx)
+        if tx:
+            tip_notification(ctx, member, split, tx)
 
 
 @tip.command(name='address', description='Send a tip to an address')
@@ -99,14 +164,26 @@ async def tip_address_command(ctx: ApplicationContext,
     if not ETH_ADDRESS_RE.match(address):
         await invalid_address(ctx)
         return
-    try:
-        tx_hash: TxHash = await CRYPTO.transfer_erc20(address, CRYPTO.to_contract_value(amount))
-    except BalanceTooLow:
-        await insufficient_funds(ctx, amount)
+    address = checksum_address(address)
+    source: str = f'tip:{ctx.interaction.id}'
+    if not await _reserve(ctx, source, amount):
         return
-    embed = discord.Embed(title=':rocket:  Tip sent!',
-                          description=f'`{amount}{CONFIG.token_symbol}` **has been sent** to `{shorten_address(address)}`!',
-                          color=discord.Color.green(),
-                          url=CRYPTO.explorer(tx_hash))
-    embed.add_field(name='Transaction Hash', value=f'```c\n{tx_hash}```')
-    await ctx.respond(embed=embed)
+    try:
+        await ctx.defer()  # the payout is waited for, which can take longer than Discord waits for a response
+        try:
+            job, = await CRYPTO.payouts.pay(source, [(None, address, CRYPTO.to_contract_value(amount))])
+        except asyncio.TimeoutError:
+            await payout_pending(ctx)
+            return
+        if job['status'] != 'sent':
+            await payout_failed(ctx)
+            return
+        tx_hash: TxHash = job['tx_hash']
+        embed = discord.Embed(title=':rocket:  Tip sent!',
+                              description=f'`{amount}{CONFIG.token_symbol}` **has been sent** to `{shorten_address(address)}`!',
+                              color=discord.Color.green(),
+                              url=CRYPTO.explorer(tx_hash))
+        embed.add_field(name='Transaction Hash', value=f'```c\n{tx_hash}```')
+        await ctx.respond(embed=embed)
+    finally:
+        CRYPTO.ledger.release(source)  # already released once the payout finished, unless it never started
@@ -1,9 +1,9 @@
 import os
-from bot import bot
-from lib import CONFIG
 
 
 if __name__ == '__main__':
     if os.name != 'nt':
-        __import__('uvloop').install()
+        __import__('uvloop').install()  # before importing the bot, so nothing gets bound to the default loop
+    from bot import bot
+    from lib import CONFIG
     bot.run(CONFIG.env('DISCORD_BOT_TOKEN'))
@@ -1,6 +1,8 @@
 from .config import CONFIG
+from .metrics import *
 from .db import *
 from .crypto import *
+from .notifications import *
 from .regex import *
 from .reusable_responses import *
 from .utils import *
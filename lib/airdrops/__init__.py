@@ -1,3 +1,4 @@
 from .airdrop_manager import AirdropManager
+from .entrant_buffer import *
 from .airdrop import Airdrop
 from .errors import *
@@ -1,11 +1,13 @@
-import asyncio
 import discord
 import logging
 import datetime
 import time
+import functools
 from typing import Union, Optional, Iterable
 from .. import DATABASE, CRYPTO, CONFIG
-from ..types import EthereumAddress, TxHash
+from ..types import EthereumAddress
+from .entrant_buffer import ENTRANT_WRITES
+from .entrants import EntrantSet
 
 __all__: tuple = ('Airdrop',)
 logger: logging.Logger = logging.getLogger('airdrops')
@@ -20,18 +22,22 @@ class Airdrop:
                  message_id: int,
                  amount: Union[int, float],
                  end_time: int,
-                 entrants: Optional[Iterable[int]] = None):
+                 entrants: Optional[Union[EntrantSet, Iterable[int]]] = None):
         self.channel_id: int = channel_id
         self.guild_id: int = guild_id
         self.message_id: int = message_id
         self.amount: Union[int, float] = amount
-        self.entrants = set(entrants) if entrants else set()
+        self.entrants: EntrantSet = entrants if isinstance(entrants, EntrantSet) else EntrantSet(entrants)
         self.end_time: int = end_time
 
     @property
     def url(self) -> str:
         return f'https://discord.com/channels/{self.guild_id}/{self.channel_id}/{self.message_id}'
 
+    @property
+    def payout_source(self) -> str:
+        return f'airdrop:{self.message_id}'
+
     @property
     def ended(self) -> bool:
         return self.ends_in <= 0
@@ -48,16 +54,29 @@ class Airdrop:
     def split(self) -> float:
         return self.amount / len(self.entrants) if self.entrants else 0
 
-    def to_db_dict(self) -> dict[str, Union[int, list[int], float]]:
+    def to_db_dict(self) -> dict[str, Union[int, float]]:
+        # entrants live in the airdrop_entrants collection, one document each
         return {
             '_id': self.message_id,
             'gid': self.guild_id,
             'cid': self.channel_id,
             'amount': self.amount,
             'end_time': self.end_time,
-            'entrants': list(self.entrants)
+            'updated_at': time.time(),
+            'status': 'open'
         }
 
+    @classmethod
+    def from_db_dict(cls, doc: dict, entrants: Optional[EntrantSet] = None) -> 'Airdrop':
+        return cls(
+            guild_id=doc['gid'],
+            channel_id=doc['cid'],
+            message_id=doc['_id'],
+            amount=doc['amount'],
+            end_time=doc['end_time'],
+            entrants=entrants
+        )
+
     @classmethod
     def from_message(cls,
                      message: discord.Message,
@@ -75,16 +94,21 @@ class Airdrop:
     async def add_entrant(self, user: Union[discord.User, int]) -> None:
         id_: int = user.id if not isinstance(user, int) else user
         self.entrants.add(id_)
-        await DATABASE.add_airdrop_entrant(self.message_id, id_)
+        ENTRANT_WRITES.add(self.message_id, id_)
 
     async def remove_entrant(self, user: Union[discord.User, int]) -> None:
         id_: int = user.id if not isinstance(user, int) else user
         self.entrants.remove(id_)
-        await DATABASE.remove_airdrop_entrant(self.message_id, id_)
+        ENTRANT_WRITES.remove(self.message_id, id_)
 
     async def join(self, interaction: discord.Interaction) -> None:
+        """
+        Answer a click on the join button. This is the hot path of a busy airdrop, so it never waits on the database
+        for registered users - registration is checked against an in-memory set and the join is written behind.
+        """
+
         if interaction.user.id not in self.entrants:
-            if not await DATABASE.get_user_address(interaction.user.id):
+            if not await DATABASE.is_registered(interaction.user.id):
                 await interaction.response.send_message('**You don\'t have an ETH address associated!**'
                                                         ' Use the `/register` command to do so.', ephemeral=True)
                 return
@@ -96,14 +120,14 @@ class Airdrop:
                 color=discord.Color.green()
             )
             embed.set_footer(text='When this airdrop ends and the reward is distributed, I\'ll notify you via DMs.',
-                             icon_url=interaction.user.avatar.url)
+                             icon_url=interaction.user.display_avatar.url)
         else:
             embed: discord.Embed = discord.Embed(
                 title=':point_up:  You\'re already in!',
                 description='You have **already joined** this airdrop.',
                 color=discord.Color.red())
             embed.set_footer(text='Just wait patiently for the airdrop to end and the reward to be distributed.',
-                             icon_url=interaction.user.avatar.url)
+                             icon_url=interaction.user.display_avatar.url)
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     async def resolve(self, bot: discord.Bot) -> None:
@@ -112,25 +136,26 @@ class Airdrop:
         Note that this doesn't update the DB record - it has to be done through the airdrop manager.
         """
 
-        entrants_to_remove: list[int] = []
-        for user_id in self.entrants:
-            address: Optional[EthereumAddress] = await DATABASE.get_user_address(user_id)
-            if not address:
-                entrants_to_remove.append(user_id)
+        addresses: dict[int, EthereumAddress] = await DATABASE.get_users_addresses(self.entrants)
+        logger.log(logging.INFO, f'Sending {self.split}{CONFIG.token_symbol} to {len(addresses)}'
+                                 f' entrants from airdrop {self.message_id}')
+        # keyed by the airdrop, so resolving it again after a crash only sends what wasn't sent yet
+        jobs: list[dict] = await CRYPTO.payouts.pay(
+            self.payout_source,
+            ((user_id, address, CRYPTO.to_contract_value(self.split)) for user_id, address in addresses.items()))
+        for job in jobs:
+            if job['status'] != 'sent' or job['notified']:
                 continue
-            logger.log(logging.INFO, f'Sending {self.split}{CONFIG.token_symbol}'
-                                     f' to {address} from airdrop {self.message_id}')
-            tx_hash: TxHash = await CRYPTO.transfer_erc20(address, CRYPTO.to_contract_value(self.split))
             embed: discord.Embed = discord.Embed(title=':tada:  Airdrop finished!',
                                                  description=f'You **received your share** of `{self.split}'
                                                              f'{CONFIG.token_symbol}` from an airdrop!\n'
                                                              f'You can view the airdrop summary [here]({self.url})',
                                                  color=0xec850a,
-                                                 url=CRYPTO.explorer(tx_hash))
-            embed.add_field(name='Transaction Hash', value=f'```c\n{tx_hash}```')
+                                                 url=CRYPTO.explorer(job['tx_hash']))
+            embed.add_field(name='Transaction Hash', value=f'```c\n{job["tx_hash"]}```')
             embed.set_footer(text='Thanks for participating!')
-            await (await bot.fetch_user(user_id)).send(embed=embed)
-            await asyncio.sleep(0.3)
+            # marked once the DM went out, so resolving the airdrop again after a crash still sends the others
+            bot.notifications.send(job['user_id'], embed, functools.partial(CRYPTO.payouts.mark_notified, [job['_id']]))
         message: discord.Message = await (await bot.fetch_channel(self.channel_id)).fetch_message(self.message_id)
         embed: discord.Embed = discord.Embed(title=':tada:  Airdrop finished!',
                                              description=f'The airdrop has **ended** and the reward has been distributed!\n'
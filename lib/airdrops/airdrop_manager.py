@@ -1,34 +1,62 @@
 import time
+import heapq
+import asyncio
 import datetime
 import logging
 import discord
+from array import array
+from bson import Timestamp
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError, OperationFailure
 from typing import Union, Optional, TYPE_CHECKING
 if TYPE_CHECKING:
     from bot import AirdropBot
 from .airdrop_components import AirdropButton
 from .airdrop import Airdrop
+from .entrant_buffer import ENTRANT_WRITES
+from .entrants import EntrantSet
 from .errors import AirdropNotFound
-from .. import CONFIG, insufficient_funds
+from .. import CONFIG, insufficient_funds, BalanceTooLow
+from ..leases import INSTANCE_ID
 
 __all__: tuple = ('AirdropManager',)
 
+AIRDROP_PROJECTION: dict = {'gid': 1, 'cid': 1, 'amount': 1, 'end_time': 1, 'updated_at': 1}
+WATCH_PIPELINE: list[dict] = [{'$match': {'$or': [{'ns.coll': {'$in': ['airdrops', 'airdrop_entrants']}},
+                                                   {'operationType': {'$in': ['invalidate', 'dropDatabase']}}]}}]
+
 
 class AirdropManager:
     def __init__(self, bot: 'AirdropBot'):
+        """
+        Keeps the live airdrops of the guilds this process owns (see `AirdropBot.owns_guild`) in memory,
+        in sync with the database, and resolves them when they end. Replicas running the same shards
+        all schedule the same airdrops, but each one is resolved by whichever replica claims it first;
+        the others retry when the claim expires, so they take over if the resolving replica dies.
+        """
+
         self._state: dict[int, Airdrop] = {}
+        self._deadlines: list[tuple[float, int]] = []
+        self._scheduled: dict[int, float] = {}
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._scheduler: Optional[asyncio.Task] = None
+        self._resolving: dict[int, asyncio.Task] = {}
+        self._sync: Optional[asyncio.Task] = None
+        self._last_sync: float = 0
         self.bot: 'AirdropBot' = bot
         self.logger: logging.Logger = logging.getLogger('airdrops')
 
-    async def __fetch_db_state(self) -> list[Airdrop]:
-        fetched: list[Airdrop] = []
-        async for doc in self.bot.db.db.airdrops.find():
-            fetched.append(Airdrop(guild_id=doc['gid'],
-                                   channel_id=doc['cid'],
-                                   message_id=doc['_id'],
-                                   amount=doc['amount'],
-                                   end_time=doc['end_time'],
-                                   entrants=doc['entrants']))
-        return fetched
+    async def __fetch_db_state(self, query: Optional[dict] = None, session=None) -> list[Airdrop]:
+        docs: list[dict] = []
+        async for doc in self.bot.db.db.airdrops.find(query or {}, AIRDROP_PROJECTION, session=session):
+            self._last_sync = max(self._last_sync, doc.get('updated_at', 0))
+            if self.bot.owns_guild(doc['gid']):
+                docs.append(doc)
+        # read through the (airdrop, user) index, so every airdrop's entrants arrive already sorted
+        entrants: dict[int, array] = {}
+        async for message_id, user_id in self.bot.db.iter_airdrop_entrants((doc['_id'] for doc in docs), session):
+            entrants.setdefault(message_id, array('Q')).append(user_id)
+        return [Airdrop.from_db_dict(doc, EntrantSet.from_sorted(entrants.get(doc['_id'], ()))) for doc in docs]
 
     async def _add_from_message(self,
                                 message: discord.Message,
@@ -38,23 +66,248 @@ class AirdropManager:
         airdrop: Airdrop = Airdrop.from_message(message, amount, int(time.time()) + duration, channel)
         await self.bot.db.db.airdrops.insert_one(airdrop.to_db_dict())
         self._state[airdrop.message_id] = airdrop
+        self._schedule(airdrop.message_id, airdrop.end_time)
         return airdrop
 
     async def _remove(self, airdrop: Union[int, Airdrop]) -> None:
         airdrop: Airdrop = self.get_airdrop(airdrop)
-        del self._state[airdrop.message_id]
+        self._discard(airdrop.message_id)
+        ENTRANT_WRITES.discard(airdrop.message_id)
         await self.bot.get_channel(airdrop.channel_id).get_partial_message(
             airdrop.message_id).unpin(reason='Airdrop cancellation')
         await self.bot.db.db.airdrops.delete_one({'_id': airdrop.message_id})
+        await self.bot.db.delete_airdrop_entrants(airdrop.message_id)
+
+    def _put(self, airdrop: Airdrop) -> None:
+        """
+        Apply a fetched airdrop to the local state, updating the existing object in place if there is one.
+        """
+
+        airdrop.entrants = ENTRANT_WRITES.overlay(airdrop.message_id, airdrop.entrants)
+        if (existing := self._state.get(airdrop.message_id)) is not None:
+            existing.entrants = airdrop.entrants
+            existing.end_time = airdrop.end_time
+        else:
+            self._state[airdrop.message_id] = existing = airdrop
+            # the reward is set aside even if it can't be afforded anymore, so it's at least not promised twice
+            self.bot.crypto.ledger.reserve(airdrop.payout_source, self.bot.crypto.to_contract_value(airdrop.amount),
+                                           force=True)
+        if airdrop.message_id not in self._resolving and self._scheduled.get(airdrop.message_id) != existing.end_time:
+            self._schedule(airdrop.message_id, existing.end_time)
 
-    async def _fetch(self):
-        self._state.update({ad.message_id: ad for ad in await self.__fetch_db_state()})
+    def _discard(self, message_id: int) -> None:
+        if (airdrop := self._state.pop(message_id, None)) is not None:
+            self.bot.crypto.ledger.release(airdrop.payout_source)
+        self._unschedule(message_id)
+
+    async def _fetch(self, session=None):
+        fetched: dict[int, Airdrop] = {ad.message_id: ad for ad in await self.__fetch_db_state(session=session)}
+        for message_id in set(self._state) - set(fetched):
+            self._discard(message_id)
+        for airdrop in fetched.values():
+            self._put(airdrop)
 
     async def update(self) -> None:
+        """
+        Reload the whole state from the database.
+        This is only needed once - afterwards the state is kept up to date incrementally, see `_run_sync`.
+        """
+
         await self._fetch()
 
+    async def _reload(self) -> Optional[Timestamp]:
+        """
+        Reload the whole state and return the cluster time it was read at.
+        """
+
+        async with await self.bot.db.client.start_session() as session:
+            await self._fetch(session=session)
+            return session.operation_time
+
     async def setup(self):
-        await self.update()
+        if self._sync is None or self._sync.done():
+            self._sync = asyncio.create_task(self._run_sync(await self._reload()))
+            self._sync.add_done_callback(self._sync_stopped)
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = asyncio.create_task(self._run_scheduler())
+
+    async def _run_sync(self, start_at: Optional[Timestamp]) -> None:
+        """
+        Follow the change stream of the airdrops and their entrants, after the state was loaded once in `setup`.
+        The change stream is opened at the cluster time of that read, so nothing written in between is lost.
+        Deployments without change streams (standalone servers) fall back to polling for documents whose
+        `updated_at` moved since the last sync.
+        """
+
+        resume_token: Optional[dict] = None
+        reload: bool = False
+        while True:
+            if reload:
+                try:
+                    start_at = await self._reload()
+                except PyMongoError as e:
+                    self.logger.log(logging.WARNING, f'Reloading the airdrop state failed, retrying: {e}')
+                    await asyncio.sleep(CONFIG.airdrop_sync_interval or 5)
+                    continue
+                resume_token, reload = None, False
+            try:
+                async with self.bot.db.db.watch(WATCH_PIPELINE, resume_after=resume_token,
+                                                start_at_operation_time=None if resume_token else start_at) as stream:
+                    async for change in stream:
+                        self._apply_change(change)
+                        resume_token = stream.resume_token
+            except OperationFailure as e:
+                if e.code == 40573:
+                    self.logger.log(logging.INFO, 'Change streams are unavailable, falling back to delta polling')
+                    return await self._poll_deltas()
+                self.logger.log(logging.WARNING, f'Airdrop change stream failed, reloading state: {e}')
+                reload = True
+            except PyMongoError as e:
+                self.logger.log(logging.WARNING, f'Airdrop change stream interrupted, resuming: {e}')
+                await asyncio.sleep(CONFIG.airdrop_sync_interval or 5)
+
+    def _sync_stopped(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.log(logging.ERROR, f'Airdrop sync stopped, the state is no longer kept up to date:'
+                                           f' {task.exception()!r}')
+
+    def _apply_change(self, change: dict) -> None:
+        operation: str = change['operationType']
+        if operation in ('invalidate', 'drop', 'rename', 'dropDatabase'):
+            raise OperationFailure(f'Airdrop change stream invalidated by {operation}')
+        if change['ns']['coll'] == 'airdrop_entrants':
+            return self._apply_entrant_change(change)
+        message_id: int = change['documentKey']['_id']
+        if operation in ('insert', 'replace'):
+            if self.bot.owns_guild(change['fullDocument']['gid']):
+                self._put(Airdrop.from_db_dict(change['fullDocument']))
+        elif operation == 'delete':
+            self._discard(message_id)
+        elif operation == 'update' and (airdrop := self._state.get(message_id)) is not None:
+            for field, value in change['updateDescription']['updatedFields'].items():
+                if field == 'end_time':
+                    airdrop.end_time = value
+                    if message_id not in self._resolving:
+                        self._schedule(message_id, value)
+
+    def _apply_entrant_change(self, change: dict) -> None:
+        message_id, user_id = map(int, change['documentKey']['_id'].split(':'))
+        # our own unwritten changes are newer than whatever the stream is reporting
+        if (airdrop := self._state.get(message_id)) is None or ENTRANT_WRITES.is_pending(message_id, user_id):
+            return
+        if change['operationType'] == 'insert':
+            airdrop.entrants.add(user_id)
+        elif change['operationType'] == 'delete':
+            airdrop.entrants.discard(user_id)
+
+    async def _poll_deltas(self) -> None:
+        while True:
+            await asyncio.sleep(CONFIG.airdrop_sync_interval or 5)
+            try:
+                for airdrop in await self.__fetch_db_state({'updated_at': {'$gte': self._last_sync}}):
+                    self._put(airdrop)
+                live: set[int] = set(await self.bot.db.db.airdrops.distinct('_id'))
+                for message_id in set(self._state) - live:
+                    self._discard(message_id)
+            except PyMongoError as e:
+                self.logger.log(logging.WARNING, f'Airdrop delta sync failed: {e}')
+
+    def _schedule(self, message_id: int, due: float) -> None:
+        """
+        (Re)schedule the resolution of an airdrop at the `due` timestamp.
+        Superseded heap entries aren't removed, they're just skipped once they reach the top.
+        """
+
+        self._scheduled[message_id] = due
+        heapq.heappush(self._deadlines, (due, message_id))
+        self._wakeup.set()
+
+    def _unschedule(self, message_id: int) -> None:
+        if self._scheduled.pop(message_id, None) is not None:
+            self._wakeup.set()
+
+    async def _run_scheduler(self) -> None:
+        while True:
+            while self._deadlines and self._scheduled.get(self._deadlines[0][1]) != self._deadlines[0][0]:
+                heapq.heappop(self._deadlines)
+            self._wakeup.clear()
+            timeout: Optional[float] = max(self._deadlines[0][0] - time.time(), 0) if self._deadlines else None
+            if timeout != 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, message_id = heapq.heappop(self._deadlines)
+            del self._scheduled[message_id]
+            if (airdrop := self._state.get(message_id)) is not None and message_id not in self._resolving:
+                self.logger.log(logging.INFO, f'Dispatching resolve operation for airdrop {message_id}')
+                self._resolving[message_id] = asyncio.create_task(self._resolve_due(airdrop))
+
+    async def _claim(self, message_id: int) -> bool:
+        """
+        Atomically move an airdrop from `open` to `resolving`, owned by this process for `resolve_claim_ttl` seconds.
+        Claims that expired (or are already ours) can be taken over.
+        """
+
+        now: float = time.time()
+        return await self.bot.db.db.airdrops.find_one_and_update(
+            {'_id': message_id, '$or': [{'status': {'$ne': 'resolving'}},
+                                        {'owner': INSTANCE_ID},
+                                        {'claimed_until': {'$lt': now}}]},
+            {'$set': {'status': 'resolving', 'owner': INSTANCE_ID,
+                      'claimed_until': now + (CONFIG.resolve_claim_ttl or 60)}},
+            {'_id': 1}, return_document=ReturnDocument.AFTER
+        ) is not None
+
+    async def _renew_claim(self, message_id: int) -> None:
+        ttl: float = CONFIG.resolve_claim_ttl or 60
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                await self.bot.db.db.airdrops.update_one({'_id': message_id, 'owner': INSTANCE_ID},
+                                                         {'$set': {'claimed_until': time.time() + ttl}})
+            except PyMongoError as e:
+                self.logger.log(logging.WARNING, f'Renewing the claim on airdrop {message_id} failed: {e}')
+
+    async def _release_claim(self, message_id: int) -> None:
+        await self.bot.db.db.airdrops.update_one({'_id': message_id, 'owner': INSTANCE_ID},
+                                                 {'$set': {'status': 'open'},
+                                                  '$unset': {'owner': '', 'claimed_until': ''}})
+
+    async def _resolve_due(self, airdrop: Airdrop) -> None:
+        message_id: int = airdrop.message_id
+        try:
+            if not await self._claim(message_id):
+                # another replica is resolving it - check back once its claim would have expired
+                doc: Optional[dict] = await self.bot.db.db.airdrops.find_one({'_id': message_id},
+                                                                            {'claimed_until': 1})
+                if doc is not None and message_id in self._state:
+                    self._schedule(message_id, doc.get('claimed_until', time.time()) + 1)
+                return
+            renewer: asyncio.Task = asyncio.create_task(self._renew_claim(message_id))
+            try:
+                await self.resolve(airdrop)
+            finally:
+                renewer.cancel()
+        except Exception as e:
+            self.logger.log(logging.ERROR, f'Resolving airdrop {message_id} failed, retrying in 10s: {e!r}')
+            try:
+                await self._release_claim(message_id)
+            except PyMongoError:
+                pass  # it expires on its own
+            if message_id in self._state:
+                self._schedule(message_id, time.time() + 10)
+        finally:
+            del self._resolving[message_id]
+
+    @property
+    def live(self) -> int:
+        return len(self._state)
+
+    @property
+    def entrant_total(self) -> int:
+        return sum(len(airdrop.entrants) for airdrop in self._state.values())
 
     def get_airdrop(self, message_id: Union[int, Airdrop]) -> Airdrop:
         ad: Optional[Airdrop] = self._state.get(message_id) if not isinstance(message_id, Airdrop) else message_id
@@ -67,7 +320,11 @@ class AirdropManager:
                           amount: Union[int, float],
                           duration: Union[int, float],
                           channel: Optional[discord.TextChannel] = None):
-        if not await self.bot.crypto.can_afford(self.bot.crypto.to_contract_value(amount)):
+        # reserved right away, so concurrent airdrops of this process can't jointly promise more than the balance
+        reservation: str = f'airdrop:interaction:{ctx.interaction.id}'
+        try:
+            self.bot.crypto.reserve(reservation, self.bot.crypto.to_contract_value(amount))
+        except BalanceTooLow:
             await insufficient_funds(ctx, amount)
             return
         embed_confirmed: discord.Embed = discord.Embed(title=':white_check_mark:  Airdrop confirmed!',
@@ -84,8 +341,19 @@ class AirdropManager:
                                              timestamp=datetime.datetime.fromtimestamp(time.time() + duration))
         embed.set_footer(text=f'Ends', icon_url=ctx.bot.user.avatar.url)
         view: discord.ui.View = discord.ui.View()
-        root: discord.Message = await channel.send(embed=embed, view=view)
-        airdrop: Airdrop = await self._add_from_message(root, amount, duration, channel)
+        try:
+            root: discord.Message = await channel.send(embed=embed, view=view)
+        except discord.HTTPException:
+            self.bot.crypto.ledger.release(reservation)
+            raise
+        # moved before the airdrop is added, so a sync of the new airdrop finds it already reserved
+        self.bot.crypto.ledger.move(reservation, f'airdrop:{root.id}')
+        try:
+            airdrop: Airdrop = await self._add_from_message(root, amount, duration, channel)
+        except Exception:
+            self.bot.crypto.ledger.release(f'airdrop:{root.id}')
+            raise
+        # from here on the airdrop exists, and resolving or cancelling it releases the reservation
         view.add_item(AirdropButton(airdrop))
         await root.edit(view=view)
         await root.pin(reason='Airdrop creation')
@@ -104,15 +372,6 @@ class AirdropManager:
 
     async def resolve(self, airdrop: Union[int, Airdrop]) -> None:
         airdrop: Airdrop = self.get_airdrop(airdrop)
+        await ENTRANT_WRITES.flush(airdrop.message_id)
         await airdrop.resolve(self.bot)
         await self._remove(airdrop)
-
-    async def frame(self):
-        await self.update()
-        to_resolve: list[Airdrop] = []
-        for airdrop in self._state.values():
-            if airdrop.ended and airdrop.ends_in <= 0:
-                to_resolve.append(airdrop)
-        for ad in to_resolve:
-            self.logger.log(logging.INFO, f'Dispatching resolve operation for airdrop {ad.message_id}')
-            await self.resolve(ad)
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from typing import Optional, TYPE_CHECKING
+if TYPE_CHECKING:
+    from ..db import DatabaseInterface
+    from .entrants import EntrantSet
+from .. import DATABASE, CONFIG
+
+__all__: tuple = ('ENTRANT_WRITES', 'EntrantWriteBuffer')
+logger: logging.Logger = logging.getLogger('airdrops')
+
+
+class EntrantWriteBuffer:
+    def __init__(self, db: 'DatabaseInterface', window: Optional[float] = None):
+        """
+        Collects entrant joins and leaves per airdrop and writes them out together once `window` seconds
+        have passed since the first unwritten change, so a burst of clicks costs a single database round-trip.
+        """
+
+        self.db: 'DatabaseInterface' = db
+        self.window: float = window if window is not None else (CONFIG.entrant_flush_interval or 0.5)
+        self._added: dict[int, set[int]] = {}
+        self._removed: dict[int, set[int]] = {}
+        self._timers: dict[int, asyncio.Task] = {}
+        self._lock: Optional[asyncio.Lock] = None  # created on first use, so importing doesn't bind an event loop
+
+    def add(self, airdrop_id: int, user_id: int) -> None:
+        self._removed.get(airdrop_id, set()).discard(user_id)
+        self._added.setdefault(airdrop_id, set()).add(user_id)
+        self._arm(airdrop_id)
+
+    def remove(self, airdrop_id: int, user_id: int) -> None:
+        self._added.get(airdrop_id, set()).discard(user_id)
+        self._removed.setdefault(airdrop_id, set()).add(user_id)
+        self._arm(airdrop_id)
+
+    def overlay(self, airdrop_id: int, entrants: 'EntrantSet') -> 'EntrantSet':
+        """
+        Apply the changes that haven't been written yet on top of entrants read from the database, in place.
+        """
+
+        entrants.update(self._added.get(airdrop_id, ()))
+        entrants.difference_update(self._removed.get(airdrop_id, ()))
+        return entrants
+
+    @property
+    def pending(self) -> int:
+        return sum(map(len, self._added.values())) + sum(map(len, self._removed.values()))
+
+    def is_pending(self, airdrop_id: int, user_id: int) -> bool:
+        return user_id in self._added.get(airdrop_id, ()) or user_id in self._removed.get(airdrop_id, ())
+
+    def _arm(self, airdrop_id: int) -> None:
+        if airdrop_id not in self._timers:
+            self._timers[airdrop_id] = asyncio.create_task(self._flush_later(airdrop_id))
+
+    async def _flush_later(self, airdrop_id: int) -> None:
+        await asyncio.sleep(self.window)
+        self._timers.pop(airdrop_id, None)
+        try:
+            await self.flush(airdrop_id)
+        except Exception:  # already logged and re-armed by flush
+            pass
+
+    async def flush(self, airdrop_id: int) -> None:
+        if (timer := self._timers.pop(airdrop_id, None)) is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            added: set[int] = self._added.pop(airdrop_id, set())
+            removed: set[int] = self._removed.pop(airdrop_id, set())
+            if not added and not removed:
+                return
+            try:
+                await self.db.update_airdrop_entrants(airdrop_id, added, removed)
+            except Exception as e:
+                logger.log(logging.ERROR, f'Writing entrants of airdrop {airdrop_id} failed, retrying: {e!r}')
+                for user_id in added:
+                    if user_id not in self._removed.get(airdrop_id, ()):
+                        self._added.setdefault(airdrop_id, set()).add(user_id)
+                for user_id in removed:
+                    if user_id not in self._added.get(airdrop_id, ()):
+                        self._removed.setdefault(airdrop_id, set()).add(user_id)
+                self._arm(airdrop_id)
+                raise
+
+    async def flush_all(self) -> None:
+        await asyncio.gather(*[self.flush(airdrop_id) for airdrop_id in set(self._added) | set(self._removed)],
+                             return_exceptions=True)
+
+    def discard(self, airdrop_id: int) -> None:
+        """
+        Forget the pending changes of an airdrop that no longer exists.
+        """
+
+        if (timer := self._timers.pop(airdrop_id, None)) is not None:
+            timer.cancel()
+        self._added.pop(airdrop_id, None)
+        self._removed.pop(airdrop_id, None)
+
+
+ENTRANT_WRITES: EntrantWriteBuffer = EntrantWriteBuffer(DATABASE)
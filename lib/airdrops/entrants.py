@@ -0,0 +1,96 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator, Optional
+
+__all__: tuple = ('EntrantSet',)
+
+
+class EntrantSet:
+    __slots__: tuple = ('_sorted', '_added', '_removed', 'compact_threshold')
+
+    def __init__(self, user_ids: Optional[Iterable[int]] = None, compact_threshold: int = 4096):
+        """
+        A set of user IDs stored as a sorted array of unsigned 64-bit integers - 8 bytes per entrant instead of
+        the ~70 a Python set needs. Recent additions and removals are kept aside in small sets and merged into
+        the array once there are `compact_threshold` of them (or when it's iterated), so joins stay O(1)
+        amortized, membership is a binary search and the size is always known without counting.
+        """
+
+        self._sorted: array = array('Q', sorted(set(user_ids))) if user_ids else array('Q')
+        self._added: set[int] = set()
+        self._removed: set[int] = set()
+        self.compact_threshold: int = compact_threshold
+
+    @classmethod
+    def from_sorted(cls, user_ids: Iterable[int]) -> 'EntrantSet':
+        """
+        Build the set from IDs that are already sorted and unique, e.g. read through an index, without re-sorting.
+        """
+
+        entrants: EntrantSet = cls()
+        entrants._sorted = array('Q', user_ids)
+        return entrants
+
+    def _in_sorted(self, user_id: int) -> bool:
+        i: int = bisect_left(self._sorted, user_id)
+        return i < len(self._sorted) and self._sorted[i] == user_id
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._added or (user_id not in self._removed and self._in_sorted(user_id))
+
+    def __len__(self) -> int:
+        return len(self._sorted) - len(self._removed) + len(self._added)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __iter__(self) -> Iterator[int]:
+        self.compact()
+        return iter(self._sorted)
+
+    def __repr__(self) -> str:
+        return f'<EntrantSet size={len(self)}>'
+
+    def add(self, user_id: int) -> None:
+        if user_id in self._removed:
+            self._removed.discard(user_id)
+        elif user_id not in self._added and not self._in_sorted(user_id):
+            self._added.add(user_id)
+            self._maybe_compact()
+
+    def discard(self, user_id: int) -> None:
+        if user_id in self._added:
+            self._added.discard(user_id)
+        elif user_id not in self._removed and self._in_sorted(user_id):
+            self._removed.add(user_id)
+            self._maybe_compact()
+
+    def remove(self, user_id: int) -> None:
+        if user_id not in self:
+            raise KeyError(user_id)
+        self.discard(user_id)
+
+    def update(self, user_ids: Iterable[int]) -> None:
+        for user_id in user_ids:
+            self.add(user_id)
+
+    def difference_update(self, user_ids: Iterable[int]) -> None:
+        for user_id in user_ids:
+            self.discard(user_id)
+
+    def _maybe_compact(self) -> None:
+        if len(self._added) + len(self._removed) >= self.compact_threshold:
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Merge the pending additions and removals into the sorted array.
+        """
+
+        if not self._added and not self._removed:
+            return
+        kept: Iterable[int] = (user_id for user_id in self._sorted if user_id not in self._removed) \
+            if self._removed else self._sorted
+        self._sorted = array('Q', heapq.merge(kept, sorted(self._added)))
+        self._added, self._removed = set(), set()
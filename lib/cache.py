@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+__all__: tuple = ('TTLCache', 'MISSING')
+
+MISSING: object = object()
+
+
+class TTLCache:
+    __slots__: tuple = ('maxsize', 'ttl', 'hits', 'misses', '_data')
+
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = 600):
+        """
+        A bounded LRU mapping whose entries also expire `ttl` seconds after being set.
+        `None` is a perfectly valid value, which makes it usable for negative caching - use `MISSING` to tell
+        an absent key apart from a cached `None`.
+        """
+
+        self.maxsize: int = maxsize
+        self.ttl: Optional[float] = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.peek(key) is not MISSING
+
+    def peek(self, key: Hashable) -> Any:
+        """
+        Like get, but without touching the LRU order or the counters.
+        """
+
+        entry: Optional[tuple[float, Any]] = self._data.get(key)
+        if entry is None:
+            return MISSING
+        if self.ttl is not None and entry[0] <= time.monotonic():
+            del self._data[key]
+            return MISSING
+        return entry[1]
+
+    def get(self, key: Hashable) -> Any:
+        value: Any = self.peek(key)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires_at: float = time.monotonic() + self.ttl if self.ttl is not None else float('inf')
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Any:
+        entry: Optional[tuple[float, Any]] = self._data.pop(key, None)
+        return entry[1] if entry is not None else MISSING
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits or self.misses else 0.0
@@ -17,6 +17,7 @@ class _Config:
         self.lib_root = os.path.dirname(os.path.abspath(__file__))
         self.root_directory: str = self.lib_root[:self.lib_root.rindex(os.sep)]
         self.abi: list = json.load(open(os.path.join(self.root_directory, 'resources', 'token.abi')))
+        self.disperse_abi: list = json.load(open(os.path.join(self.root_directory, 'resources', 'disperse.abi')))
         self.raw_config: dict = {}
         load_dotenv()
         self._load_config()
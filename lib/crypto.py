@@ -1,13 +1,23 @@
+import time
 import discord
 import asyncio
-import functools
-import concurrent.futures
+import logging
 from web3 import Web3
-from typing import Union, Iterable
+from eth_account import Account
+from eth_utils import function_abi_to_4byte_selector
+from eth_account.signers.local import LocalAccount
+from typing import Union, Iterable, Optional, Any, Callable, Awaitable
 from . import CONFIG, DATABASE
+from .rpc import RPCPool
+from .cache import TTLCache, MISSING
+from .nonces import NonceManager
+from .payouts import PayoutQueue
+from .ledger import BalanceLedger
+from .metrics import instrument, CRYPTO_OP_SECONDS
 from .types import TxHash, EthereumAddress
 
 __all__: tuple = ('CRYPTO', 'BalanceTooLow')
+logger: logging.Logger = logging.getLogger('crypto')
 
 
 class BalanceTooLow(Exception):
@@ -16,26 +26,75 @@ class BalanceTooLow(Exception):
     pass
 
 
+@instrument(CRYPTO_OP_SECONDS)
 class _Crypto:
     def __init__(self):
-        self.loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
         self.testnet: bool = CONFIG.use_testnet
-        self.rpc_url: str = CONFIG.mainnet_rpc_url if not self.testnet else CONFIG.testnet_rpc_url
+        self.rpc_urls: Union[str, list[str]] = CONFIG.mainnet_rpc_url if not self.testnet else CONFIG.testnet_rpc_url
         self.explorer_url: str = CONFIG.mainnet_explorer_url if not self.testnet else CONFIG.testnet_explorer_url
         self.contract_address: EthereumAddress = (CONFIG.mainnet_contract_address if not
                                                   self.testnet else CONFIG.testnet_contract_address)
-        self.w3: Web3 = Web3(provider=Web3.HTTPProvider(self.rpc_url))
-        self.spending_address: EthereumAddress = self.w3.toChecksumAddress(CONFIG.env('SPENDING_ADDRESS'))
-        self.executor = concurrent.futures.ThreadPoolExecutor()
-        self.transaction_count: int = self.w3.eth.get_transaction_count(self.spending_address)
+        self.rpc: RPCPool = RPCPool(self.rpc_urls)
+        self.w3: Web3 = Web3()  # only used for ABI encoding and address checksums, never talks to a node
+        self.spending_address: Optional[EthereumAddress] = None
+        self.account: Optional[LocalAccount] = None
+        self.chain_id: Optional[int] = None
+        self.nonces: NonceManager = NonceManager(self)
+        self.payouts: PayoutQueue = PayoutQueue(self)
+        self.ledger: BalanceLedger = BalanceLedger(self)
+        self._gas_price: tuple[float, int] = (0, 0)
+        self._abis: dict[tuple[str, str], tuple[bytes, list[str], list[str]]] = {}
+        # address -> (checked at, block, balance)
+        self.balances: TTLCache = TTLCache(CONFIG.balance_cache_size or 10000, None)
+        self._balance_lookups: dict[str, asyncio.Future] = {}
         self.contract = self.w3.eth.contract(self.w3.toChecksumAddress(self.contract_address), abi=CONFIG.abi)
-        self.decimals: int = CONFIG.get('token_decimals') or self.contract.functions.decimals().call()
+        self.decimals: Optional[int] = CONFIG.get('token_decimals')
+        self.disperse_address: Optional[EthereumAddress] = (CONFIG.mainnet_disperse_address if not
+                                                            self.testnet else CONFIG.testnet_disperse_address)
+        self.disperse = self.w3.eth.contract(self.w3.toChecksumAddress(self.disperse_address),
+                                             abi=CONFIG.disperse_abi) if self.disperse_address else None
+        # what the disperse contract may still spend once everything we've sent is mined, read from the chain if None
+        self.disperse_allowance: Optional[int] = None
+        self._allowance_lock: Optional[asyncio.Lock] = None
+
+    async def setup(self) -> None:
+        """
+        Fetch everything that needs the node before the first transfer - the chain ID, the spending balance and,
+        if it isn't configured, the token's decimals. Nothing here runs on import, so the module can be imported
+        without a node. The nonces are set up by whichever process takes over sending payouts, see `PayoutQueue`.
+        """
+
+        self.spending_address = self.w3.toChecksumAddress(CONFIG.env('SPENDING_ADDRESS'))
+        self.account = Account.from_key(CONFIG.env('SPENDING_PRIVATE_KEY'))
+        steps: list[Awaitable] = [self._request_int('eth_chainId'), self.ledger.sync()]
+        if self.decimals is None:
+            steps.append(self._call(self.contract, 'decimals'))
+        results: list = await asyncio.gather(*steps)
+        self.chain_id = results[0]
+        if self.decimals is None:
+            self.decimals = results[2]
+        self.ledger.start()
+
+    async def close(self) -> None:
+        await self.rpc.close()
 
     async def spending_balance(self) -> int:
         return await self.get_erc20_balance(self.spending_address)
 
-    async def can_afford(self, amount: Union[int, float]) -> bool:
-        return await self.spending_balance() >= amount
+    def can_afford(self, amount: Union[int, float]) -> bool:
+        return self.ledger.can_afford(amount)
+
+    def ensure_affordable(self, amount: Union[int, float]) -> None:
+        if not self.can_afford(amount):
+            raise BalanceTooLow(self.to_human_value(amount))
+
+    def reserve(self, key: str, amount: Union[int, float]) -> None:
+        """
+        Set `amount` aside for a payout that will happen later, see `BalanceLedger`.
+        """
+
+        if not self.ledger.reserve(key, int(amount)):
+            raise BalanceTooLow(self.to_human_value(amount))
 
     @property
     def decimal_multiplier(self) -> int:
@@ -47,47 +106,282 @@ class _Crypto:
     def to_human_value(self, amount: Union[int, float]) -> float:
         return round(amount / self.decimal_multiplier, self.decimals)
 
-    def _run_in_executor(self, func):
-        return self.loop.run_in_executor(self.executor, func)
+    async def _request_int(self, method: str, params: Optional[list] = None) -> int:
+        return int(await self.rpc.request(method, params), 16)
+
+    async def _call(self, contract, fn_name: str, *args, block: str = 'latest') -> Any:
+        """
+        eth_call a view function of `contract` and decode its (single) return value.
+        """
+
+        result: str = await self.rpc.request('eth_call', [{'to': contract.address,
+                                                           'data': self._encode_call(contract, fn_name, args)},
+                                                          block])
+        _, _, output_types = self._function_abi(contract, fn_name)
+        return self.w3.codec.decode_abi(output_types, bytes.fromhex(result[2:]))[0]
 
-    def _transfer_erc20(self,
-                        to: EthereumAddress,
-                        amount: Union[int, float],
-                        gas_limit: int = 100000) -> TxHash:
-        tx = self.contract.functions.transfer(to, amount).buildTransaction({
+    def _function_abi(self, contract, fn_name: str) -> tuple[bytes, list[str], list[str]]:
+        """
+        The selector, input types and output types of a contract function, looked up once.
+        """
+
+        key: tuple[str, str] = (contract.address, fn_name)
+        if (abi := self._abis.get(key)) is None:
+            function_abi: dict = contract.get_function_by_name(fn_name).abi
+            abi = self._abis[key] = (function_abi_to_4byte_selector(function_abi),
+                                     [input_['type'] for input_ in function_abi['inputs']],
+                                     [output['type'] for output in function_abi['outputs']])
+        return abi
+
+    def _encode_call(self, contract, fn_name: str, args: Union[list, tuple]) -> str:
+        """
+        ABI-encode a call without web3's per-call validation.
+        Addresses are passed to the encoder as raw bytes, since they're checksummed once when registered
+        instead of on every transaction.
+        """
+
+        selector, input_types, _ = self._function_abi(contract, fn_name)
+        values: list = [[bytes.fromhex(item[2:]) for item in value] if type_ == 'address[]' else
+                        bytes.fromhex(value[2:]) if type_ == 'address' else value
+                        for type_, value in zip(input_types, args)]
+        return '0x' + (selector + self.w3.codec.encode_abi(input_types, values)).hex()
+
+    def _allocate_nonces(self, count: int = 1, reuse: bool = True) -> list[int]:
+        return self.nonces.allocate(count, reuse)
+
+    async def gas_price(self) -> int:
+        """
+        The node's gas price, cached for `gas_price_ttl` seconds since it barely moves between consecutive transfers.
+        """
+
+        fetched_at, gas_price = self._gas_price
+        if time.monotonic() - fetched_at > (CONFIG.gas_price_ttl or 5):
+            gas_price: int = await self._request_int('eth_gasPrice')
+            self._gas_price = (time.monotonic(), gas_price)
+        return gas_price
+
+    async def _send_transaction(self, contract, fn_name: str, args: list,
+                                nonce: int, gas_price: int, gas_limit: int, jobs: Iterable[str] = ()) -> TxHash:
+        try:
+            data: str = self._encode_call(contract, fn_name, args)
+        except Exception:
+            self.nonces.release(nonce)  # never signed, so the nonce is free to be handed out again
+            raise
+        tx: dict = {
+            'to': contract.address,
+            'data': data,
+            'value': 0,
             'gas': gas_limit,
-            'gasPrice': self.w3.eth.gas_price,
-            'nonce': self.transaction_count
-        })
-        signed_tx = self.w3.eth.account.sign_transaction(tx, CONFIG.env('SPENDING_PRIVATE_KEY'))
-        tx_hash = self.w3.eth.sendRawTransaction(signed_tx.rawTransaction)
-        self.transaction_count += 1
-        return tx_hash.hex()
+            'gasPrice': gas_price,
+            'nonce': nonce,
+            'chainId': self.chain_id
+        }
+        return await self.nonces.send(tx, jobs=jobs)
+
+    async def _transfer_erc20(self,
+                              to: EthereumAddress,
+                              amount: Union[int, float],
+                              nonce: int,
+                              gas_price: int,
+                              gas_limit: int = 100000,
+                              jobs: Iterable[str] = ()) -> TxHash:
+        tx_hash: TxHash = await self._send_transaction(self.contract, 'transfer', [to, amount],
+                                                       nonce, gas_price, gas_limit, jobs)
+        self.ledger.spend(int(amount))
+        self._invalidate_balances([to])
+        return tx_hash
+
+    async def _disperse_erc20(self,
+                              transfers: list[tuple[EthereumAddress, int]],
+                              nonce: int,
+                              gas_price: int,
+                              jobs: Iterable[str] = ()) -> TxHash:
+        gas_limit: int = (CONFIG.disperse_base_gas or 60000) + (CONFIG.disperse_gas_per_recipient or 40000) * len(transfers)
+        args: list = [self.contract.address, [to for to, _ in transfers], [int(amount) for _, amount in transfers]]
+        tx_hash: TxHash = await self._send_transaction(self.disperse, 'disperseToken', args,
+                                                       nonce, gas_price, gas_limit, jobs)
+        self.ledger.spend(sum(args[2]))
+        self._invalidate_balances(args[1])
+        return tx_hash
+
+    async def _approve_disperse(self, amount: int, nonce: int, gas_price: int) -> TxHash:
+        return await self._send_transaction(self.contract, 'approve', [self.disperse.address, amount],
+                                            nonce, gas_price, 100000)
+
+    @property
+    def disperse_chunk_size(self) -> int:
+        """
+        How many recipients fit into a single disperse transaction without going over `disperse_gas_limit`.
+        """
+
+        return max(1, ((CONFIG.disperse_gas_limit or 8000000) - (CONFIG.disperse_base_gas or 60000))
+                   // (CONFIG.disperse_gas_per_recipient or 40000))
 
     async def transfer_erc20(self,
                              to: EthereumAddress,
-                             amount: Union[int, float]) -> TxHash:
-        if not await self.can_afford(amount):
-            raise BalanceTooLow(self.to_human_value(amount))
-        return await self._run_in_executor(functools.partial(self._transfer_erc20,
-                                                             to=to,
-                                                             amount=amount))
+                             amount: Union[int, float],
+                             check_balance: bool = True) -> TxHash:
+        if check_balance:
+            self.ensure_affordable(amount)
+        gas_price: int = await self.gas_price()
+        return await self._transfer_erc20(to, amount, self._allocate_nonces()[0], gas_price)
+
+    async def bulk_transfer_erc20(self,
+                                  transfers: Iterable[tuple[EthereumAddress, Union[int, float]]],
+                                  concurrency: Optional[int] = None,
+                                  check_balance: bool = True,
+                                  jobs: Optional[Iterable[str]] = None) -> list[Optional[TxHash]]:
+        """
+        Send many transfers at once.
+        Affordability and gas price are checked a single time for the whole batch, nonces are reserved up front,
+        and the transactions are then signed and broadcast concurrently, at most `concurrency` at a time.
+        If a disperse contract is configured, the recipients are packed into as few disperse transactions as the
+        gas limit allows instead of getting a `transfer` each.
+
+        :param transfers: (address, contract value) pairs
+        :param concurrency: The maximum number of transactions in flight, defaults to the `payout_concurrency` config
+        :param check_balance: Whether to check the spending balance covers the batch, for callers that already did
+        :param jobs: The IDs of the payout jobs behind `transfers`, in the same order, recorded with the transactions
+        :return: The TX hashes, in the same order as `transfers` - None for the ones that failed to send
+        """
+
+        transfers: list[tuple[EthereumAddress, Union[int, float]]] = list(transfers)
+        if not transfers:
+            return []
+        jobs: list[Optional[str]] = list(jobs) if jobs is not None else [None] * len(transfers)
+        total: Union[int, float] = sum(amount for _, amount in transfers)
+        if check_balance:
+            self.ensure_affordable(total)
+        gas_price: int = await self.gas_price()
+        if self.disperse is not None and len(transfers) > 1:
+            return await self._bulk_disperse_erc20(transfers, int(total), gas_price, concurrency, jobs)
+        nonces: list[int] = self._allocate_nonces(len(transfers))
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency or CONFIG.payout_concurrency or 8)
+
+        async def send(to: EthereumAddress, amount: Union[int, float], nonce: int, job: Optional[str]) -> Optional[TxHash]:
+            async with semaphore:
+                try:
+                    return await self._transfer_erc20(to, amount, nonce, gas_price, jobs=[job] if job else [])
+                except Exception as e:
+                    logger.log(logging.ERROR, f'Transfer of {amount} to {to} with nonce {nonce} failed: {e!r}')
+                    self.ledger.request_sync()
+
+        return list(await asyncio.gather(*[send(to, amount, nonce, job)
+                                           for (to, amount), nonce, job in zip(transfers, nonces, jobs)]))
+
+    async def _bulk_disperse_erc20(self,
+                                   transfers: list[tuple[EthereumAddress, Union[int, float]]],
+                                   total: int,
+                                   gas_price: int,
+                                   concurrency: Optional[int] = None,
+                                   jobs: Optional[list[Optional[str]]] = None) -> list[Optional[TxHash]]:
+        chunk_size: int = self.disperse_chunk_size
+        chunks: list[list[tuple[EthereumAddress, Union[int, float]]]] = [transfers[i:i + chunk_size]
+                                                                        for i in range(0, len(transfers), chunk_size)]
+        jobs = jobs or [None] * len(transfers)
+        chunk_jobs: list[list[str]] = [[job for job in jobs[i:i + chunk_size] if job]
+                                       for i in range(0, len(transfers), chunk_size)]
+        if self._allowance_lock is None:
+            self._allowance_lock = asyncio.Lock()
+        async with self._allowance_lock:
+            try:
+                if self.disperse_allowance is None:
+                    # at the pending block, so our disperses that aren't mined yet have already used theirs
+                    self.disperse_allowance = await self._call(self.contract, 'allowance', self.spending_address,
+                                                               self.disperse.address, block='pending')
+                if self.disperse_allowance < total:
+                    # approving sets the allowance rather than adding to it, so it covers both what the disperses
+                    # already sent leave over and this batch
+                    allowance: int = self.disperse_allowance + total
+                    await self._approve_disperse(allowance, self._allocate_nonces(reuse=False)[0], gas_price)
+                    self.disperse_allowance = allowance
+                self.disperse_allowance -= total
+                # approvals and disperses never reuse a released nonce, so they're mined in the order they were sent in
+                nonces: list[int] = self._allocate_nonces(len(chunks), reuse=False)
+            except Exception as e:
+                # no disperse was sent, so every transfer fails like a failed chunk would and its jobs are retried
+                logger.log(logging.ERROR, f'Approving the disperse contract for {len(transfers)} transfers'
+                                          f' failed: {e!r}')
+                self.disperse_allowance = None  # the approval may or may not have been sent, so it's read again
+                return [None] * len(transfers)
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency or CONFIG.payout_concurrency or 8)
+
+        async def send(chunk: list[tuple[EthereumAddress, Union[int, float]]],
+                       nonce: int,
+                       jobs_: list[str]) -> Optional[TxHash]:
+            async with semaphore:
+                try:
+                    return await self._disperse_erc20(chunk, nonce, gas_price, jobs_)
+                except Exception as e:
+                    logger.log(logging.ERROR, f'Disperse of {len(chunk)} transfers with nonce {nonce} failed: {e!r}')
+                    self.disperse_allowance += sum(int(amount) for _, amount in chunk)
+                    self.ledger.request_sync()
+
+        chunk_hashes: list[Optional[TxHash]] = await asyncio.gather(*[send(chunk, nonce, jobs_) for chunk, nonce, jobs_
+                                                                       in zip(chunks, nonces, chunk_jobs)])
+        return [tx_hash for chunk, tx_hash in zip(chunks, chunk_hashes) for _ in chunk]
 
     def explorer(self, hash_: str, type_: str = 'tx') -> str:
         return f'{self.explorer_url}/{type_}/{hash_}'
 
-    async def get_erc20_balance(self, address: EthereumAddress) -> int:
-        return await self._run_in_executor(lambda: self.contract.functions.balanceOf(address).call())
+    async def get_erc20_balance(self, address: EthereumAddress, block: str = 'latest') -> int:
+        return await self._call(self.contract, 'balanceOf', address, block=block)
+
+    async def cached_erc20_balance(self, address: EthereumAddress) -> int:
+        """
+        The balance of `address`, for display.
+        Balances are cached per block - a balance checked less than `balance_cache_staleness` seconds ago is returned
+        as is, an older one only if no new block has been mined since - and concurrent lookups of the same
+        address share a single one.
+        """
+
+        key: str = address.lower()
+        entry: Any = self.balances.get(key)
+        if entry is not MISSING and time.monotonic() - entry[0] < (CONFIG.balance_cache_staleness or 3):
+            return entry[2]
+        if (lookup := self._balance_lookups.get(key)) is None:
+            lookup = self._balance_lookups[key] = asyncio.ensure_future(self._lookup_balance(key))
+            lookup.add_done_callback(lambda _: self._balance_lookups.pop(key, None))
+        return await asyncio.shield(lookup)
+
+    async def _lookup_balance(self, key: str) -> int:
+        block: int = await self._request_int('eth_blockNumber')
+        entry: Any = self.balances.peek(key)
+        if entry is not MISSING and entry[1] == block:
+            balance: int = entry[2]
+        else:
+            balance: int = await self.get_erc20_balance(key, hex(block))
+        self.balances.set(key, (time.monotonic(), block, balance))
+        return balance
+
+    def _invalidate_balances(self, addresses: Iterable[EthereumAddress]) -> None:
+        for address in [self.spending_address, *addresses]:
+            self.balances.pop(address.lower())
 
     async def group_payout(self,
-                           group: Union[discord.Role, Iterable[EthereumAddress]],
-                           amount: Union[int, float]) -> list[TxHash]:
-        if not await self.can_afford(amount):
-            raise BalanceTooLow(self.to_human_value(amount))
-        addresses: list[EthereumAddress] = list((await DATABASE.get_role_addresses(group)).values()) \
-            if isinstance(group, discord.Role) else list(group)
-        split: int = int(amount / len(addresses))
-        return [await self.transfer_erc20(to=address, amount=split) for address in addresses]
+                           group: Union[discord.Role, dict[discord.Member, EthereumAddress], Iterable[EthereumAddress]],
+                           amount: int,
+                           source: str,
+                           progress: Optional[Callable[[int, int], Awaitable[None]]] = None) -> list[Optional[TxHash]]:
+        """
+        Split `amount` (in contract units) evenly between the registered members of a role (or already looked up
+        members and their addresses) or a group of addresses, through the payout queue. What doesn't divide evenly
+        stays with the spending address.
+        `source` identifies the payout, so running the same one again can't pay anyone twice.
+        The balance is checked once for the whole group, see `PayoutQueue.wait` for `progress`.
+        """
+
+        if isinstance(group, discord.Role):
+            group = await DATABASE.get_role_addresses(group)
+        recipients: list[tuple[Optional[int], EthereumAddress]] = \
+            [(member.id, address) for member, address in group.items()] \
+            if isinstance(group, dict) else [(None, address) for address in group]
+        if not recipients:
+            return []
+        split: int = int(amount) // len(recipients)
+        jobs: list[dict] = await self.payouts.pay(source, ((user_id, address, split) for user_id, address in recipients),
+                                                  progress=progress)
+        return [job['tx_hash'] if job['status'] == 'sent' else None for job in jobs]
 
 
 CRYPTO: _Crypto = _Crypto()
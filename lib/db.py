@@ -1,11 +1,52 @@
+import time
+import asyncio
 import discord
+import logging
 import urllib.parse
 from . import CONFIG
+from .cache import TTLCache, MISSING
+from pymongo import UpdateOne, DeleteMany, IndexModel, ReturnDocument
+from pymongo.errors import PyMongoError, DuplicateKeyError
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 from lib.types import EthereumAddress
-from typing import Optional
+from .utils import checksum_address
+from .metrics import instrument, DB_OP_SECONDS
+from typing import Optional, Iterable, Iterator
 
-__all__: tuple = ('DATABASE', 'DatabaseInterface')
+__all__: tuple = ('DATABASE', 'DatabaseInterface', 'AddressAlreadyRegistered')
+logger: logging.Logger = logging.getLogger('database')
+
+INDEXES: dict[str, list[IndexModel]] = {
+    # `address` is stored checksummed for display and payouts, `address_key` lowercase for exact lookups
+    'users': [IndexModel([('address_key', 1)], name='address_key', unique=True, sparse=True)],
+    'airdrops': [IndexModel([('end_time', 1)], name='end_time'),
+                 IndexModel([('updated_at', 1)], name='updated_at'),
+                 IndexModel([('gid', 1), ('cid', 1)], name='guild_channel')],
+    'airdrop_entrants': [IndexModel([('airdrop', 1), ('user', 1)], name='airdrop_user', unique=True)],
+    'payout_jobs': [IndexModel([('status', 1), ('created_at', 1)], name='status_created_at'),
+                    IndexModel([('status', 1), ('claimed_until', 1)], name='status_claimed_until'),
+                    IndexModel([('claim', 1)], name='claim', sparse=True)],
+    'pending_transactions': [IndexModel([('address', 1), ('nonce', 1)], name='address_nonce'),
+                             IndexModel([('jobs', 1)], name='jobs'),
+                             IndexModel([('mined_at', 1)], name='mined_at', expireAfterSeconds=60 * 60 * 24 * 7)]
+}
+# (collection, filter, sort) of the queries run on hot paths, checked against their query plans
+HOT_QUERIES: list[tuple[str, dict, Optional[list]]] = [
+    ('users', {'address_key': '0x0000000000000000000000000000000000000000'}, None),
+    ('airdrops', {'updated_at': {'$gte': 0}}, None),
+    ('airdrop_entrants', {'airdrop': {'$in': [0]}}, [('airdrop', 1), ('user', 1)]),
+    ('payout_jobs', {'status': 'queued'}, [('created_at', 1)]),
+    ('payout_jobs', {'status': 'sending', 'claimed_until': {'$lt': 0}}, None),
+    ('payout_jobs', {'claim': '', 'status': 'sending'}, None),
+    ('pending_transactions', {'address': '', 'nonce': {'$gte': 0}, 'mined': {'$ne': True}}, [('nonce', 1)]),
+    ('pending_transactions', {'jobs': ''}, None)
+]
+
+
+class AddressAlreadyRegistered(Exception):
+    def __init__(self, address: EthereumAddress):
+        super().__init__(f'{address} is already registered by another user')
+        self.address: EthereumAddress = address
 
 
 class _DatabaseClient(AsyncIOMotorClient):
@@ -14,32 +55,294 @@ class _DatabaseClient(AsyncIOMotorClient):
         super().__init__(self._uri)
 
 
+@instrument(DB_OP_SECONDS)
 class DatabaseInterface:
-    def __init__(self, client: _DatabaseClient):
-        self.client: _DatabaseClient = client
-        self.db: AsyncIOMotorDatabase = client[CONFIG.env('DB_NAME')]
+    def __init__(self, client: Optional[_DatabaseClient] = None):
+        """
+        The client is created by `connect()` rather than on import - resolving the SRV record blocks,
+        so it's done in a thread while the rest of the bot starts up.
+        """
+
+        self._client: Optional[_DatabaseClient] = client
+        self._db: Optional[AsyncIOMotorDatabase] = client[CONFIG.env('DB_NAME')] if client is not None else None
+        self._connecting: Optional[asyncio.Future] = None
+        self._plan_check: Optional[asyncio.Task] = None
+        self.address_cache: TTLCache = TTLCache(CONFIG.address_cache_size or 100000, CONFIG.address_cache_ttl or 3600)
+        self.user_id_cache: TTLCache = TTLCache(CONFIG.address_cache_size or 100000, CONFIG.address_cache_ttl or 3600)
+        self.registered_users: set[int] = set()
+
+    @property
+    def client(self) -> _DatabaseClient:
+        if self._client is None:
+            raise RuntimeError('The database was used before connecting to it')
+        return self._client
+
+    @property
+    def db(self) -> AsyncIOMotorDatabase:
+        if self._db is None:
+            raise RuntimeError('The database was used before connecting to it')
+        return self._db
+
+    async def connect(self) -> None:
+        """
+        Create the client, if it wasn't already. Concurrent calls share the same attempt.
+        """
+
+        if self._db is not None:
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(asyncio.to_thread(_DatabaseClient))
+        try:
+            client: _DatabaseClient = await asyncio.shield(self._connecting)
+        except Exception:
+            self._connecting = None
+            raise
+        if self._db is None:
+            self._client, self._db = client, client[CONFIG.env('DB_NAME')]
+
+    async def setup(self) -> None:
+        """
+        Create the indexes every query relies on and migrate documents written by older versions.
+        """
+
+        await self.migrate_user_addresses()
+        await self.ensure_indexes()
+        await self.migrate_airdrop_entrants()
+        if CONFIG.check_query_plans and (self._plan_check is None or self._plan_check.done()):
+            # only informative, so it doesn't hold up startup
+            self._plan_check = asyncio.create_task(self.check_query_plans())
+            self._plan_check.add_done_callback(self._plan_check_done)
+
+    async def ensure_indexes(self) -> None:
+        """
+        Create the indexes, failing if a unique one can't be - the code relies on those for correctness,
+        the others only make it faster.
+        """
+
+        async def create(collection: str, indexes: list[IndexModel]) -> None:
+            try:
+                await self.db[collection].create_indexes(indexes)
+            except PyMongoError as e:
+                if any(index.document.get('unique') for index in indexes):
+                    raise
+                logger.log(logging.WARNING, f'Could not create the indexes of {collection}: {e}')
+
+        await asyncio.gather(*[create(collection, indexes) for collection, indexes in INDEXES.items()])
+
+    async def migrate_user_addresses(self, batch_size: int = 1000) -> None:
+        """
+        Give users registered before addresses were normalised their checksummed address and lowercase lookup key.
+        """
+
+        operations: list[UpdateOne] = []
+        migrated: int = 0
+        async for doc in self.db.users.find({'address': {'$type': 'string'}, 'address_key': {'$exists': False}},
+                                            {'address': 1}):
+            address: EthereumAddress = checksum_address(doc['address'])
+            operations.append(UpdateOne({'_id': doc['_id']}, {'$set': {'address': address,
+                                                                      'address_key': address.lower()}}))
+            if len(operations) >= batch_size:
+                await self.db.users.bulk_write(operations, ordered=False)
+                migrated, operations = migrated + len(operations), []
+        if operations:
+            await self.db.users.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+        if migrated:
+            logger.log(logging.INFO, f'Normalised the addresses of {migrated} users')
+        if 'address_key' not in await self.db.users.index_information():
+            await self._check_duplicate_addresses()
+
+    async def _check_duplicate_addresses(self) -> None:
+        """
+        Older versions let several users register the same address, which the unique `address_key` index
+        can't be built over. Which of them keeps it isn't ours to decide, so startup fails until it's resolved.
+        """
+
+        duplicates: list[dict] = await self.db.users.aggregate([
+            {'$match': {'address_key': {'$type': 'string'}}},
+            {'$group': {'_id': '$address_key', 'users': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}}
+        ]).to_list(length=None)
+        if duplicates:
+            listed: str = ', '.join(f'{doc["_id"]} (users {", ".join(map(str, doc["users"]))})'
+                                    for doc in duplicates[:10])
+            raise RuntimeError(f'{len(duplicates)} addresses are registered by more than one user: {listed}.'
+                               f' Unset the address of all but one user of each before starting the bot')
+
+    @staticmethod
+    def _plan_stages(plan: dict) -> Iterator[str]:
+        yield plan.get('stage', '')
+        for key in ('inputStage', 'queryPlan', 'winningPlan'):
+            if isinstance(plan.get(key), dict):
+                yield from DatabaseInterface._plan_stages(plan[key])
+        for child in plan.get('inputStages', ()):
+            yield from DatabaseInterface._plan_stages(child)
+
+    @staticmethod
+    def _plan_check_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.log(logging.WARNING, f'Checking the query plans failed: {task.exception()!r}')
+
+    async def check_query_plans(self) -> None:
+        """
+        Explain the hot queries and warn about the ones that would scan a whole collection.
+        """
+
+        for collection, filter_, sort in HOT_QUERIES:
+            cursor = self.db[collection].find(filter_, {'_id': 1})
+            if sort:
+                cursor = cursor.sort(sort)
+            try:
+                plan: dict = (await cursor.explain())['queryPlanner']['winningPlan']
+            except (PyMongoError, KeyError) as e:
+                logger.log(logging.DEBUG, f'Could not explain a query on {collection}: {e!r}')
+                continue
+            if 'COLLSCAN' in self._plan_stages(plan):
+                logger.log(logging.WARNING, f'Query {filter_} on {collection} does a collection scan,'
+                                            f' check that its indexes exist')
+
+    async def load_registered_users(self) -> None:
+        """
+        Load the IDs of all registered users, so that airdrop joins can check registration without a query.
+        """
+
+        registered: set[int] = set()
+        async for doc in self.db.users.find({'address': {'$ne': None}}, {'_id': 1}, batch_size=10000):
+            registered.add(doc['_id'])
+        self.registered_users |= registered
+
+    async def is_registered(self, user_id: int) -> bool:
+        if user_id in self.registered_users:
+            return True
+        # users registered through another process aren't in the set, so a miss is double-checked -
+        # against the database rather than the address cache, which may remember them as unregistered
+        user: Optional[dict] = await self.db.users.find_one({'_id': user_id}, {'address': 1})
+        if user is None or not user.get('address'):
+            return False
+        self.registered_users.add(user_id)
+        self.address_cache.set(user_id, user['address'])
+        return True
 
     async def register_user(self, user_id: int, address: EthereumAddress) -> None:
-        await self.db.users.update_one({'_id': user_id}, {'$set': {'address': address}}, upsert=True)
+        """
+        :raises AddressAlreadyRegistered: If another user already registered `address`
+        """
+
+        address = checksum_address(address)
+        try:
+            previous: Optional[dict] = await self.db.users.find_one_and_update(
+                {'_id': user_id}, {'$set': {'address': address, 'address_key': address.lower()}},
+                {'address': 1}, upsert=True, return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            raise AddressAlreadyRegistered(address) from None
+        self.registered_users.add(user_id)
+        # the old address may have been evicted from the address cache while its reverse entry is still cached
+        if previous is not None and previous.get('address'):
+            self.user_id_cache.pop(previous['address'].lower())
+        self.address_cache.set(user_id, address)
+        self.user_id_cache.set(address.lower(), user_id)
 
     async def get_user_address(self, user_id: int) -> Optional[EthereumAddress]:
-        user: Optional[dict] = await self.db.users.find_one({'_id': user_id})
-        if user:
-            return user['address']
+        return (await self.get_users_addresses((user_id,))).get(user_id)
+
+    async def get_users_addresses(self, user_ids: Iterable[int], chunk_size: int = 10000) -> dict[int, EthereumAddress]:
+        """
+        Resolve the addresses of many users at once, using a single $in query per `chunk_size` IDs.
+        Cached users (including ones known to be unregistered) don't hit the database at all.
+        Users without an associated address are left out of the result.
+        """
+
+        resolved: dict[int, EthereumAddress] = {}
+        missing: list[int] = []
+        for user_id in dict.fromkeys(user_ids):
+            if (address := self.address_cache.get(user_id)) is MISSING:
+                missing.append(user_id)
+            elif address:
+                resolved[user_id] = address
+        chunks: list[list[int]] = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+
+        async def fetch(chunk: list[int]) -> list[dict]:
+            return await self.db.users.find({'_id': {'$in': chunk}}, {'address': 1}).to_list(length=None)
+
+        fetched: dict[int, EthereumAddress] = {doc['_id']: doc['address']
+                                               for docs in await asyncio.gather(*[fetch(chunk) for chunk in chunks])
+                                               for doc in docs if doc.get('address')}
+        for user_id in missing:
+            self.address_cache.set(user_id, fetched.get(user_id))
+        self.registered_users.update(fetched)
+        resolved.update(fetched)
+        return resolved
 
     async def get_user_id_by_address(self, address: EthereumAddress) -> Optional[int]:
-        user: Optional[dict] = await self.db.users.find_one({'address': address})
-        if user:
-            return user['_id']
+        key: str = address.lower()
+        if (user_id := self.user_id_cache.get(key)) is not MISSING:
+            return user_id
+        user: Optional[dict] = await self.db.users.find_one({'address_key': key}, {'_id': 1})
+        user_id: Optional[int] = user['_id'] if user else None
+        self.user_id_cache.set(key, user_id)
+        return user_id
+
+    @staticmethod
+    def entrant_key(airdrop_message_id: int, entrant_id: int) -> str:
+        # deterministic, so that delete events (which only carry the _id) can be mapped back to the entrant
+        return f'{airdrop_message_id}:{entrant_id}'
+
+    async def migrate_airdrop_entrants(self) -> None:
+        """
+        Move the entrants of airdrops that still keep them in an array on the airdrop document
+        over to the airdrop entrants collection.
+        """
+
+        async for doc in self.db.airdrops.find({'entrants': {'$exists': True}}, {'entrants': 1}):
+            if doc['entrants']:
+                await self.update_airdrop_entrants(doc['_id'], doc['entrants'])
+            await self.db.airdrops.update_one({'_id': doc['_id']}, {'$unset': {'entrants': ''}})
+
+    async def iter_airdrop_entrants(self, airdrop_message_ids: Iterable[int], session=None):
+        """
+        Yield the (airdrop, entrant) pairs of the given airdrops, sorted by airdrop and then by entrant.
+        """
+
+        async for doc in self.db.airdrop_entrants.find({'airdrop': {'$in': list(airdrop_message_ids)}},
+                                                       {'_id': 0, 'airdrop': 1, 'user': 1},
+                                                       session=session, batch_size=10000).sort([('airdrop', 1),
+                                                                                                ('user', 1)]):
+            yield doc['airdrop'], doc['user']
 
     async def add_airdrop_entrant(self, airdrop_message_id: int, entrant_id: int) -> None:
-        await self.db.airdrops.update_one({'_id': airdrop_message_id}, {'$addToSet': {'entrants': entrant_id}})
+        await self.update_airdrop_entrants(airdrop_message_id, added=(entrant_id,))
 
     async def remove_airdrop_entrant(self, airdrop_message_id: int, entrant_id: int) -> None:
-        await self.db.airdrops.update_one({'_id': airdrop_message_id}, {'$pull': {'entrants': entrant_id}})
+        await self.update_airdrop_entrants(airdrop_message_id, removed=(entrant_id,))
+
+    async def update_airdrop_entrants(self,
+                                      airdrop_message_id: int,
+                                      added: Iterable[int] = (),
+                                      removed: Iterable[int] = ()) -> None:
+        """
+        Apply a batch of joins and leaves to an airdrop in a single round-trip.
+        Each entrant is its own document, so this costs the same no matter how many entrants the airdrop has.
+        """
+
+        added, removed = list(added), list(removed)
+        now: float = time.time()
+        operations: list = [UpdateOne({'_id': self.entrant_key(airdrop_message_id, entrant_id)},
+                                      {'$setOnInsert': {'airdrop': airdrop_message_id, 'user': entrant_id, 'at': now}},
+                                      upsert=True) for entrant_id in added]
+        if removed:
+            operations.append(DeleteMany({'_id': {'$in': [self.entrant_key(airdrop_message_id, entrant_id)
+                                                          for entrant_id in removed]}}))
+        if operations:
+            await self.db.airdrop_entrants.bulk_write(operations, ordered=False)
+            await self.db.airdrops.update_one({'_id': airdrop_message_id}, {'$set': {'updated_at': now}})
+
+    async def delete_airdrop_entrants(self, airdrop_message_id: int) -> None:
+        await self.db.airdrop_entrants.delete_many({'airdrop': airdrop_message_id})
 
     async def get_role_addresses(self, role: discord.Role) -> dict[discord.Member, EthereumAddress]:
-        return {m: a for m, a in zip(role.members, [await self.get_user_address(m.id) for m in role.members]) if a}
+        addresses: dict[int, EthereumAddress] = await self.get_users_addresses(m.id for m in role.members)
+        return {m: addresses[m.id] for m in role.members if m.id in addresses}
 
 
-DATABASE: DatabaseInterface = DatabaseInterface(_DatabaseClient())
+DATABASE: DatabaseInterface = DatabaseInterface()
@@ -0,0 +1,105 @@
+import time
+import uuid
+import asyncio
+import logging
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError, DuplicateKeyError
+from typing import Optional, Callable, Awaitable
+from . import CONFIG, DATABASE
+
+__all__: tuple = ('Lease', 'INSTANCE_ID')
+logger: logging.Logger = logging.getLogger('leases')
+
+# identifies this process as the owner of the leases it holds
+INSTANCE_ID: str = uuid.uuid4().hex
+
+
+class Lease:
+    def __init__(self, name: str, ttl: Optional[float] = None, owner: str = INSTANCE_ID):
+        """
+        A named lock kept in the database, so that only one of several processes does a job at a time.
+        It's held for `ttl` seconds after it was last acquired or renewed, and can be taken over by
+        another process once it expires - so a process that dies only blocks the job for up to `ttl` seconds.
+        Expiry is compared against the wall clock of the processes involved, which are assumed to be in sync.
+        """
+
+        self.name: str = name
+        self.ttl: float = ttl or CONFIG.lease_ttl or 30
+        self.owner: str = owner
+        self._held_until: float = 0
+
+    @property
+    def collection(self):
+        return DATABASE.db.leases
+
+    @property
+    def held(self) -> bool:
+        return time.monotonic() < self._held_until
+
+    @property
+    def remaining(self) -> float:
+        return max(self._held_until - time.monotonic(), 0)
+
+    async def acquire(self) -> bool:
+        """
+        Acquire the lease if it's free or expired, or renew it if it's already ours.
+
+        :return: Whether the lease is held
+        """
+
+        started_at: float = time.monotonic()
+        now: float = time.time()
+        try:
+            await self.collection.find_one_and_update(
+                {'_id': self.name, '$or': [{'owner': self.owner}, {'expires_at': {'$lt': now}}]},
+                {'$set': {'owner': self.owner, 'expires_at': now + self.ttl}},
+                {'_id': 1}, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:  # someone else holds it, so the upsert collided with their document
+            self._held_until = 0
+            return False
+        # counted from before the request, so we never think we hold it longer than the others think we do
+        self._held_until = started_at + self.ttl
+        return True
+
+    async def release(self) -> None:
+        self._held_until = 0
+        await self.collection.delete_one({'_id': self.name, 'owner': self.owner})
+
+    async def hold(self, on_acquired: Callable[[], Awaitable[None]], on_lost: Callable[[], Awaitable[None]]) -> None:
+        """
+        Keep trying to acquire the lease and renew it every third of its TTL, until cancelled.
+        `on_acquired` is awaited whenever the lease is acquired, `on_lost` whenever it couldn't be renewed in time.
+        If `on_acquired` fails, the lease is released again for another process to try.
+        """
+
+        held: bool = False
+        try:
+            while True:
+                try:
+                    acquired: bool = await self.acquire()
+                except PyMongoError as e:
+                    logger.log(logging.WARNING, f'Renewing the {self.name} lease failed: {e}')
+                    # still ours if it'd last until the next attempt
+                    acquired: bool = self.remaining > self.ttl / 3
+                if acquired and not held:
+                    logger.log(logging.INFO, f'Acquired the {self.name} lease')
+                    try:
+                        await on_acquired()
+                    except Exception as e:
+                        logger.log(logging.ERROR, f'Taking over {self.name} failed, releasing the lease: {e!r}')
+                        await on_lost()
+                        await self.release()
+                        acquired = False
+                elif held and not acquired:
+                    logger.log(logging.WARNING, f'Lost the {self.name} lease')
+                    await on_lost()
+                held = acquired
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if held:
+                await on_lost()
+                try:
+                    await self.release()
+                except PyMongoError:
+                    pass  # it'll expire on its own
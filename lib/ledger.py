@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from typing import Optional, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .crypto import _Crypto
+from . import CONFIG
+
+__all__: tuple = ('BalanceLedger',)
+logger: logging.Logger = logging.getLogger('crypto.ledger')
+
+
+class BalanceLedger:
+    def __init__(self, crypto: '_Crypto'):
+        """
+        An in-process view of the spending balance, so affordability checks don't cost a `balanceOf` call each.
+        It's seeded from the chain, decreased by every transfer we sign and re-synced every `balance_sync_interval`
+        seconds, or right away when a transfer fails. Money promised to payouts that haven't been sent yet
+        (live airdrops, tips being dispatched) is reserved under a key, and reserving never awaits,
+        so two concurrent payouts can't both pass the check and jointly overspend.
+        Reservations only live in this process' memory. When the bot runs as several processes, each of them
+        checks against the whole balance, so together they can promise more than it holds - the payouts that don't
+        fit then fail to send and are retried, see `PayoutQueue`.
+        """
+
+        self.crypto: '_Crypto' = crypto
+        self.balance: int = 0
+        self.reserved: int = 0
+        self._reservations: dict[str, int] = {}
+        self._spent_since_sync: int = 0
+        self._sync_task: Optional[asyncio.Task] = None
+        self._syncer: Optional[asyncio.Task] = None
+
+    @property
+    def available(self) -> int:
+        return self.balance - self.reserved
+
+    def can_afford(self, amount: int) -> bool:
+        return self.available >= amount
+
+    def reserve(self, key: str, amount: int, force: bool = False) -> bool:
+        """
+        Reserve `amount` under `key`, if it's available (or regardless of that, when `force`d).
+        Reserving a key that's already reserved is a no-op.
+
+        :return: Whether the amount is reserved
+        """
+
+        if key in self._reservations:
+            return True
+        if not force and not self.can_afford(amount):
+            return False
+        self._reservations[key] = amount
+        self.reserved += amount
+        return True
+
+    def move(self, key: str, new_key: str) -> None:
+        if (amount := self._reservations.pop(key, None)) is not None:
+            self._reservations[new_key] = amount
+
+    def release(self, key: str, amount: Optional[int] = None) -> None:
+        """
+        Release a reservation, or just `amount` of it once that part has been paid out.
+        """
+
+        if (reserved := self._reservations.get(key)) is None:
+            return
+        amount = reserved if amount is None else min(amount, reserved)
+        self.reserved -= amount
+        if amount == reserved:
+            del self._reservations[key]
+        else:
+            self._reservations[key] = reserved - amount
+
+    def spend(self, amount: int) -> None:
+        self.balance -= amount
+        self._spent_since_sync += amount
+
+    async def sync(self) -> None:
+        """
+        Re-read the balance from the chain, including our transactions the node hasn't mined yet.
+        Transfers signed while the balance was being fetched are subtracted again, which may briefly
+        undercount if the node already saw them - never overcount.
+        """
+
+        self._spent_since_sync = 0
+        balance: int = await self.crypto.get_erc20_balance(self.crypto.spending_address, 'pending')
+        self.balance = balance - self._spent_since_sync
+
+    def request_sync(self) -> None:
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._safe_sync())
+
+    async def _safe_sync(self) -> None:
+        try:
+            await self.sync()
+        except Exception as e:
+            logger.log(logging.WARNING, f'Syncing the spending balance failed: {e!r}')
+
+    def start(self) -> None:
+        if self._syncer is None or self._syncer.done():
+            self._syncer = asyncio.create_task(self._run_syncer())
+
+    async def _run_syncer(self) -> None:
+        while True:
+            await asyncio.sleep(CONFIG.balance_sync_interval or 60)
+            await self._safe_sync()
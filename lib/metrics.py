@@ -0,0 +1,196 @@
+"""
+A small Prometheus-style metrics registry, exposed in the text format over HTTP by `MetricsServer`.
+Metrics are module-level objects created once, and updating one is a dictionary lookup - cheap enough for hot paths.
+"""
+
+import abc
+import time
+import inspect
+import logging
+import functools
+from bisect import bisect_left
+from aiohttp import web
+from typing import Optional, Callable, Union, Awaitable
+from . import CONFIG
+
+__all__: tuple = ('Counter', 'Gauge', 'Histogram', 'instrument', 'render_metrics', 'MetricsServer',
+                  'DB_OP_SECONDS', 'CRYPTO_OP_SECONDS', 'INTERACTION_ACK_SECONDS', 'PAYOUTS_TOTAL',
+                  'PAYOUT_BATCH_SECONDS', 'QUEUE_DEPTH', 'LIVE_AIRDROPS', 'AIRDROP_ENTRANTS')
+logger: logging.Logger = logging.getLogger('metrics')
+
+REGISTRY: list['_Metric'] = []
+DEFAULT_BUCKETS: tuple = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric(abc.ABC):
+    type_: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labels: tuple = labels
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_string(self, key: tuple, extra: str = '') -> str:
+        pairs: list[str] = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    @abc.abstractmethod
+    async def samples(self) -> list[str]:
+        ...
+
+    async def render(self) -> str:
+        lines: list[str] = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_}']
+        lines.extend(await self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type_: str = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key: tuple = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    async def samples(self) -> list[str]:
+        return [f'{self.name}{self._label_string(key)} {value}' for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    type_: str = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        """
+        A value that goes up and down. It's either set directly, or read from a callback whenever it's scraped.
+        """
+
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+        self._callbacks: dict[tuple, Callable[[], Union[float, Awaitable[float]]]] = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, callback: Callable[[], Union[float, Awaitable[float]]], **labels) -> None:
+        self._callbacks[self._key(labels)] = callback
+
+    async def samples(self) -> list[str]:
+        values: dict[tuple, float] = dict(self._values)
+        for key, callback in self._callbacks.items():
+            try:
+                value = callback()
+                values[key] = await value if inspect.isawaitable(value) else value
+            except Exception as e:
+                logger.log(logging.WARNING, f'Reading {self.name} failed: {e!r}')
+        return [f'{self.name}{self._label_string(key)} {value}' for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    type_: str = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets: tuple = buckets
+        # label values -> (per bucket counts, with a trailing +Inf one, sum)
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key: tuple = self._key(labels)
+        if (state := self._values.get(key)) is None:
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    async def samples(self) -> list[str]:
+        lines: list[str] = []
+        for key, (counts, total) in self._values.items():
+            cumulative: int = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le: str = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{self._label_string(key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._label_string(key)} {total}')
+            lines.append(f'{self.name}_count{self._label_string(key)} {cumulative}')
+        return lines
+
+
+def instrument(histogram: Histogram) -> Callable[[type], type]:
+    """
+    Class decorator timing every public coroutine method of the class into `histogram`, labelled by method name.
+    """
+
+    def wrap(method: Callable, name: str) -> Callable:
+        @functools.wraps(method)
+        async def timed(*args, **kwargs):
+            started_at: float = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started_at, method=name)
+        return timed
+
+    def decorator(cls: type) -> type:
+        for name, method in list(vars(cls).items()):
+            if not name.startswith('_') and inspect.iscoroutinefunction(method):
+                setattr(cls, name, wrap(method, name))
+        return cls
+
+    return decorator
+
+
+async def render_metrics() -> str:
+    return '\n'.join([await metric.render() for metric in REGISTRY]) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, host: Optional[str] = None, port: Optional[int] = None):
+        """
+        Serves the metrics at `/metrics`, meant to be scraped from the same host or a private network.
+        """
+
+        self.host: str = host or CONFIG.metrics_host or '127.0.0.1'
+        self.port: int = port if port is not None else int(CONFIG.env('METRICS_PORT') or CONFIG.metrics_port or 9100)
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, _: web.Request) -> web.Response:
+        return web.Response(text=await render_metrics(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self) -> None:
+        app: web.Application = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.log(logging.INFO, f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+DB_OP_SECONDS: Histogram = Histogram('airdrop_db_operation_seconds', 'Latency of database operations', ('method',))
+CRYPTO_OP_SECONDS: Histogram = Histogram('airdrop_crypto_operation_seconds',
+                                         'Latency of node-backed operations, mostly RPC round-trips', ('method',))
+INTERACTION_ACK_SECONDS: Histogram = Histogram('airdrop_interaction_ack_seconds',
+                                               'Time from an interaction being created until it was acknowledged',
+                                               ('type',))
+PAYOUTS_TOTAL: Counter = Counter('airdrop_payouts_total', 'Payout jobs processed, by outcome', ('status',))
+PAYOUT_BATCH_SECONDS: Histogram = Histogram('airdrop_payout_batch_seconds', 'Time taken to send a batch of payouts')
+QUEUE_DEPTH: Gauge = Gauge('airdrop_queue_depth', 'Items waiting in the background queues', ('queue',))
+LIVE_AIRDROPS: Gauge = Gauge('airdrop_live_airdrops', 'Airdrops held by this process')
+AIRDROP_ENTRANTS: Gauge = Gauge('airdrop_entrants', 'Entrants across the airdrops held by this process')
@@ -0,0 +1,283 @@
+import time
+import heapq
+import datetime
+import asyncio
+import logging
+from typing import Optional, Iterable, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .crypto import _Crypto
+from . import CONFIG, DATABASE
+from .rpc import RPCError, EndpointUnavailable
+from .metrics import PAYOUTS_TOTAL
+from .types import TxHash
+
+__all__: tuple = ('NonceManager',)
+logger: logging.Logger = logging.getLogger('crypto.nonces')
+
+# errors a node returns for a transaction it already has, i.e. the broadcast effectively succeeded
+KNOWN_TX_ERRORS: tuple = ('already known', 'known transaction', 'alreadyknown')
+NONCE_USED_ERRORS: tuple = ('nonce too low', 'nonce is too low', 'oldnonce')
+# how many checks a used nonce may go without a receipt for any of its transactions before they're given up on
+MAX_RECEIPT_MISSES: int = 3
+
+
+class NonceManager:
+    def __init__(self, crypto: '_Crypto'):
+        """
+        Hands out nonces for the spending address and keeps track of every transaction sent with them.
+        Each signed transaction is written to the `pending_transactions` collection before it's broadcast,
+        so after a crash or restart it can be re-broadcast instead of leaving a nonce gap that stalls everything
+        after it. Transactions that sit unmined for too long are replaced with a higher gas price, up to
+        `max_gas_bumps` times and `max_gas_price`. Nonces of transactions the node refused are reused by the next
+        allocation, or filled with an empty transaction to ourselves if transactions after them are waiting.
+        Once a nonce is used, the receipts of the transactions sent with it tell whether it succeeded; the payout
+        jobs of one that reverted, or was never mined, are marked as failed. Mined transactions are kept
+        (flagged `mined`) for a week, so payout jobs can tell they went out.
+        """
+
+        self.crypto: '_Crypto' = crypto
+        self.next_nonce: Optional[int] = None
+        self._released: list[int] = []
+        self._monitor: Optional[asyncio.Task] = None
+
+    @property
+    def collection(self):
+        return DATABASE.db.pending_transactions
+
+    def _key(self, nonce: int) -> str:
+        return f'{self.crypto.spending_address.lower()}:{nonce}'
+
+    async def setup(self) -> None:
+        """
+        Reconcile the persisted pending transactions with the chain and work out the next nonce.
+        """
+
+        latest, pending, _ = await asyncio.gather(
+            self.crypto._request_int('eth_getTransactionCount', [self.crypto.spending_address, 'latest']),
+            self.crypto._request_int('eth_getTransactionCount', [self.crypto.spending_address, 'pending']),
+            DATABASE.connect()
+        )
+        address: str = self.crypto.spending_address.lower()
+        await self._settle(latest)
+        records: list[dict] = await self.collection.find({'address': address, 'nonce': {'$gte': latest},
+                                                          'mined': {'$ne': True}},
+                                                         {'nonce': 1, 'hash': 1, 'raw': 1}).to_list(length=None)
+        self.next_nonce = max([pending] + [record['nonce'] + 1 for record in records])
+        tracked: set[int] = {record['nonce'] for record in records}
+        self._released = [nonce for nonce in range(pending, self.next_nonce) if nonce not in tracked]
+        heapq.heapify(self._released)
+        for record in records:
+            await self._rebroadcast(record)
+        if records or self._released:
+            logger.log(logging.INFO, f'Recovered {len(records)} pending transactions and {len(self._released)}'
+                                     f' nonce gaps, next nonce is {self.next_nonce}')
+        if self._monitor is None or self._monitor.done():
+            self._monitor = asyncio.create_task(self._run_monitor())
+
+    async def stop(self) -> None:
+        if self._monitor is not None:
+            self._monitor.cancel()
+            await asyncio.gather(self._monitor, return_exceptions=True)
+            self._monitor = None
+
+    def allocate(self, count: int = 1, reuse: bool = True) -> list[int]:
+        """
+        Reserve `count` nonces, filling gaps left by refused transactions first unless `reuse` is off,
+        in which case they're higher than every nonce handed out so far.
+        This never awaits, so concurrent callers can't be handed the same nonce.
+        """
+
+        nonces: list[int] = [heapq.heappop(self._released)
+                             for _ in range(min(count, len(self._released) if reuse else 0))]
+        fresh: int = count - len(nonces)
+        nonces.extend(range(self.next_nonce, self.next_nonce + fresh))
+        self.next_nonce += fresh
+        return nonces
+
+    def release(self, nonce: int) -> None:
+        heapq.heappush(self._released, nonce)
+
+    async def _settle(self, latest: int) -> None:
+        """
+        Flag the tracked transactions whose nonce has been used as mined, after checking their receipts.
+        """
+
+        records: list[dict] = await self.collection.find({'address': self.crypto.spending_address.lower(),
+                                                          'nonce': {'$lt': latest},
+                                                          'mined': {'$ne': True}},
+                                                         {'hash': 1, 'replaced': 1, 'jobs': 1, 'nonce': 1,
+                                                          'receipt_misses': 1}).to_list(length=None)
+        await asyncio.gather(*[self._settle_record(record) for record in records])
+
+    async def _settle_record(self, record: dict) -> None:
+        """
+        Look up which of the transactions sent with a used nonce was mined - the latest one or one it replaced - and
+        whether it succeeded. If it reverted, or none of them was mined (the nonce was used by something else),
+        its payout jobs are marked as failed.
+        """
+
+        hashes: list[TxHash] = [record['hash'], *record.get('replaced', ())]
+        receipts: list[Optional[dict]] = await asyncio.gather(*[
+            self.crypto.rpc.request('eth_getTransactionReceipt', [tx_hash]) for tx_hash in hashes])
+        receipt: Optional[dict] = next((receipt for receipt in receipts if receipt), None)
+        if receipt is None and record.get('receipt_misses', 0) + 1 < MAX_RECEIPT_MISSES:
+            # the node that answered may be behind the one that counted the nonce
+            await self.collection.update_one({'_id': record['_id']}, {'$inc': {'receipt_misses': 1}})
+            return
+        succeeded: bool = receipt is not None and int(receipt['status'], 16) == 1
+        mined_hash: Optional[TxHash] = receipt['transactionHash'] if receipt is not None else None
+        await self.collection.update_one({'_id': record['_id']},
+                                         {'$set': {'mined': True, 'mined_at': datetime.datetime.utcnow(),
+                                                   'succeeded': succeeded, 'mined_hash': mined_hash}})
+        jobs: list[str] = record.get('jobs', [])
+        if succeeded:
+            if jobs and mined_hash.lower() != record['hash'].lower():
+                await DATABASE.db.payout_jobs.update_many({'_id': {'$in': jobs}},
+                                                          {'$set': {'tx_hash': mined_hash, 'updated_at': time.time()}})
+            return
+        logger.log(logging.ERROR, f'Transaction {mined_hash or record["hash"]} (nonce {record["nonce"]})'
+                                  f' {"reverted" if receipt is not None else "was never mined"},'
+                                  f' failing its {len(jobs)} payout jobs')
+        self.crypto.ledger.request_sync()
+        if jobs:
+            result = await DATABASE.db.payout_jobs.update_many({'_id': {'$in': jobs}, 'status': 'sent'},
+                                                               {'$set': {'status': 'failed', 'updated_at': time.time()}})
+            PAYOUTS_TOTAL.inc(result.modified_count, status='reverted')
+
+    async def find_by_job(self, job_id: str) -> Optional[dict]:
+        return await self.collection.find_one({'jobs': job_id, 'succeeded': {'$ne': False}}, {'hash': 1, 'nonce': 1})
+
+    async def send(self, tx: dict, replacing: Optional[dict] = None, jobs: Iterable[str] = ()) -> TxHash:
+        """
+        Sign, persist and broadcast a transaction whose nonce was allocated by this manager.
+        If the node can't be reached the transaction stays tracked and is re-broadcast later,
+        so its hash is returned either way.
+
+        :param tx: The transaction, including its nonce and gas price
+        :param replacing: The record of the pending transaction this one replaces, if any
+        :param jobs: The IDs of the payout jobs this transaction pays out
+        """
+
+        try:
+            signed_tx = self.crypto.account.sign_transaction(tx)
+            tx_hash: TxHash = signed_tx.hash.hex()
+            record: dict = {
+                '_id': self._key(tx['nonce']),
+                'address': self.crypto.spending_address.lower(),
+                'nonce': tx['nonce'],
+                'hash': tx_hash,
+                'gas_price': tx['gasPrice'],
+                'payload': {k: v for k, v in tx.items() if k not in ('nonce', 'gasPrice')},
+                'raw': signed_tx.rawTransaction.hex(),
+                'sent_at': time.time(),
+                'jobs': list(jobs) if replacing is None else replacing.get('jobs', []),
+                'bumps': 0 if replacing is None else replacing.get('bumps', 0) + 1,
+                # any of the transactions sent with this nonce may be the one that gets mined
+                'replaced': [] if replacing is None else [*replacing.get('replaced', []), replacing['hash']],
+                'mined': False
+            }
+            await self.collection.replace_one({'_id': record['_id']}, record, upsert=True)
+        except Exception:
+            # nothing was sent or tracked, so the nonce would otherwise be a gap every later transaction waits behind
+            if replacing is None:
+                self.release(tx['nonce'])
+            raise
+        try:
+            await self._broadcast(record['raw'], tx['nonce'])
+        except RPCError as e:
+            if replacing is not None:
+                await self.collection.replace_one({'_id': record['_id']}, replacing, upsert=True)
+                raise
+            await self.collection.delete_one({'_id': record['_id']})
+            if not any(error in e.message.lower() for error in NONCE_USED_ERRORS):
+                self.release(tx['nonce'])
+            raise
+        if replacing is not None and record['jobs']:
+            # the replaced transaction won't be mined, so the jobs point at the one that will
+            await DATABASE.db.payout_jobs.update_many({'_id': {'$in': record['jobs']}, 'tx_hash': replacing['hash']},
+                                                      {'$set': {'tx_hash': tx_hash, 'updated_at': time.time()}})
+        return tx_hash
+
+    async def _broadcast(self, raw: str, nonce: int) -> None:
+        try:
+            await self.crypto.rpc.request('eth_sendRawTransaction', [raw])
+        except EndpointUnavailable as e:
+            logger.log(logging.WARNING, f'Could not broadcast transaction with nonce {nonce}, will retry: {e}')
+        except RPCError as e:
+            if not any(error in e.message.lower() for error in KNOWN_TX_ERRORS):
+                raise
+
+    async def _rebroadcast(self, record: dict) -> None:
+        try:
+            await self._broadcast(record['raw'], record['nonce'])
+        except RPCError as e:
+            # a used nonce is settled from its receipts, once the transaction count has caught up with it
+            if not any(error in e.message.lower() for error in NONCE_USED_ERRORS):
+                logger.log(logging.WARNING, f'Re-broadcasting transaction {record["hash"]} failed: {e}')
+
+    async def _run_monitor(self) -> None:
+        while True:
+            await asyncio.sleep(CONFIG.nonce_check_interval or 30)
+            try:
+                await self.check_pending()
+            except Exception as e:
+                logger.log(logging.WARNING, f'Checking pending transactions failed: {e!r}')
+
+    async def check_pending(self) -> None:
+        """
+        Settle mined transactions, fill the nonce gaps pending transactions are waiting behind, re-broadcast the rest
+        and replace the ones that have been stuck for longer than `stuck_transaction_timeout` with a bumped gas price.
+        """
+
+        address: str = self.crypto.spending_address.lower()
+        latest: int = await self.crypto._request_int('eth_getTransactionCount', [self.crypto.spending_address, 'latest'])
+        await self._settle(latest)
+        # whole records, a replacement that fails restores the record it replaced as is
+        records: list[dict] = await self.collection.find({'address': address, 'nonce': {'$gte': latest},
+                                                          'mined': {'$ne': True}}) \
+            .sort('nonce', 1).to_list(length=None)
+        # transactions behind a gap aren't stuck because of their gas price, so they're left alone until it's mined
+        filled: bool = bool(records) and await self._fill_gaps(latest, records[-1]['nonce'])
+        stuck_before: float = time.time() - (CONFIG.stuck_transaction_timeout or 180)
+        max_bumps: int = CONFIG.max_gas_bumps if CONFIG.max_gas_bumps is not None else 10
+        max_gas_price: Optional[int] = CONFIG.max_gas_price
+        gas_price: Optional[int] = None
+        for record in records:
+            if (filled or record['sent_at'] > stuck_before or record.get('bumps', 0) >= max_bumps
+                    or (max_gas_price is not None and record['gas_price'] >= max_gas_price)):
+                await self._rebroadcast(record)
+                continue
+            gas_price = gas_price or await self.crypto.gas_price()
+            bumped: int = max(int(record['gas_price'] * (CONFIG.gas_bump_factor or 1.125)) + 1, gas_price)
+            if max_gas_price is not None:
+                bumped = min(bumped, max_gas_price)
+            logger.log(logging.INFO, f'Replacing stuck transaction {record["hash"]} (nonce {record["nonce"]})'
+                                     f' with gas price {bumped}')
+            try:
+                await self.send({**record['payload'], 'nonce': record['nonce'], 'gasPrice': bumped}, replacing=record)
+            except RPCError as e:
+                logger.log(logging.WARNING, f'Replacing transaction with nonce {record["nonce"]} failed: {e}')
+
+    async def _fill_gaps(self, latest: int, below: int) -> bool:
+        """
+        Send an empty transaction to ourselves with every released nonce below `below`,
+        since the transactions with higher nonces can't be mined until those are used.
+
+        :return: Whether any gap was filled
+        """
+
+        gaps: list[int] = sorted(nonce for nonce in self._released if latest <= nonce < below)
+        if not gaps:
+            return False
+        # taken out of the released ones right away, so they can't be allocated while we're sending
+        self._released = [nonce for nonce in self._released if nonce >= below]
+        heapq.heapify(self._released)
+        gas_price: int = await self.crypto.gas_price()
+        for nonce in gaps:
+            logger.log(logging.INFO, f'Filling the nonce gap at {nonce}')
+            try:
+                await self.send({'to': self.crypto.spending_address, 'value': 0, 'gas': 21000, 'gasPrice': gas_price,
+                                 'nonce': nonce, 'chainId': self.crypto.chain_id})
+            except RPCError as e:  # the nonce was released again, it's retried on the next check
+                logger.log(logging.WARNING, f'Filling the nonce gap at {nonce} failed: {e}')
+        return True
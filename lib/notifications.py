@@ -0,0 +1,75 @@
+import asyncio
+import discord
+import logging
+from typing import Optional, Callable, Awaitable
+from . import CONFIG
+
+__all__: tuple = ('NotificationQueue',)
+logger: logging.Logger = logging.getLogger('notifications')
+
+
+class NotificationQueue:
+    def __init__(self, bot: discord.Bot, workers: Optional[int] = None):
+        """
+        A queue of DMs that are sent in the background by a pool of `workers`,
+        so that payouts never have to wait on Discord before moving on to the next recipient.
+        Pacing is left to the library's per-route rate limit buckets, recipients are looked up in the member cache
+        before falling back to the API, rate-limited sends are retried and users with closed DMs are skipped.
+        """
+
+        self.bot: discord.Bot = bot
+        self.workers: int = workers or CONFIG.dm_workers or 8
+        self.max_retries: int = CONFIG.dm_max_retries or 3
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        for _ in range(self.workers - len(self._workers)):
+            self._workers.append(asyncio.create_task(self._work()))
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def send(self,
+             user_id: int,
+             embed: discord.Embed,
+             on_delivered: Optional[Callable[[], Awaitable[None]]] = None) -> None:
+        """
+        Queue a DM. `on_delivered` is awaited once it's been sent - or skipped for good, because the user's DMs are
+        closed - but not if sending it failed.
+        """
+
+        self._queue.put_nowait((user_id, embed, on_delivered))
+
+    async def join(self) -> None:
+        await self._queue.join()
+
+    async def _work(self) -> None:
+        while True:
+            user_id, embed, on_delivered = await self._queue.get()
+            try:
+                await self._deliver(user_id, embed)
+                if on_delivered is not None:
+                    await on_delivered()
+            except Exception as e:
+                logger.log(logging.WARNING, f'Could not notify user {user_id}: {e!r}')
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, user_id: int, embed: discord.Embed) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                user: discord.User = self.bot.get_user(user_id) or await self.bot.fetch_user(user_id)
+                await user.send(embed=embed)
+                return
+            except (discord.Forbidden, discord.NotFound):
+                logger.log(logging.DEBUG, f'Skipping user {user_id}, their DMs are closed')
+                return
+            except discord.HTTPException as e:
+                # the library already waits out and retries most 429s, these are the ones it gave up on
+                if (e.status != 429 and e.status < 500) or attempt == self.max_retries:
+                    raise
+                retry_after: float = float(e.response.headers.get('Retry-After') or 2 ** attempt)
+                await asyncio.sleep(retry_after)
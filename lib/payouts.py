@@ -0,0 +1,282 @@
+import time
+import uuid
+import asyncio
+import logging
+from pymongo import UpdateOne
+from typing import Optional, Iterable, Callable, Awaitable, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .crypto import _Crypto
+from . import CONFIG, DATABASE
+from .leases import Lease
+from .metrics import PAYOUTS_TOTAL, PAYOUT_BATCH_SECONDS
+from .types import EthereumAddress
+
+__all__: tuple = ('PayoutQueue',)
+logger: logging.Logger = logging.getLogger('crypto.payouts')
+
+FINISHED_STATUSES: frozenset = frozenset({'sent', 'failed'})
+JOB_PROJECTION: dict = {'status': 1, 'tx_hash': 1, 'user_id': 1, 'address': 1, 'notified': 1}
+CLAIMED_JOB_PROJECTION: dict = {'source': 1, 'address': 1, 'amount': 1, 'attempts': 1, 'claim': 1}
+
+
+class PayoutQueue:
+    def __init__(self, crypto: '_Crypto'):
+        """
+        A durable queue of payouts backed by the `payout_jobs` collection.
+        Every payout is a job keyed by its source (an airdrop, a tip command) and its recipient, and jobs are only
+        ever inserted once, so enqueueing the same payout again - e.g. re-resolving an airdrop after a crash -
+        can't pay anyone twice. Workers claim queued jobs in batches and send them through the nonce manager,
+        which records the job IDs with each transaction; a job whose worker died mid-send is marked as sent if its
+        transaction was recorded and put back in the queue otherwise.
+        Jobs can be enqueued and waited on by any process, but only the one holding the `payouts` lease
+        runs workers, so a single process owns the spending address' nonces.
+        """
+
+        self.crypto: '_Crypto' = crypto
+        self.worker_id: str = uuid.uuid4().hex
+        self._waiters: dict[str, list[asyncio.Future]] = {}
+        self._wakeup: Optional[asyncio.Event] = None  # created by `start()`, on the loop the workers run on
+        self._workers: list[asyncio.Task] = []
+        self.lease: Lease = Lease('payouts')
+        self._leader: Optional[asyncio.Task] = None
+
+    @property
+    def collection(self):
+        return DATABASE.db.payout_jobs
+
+    @staticmethod
+    def job_id(source: str, user_id: Optional[int], address: EthereumAddress) -> str:
+        return f'{source}:{user_id if user_id is not None else address.lower()}'
+
+    async def enqueue(self,
+                      source: str,
+                      payouts: Iterable[tuple[Optional[int], EthereumAddress, int]],
+                      check_balance: bool = True) -> list[str]:
+        """
+        Queue payouts, skipping the ones that were already queued under the same source.
+
+        :param source: What the payouts are for, e.g. `airdrop:<message ID>`
+        :param payouts: (user ID or None, address, contract value) triples
+        :param check_balance: Whether to check the spending balance covers the payouts that weren't queued yet
+        :return: The job IDs, in the same order as `payouts`
+        """
+
+        payouts: list[tuple[Optional[int], EthereumAddress, int]] = list(payouts)
+        job_ids: list[str] = [self.job_id(source, user_id, address) for user_id, address, _ in payouts]
+        if not job_ids:
+            return []
+        existing: set[str] = {job['_id'] for job in await self.collection.find({'_id': {'$in': job_ids}},
+                                                                               {'_id': 1}).to_list(length=None)}
+        new: list[tuple[str, tuple[Optional[int], EthereumAddress, int]]] = [
+            (job_id, payout) for job_id, payout in zip(job_ids, payouts) if job_id not in existing]
+        if not new:
+            return job_ids
+        total: int = sum(amount for _, (_, _, amount) in new)
+        if check_balance:
+            self.crypto.reserve(source, total)
+        now: float = time.time()
+        await self.collection.bulk_write([UpdateOne({'_id': job_id}, {'$setOnInsert': {
+            'source': source,
+            'user_id': user_id,
+            'address': address,
+            'amount': str(amount),  # token amounts easily overflow a 64-bit integer
+            'status': 'queued',
+            'attempts': 0,
+            'tx_hash': None,
+            'notified': False,
+            'created_at': now
+        }}, upsert=True) for job_id, (user_id, address, amount) in new], ordered=False)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_ids
+
+    async def wait(self,
+                   job_ids: Iterable[str],
+                   timeout: Optional[float] = None,
+                   progress: Optional[Callable[[int, int], Awaitable[None]]] = None) -> list[dict]:
+        """
+        Wait for jobs to be sent or to fail for good, whichever worker (or process) handles them.
+        Jobs that don't exist (anymore) count as failed.
+
+        :param timeout: Seconds to wait before raising `asyncio.TimeoutError`, `payout_wait_timeout` by default -
+                        with no process holding the payout lease, nothing would ever finish them
+        :param progress: Awaited with the number of finished jobs and the total whenever some of them finish
+
+        :return: The finished jobs, in the same order as `job_ids`
+        """
+
+        job_ids: list[str] = list(job_ids)
+        deadline: float = time.monotonic() + (timeout if timeout is not None else CONFIG.payout_wait_timeout or 600)
+        poll_interval: float = CONFIG.payout_poll_interval or 5
+        while True:
+            jobs: dict[str, dict] = {job['_id']: job
+                                     for job in await self.collection.find({'_id': {'$in': job_ids}},
+                                                                           JOB_PROJECTION).to_list(length=None)}
+            for job_id in job_ids:
+                if job_id not in jobs:
+                    logger.log(logging.WARNING, f'Payout job {job_id} was waited for, but doesn\'t exist')
+                    jobs[job_id] = {'_id': job_id, 'status': 'failed', 'tx_hash': None, 'notified': False}
+            unfinished: list[str] = [job_id for job_id in job_ids if jobs[job_id]['status'] not in FINISHED_STATUSES]
+            if progress is not None:
+                await progress(len(job_ids) - len(unfinished), len(job_ids))
+            if not unfinished:
+                return [jobs[job_id] for job_id in job_ids]
+            if time.monotonic() >= deadline:
+                raise asyncio.TimeoutError(f'{len(unfinished)} payout jobs are still unfinished')
+            # woken up as soon as a local worker finishes one of them, polled for ones finished elsewhere
+            futures: list[asyncio.Future] = [asyncio.get_running_loop().create_future() for _ in unfinished]
+            for job_id, future in zip(unfinished, futures):
+                self._waiters.setdefault(job_id, []).append(future)
+            try:
+                await asyncio.wait(futures, timeout=max(0.0, min(poll_interval, deadline - time.monotonic())),
+                                   return_when=asyncio.ALL_COMPLETED if progress is None else asyncio.FIRST_COMPLETED)
+            finally:
+                for job_id, future in zip(unfinished, futures):
+                    if (waiters := self._waiters.get(job_id)) is not None:
+                        waiters.remove(future)
+                        if not waiters:
+                            del self._waiters[job_id]
+
+    async def pay(self,
+                  source: str,
+                  payouts: Iterable[tuple[Optional[int], EthereumAddress, int]],
+                  check_balance: bool = True,
+                  progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+                  timeout: Optional[float] = None) -> list[dict]:
+        """
+        Enqueue payouts and wait for them to finish, see `enqueue` and `wait`.
+        On a timeout the jobs stay queued, paying the same `source` again later picks them up.
+        """
+
+        try:
+            return await self.wait(await self.enqueue(source, payouts, check_balance), timeout, progress)
+        finally:
+            self.crypto.ledger.release(source)
+
+    async def mark_notified(self, job_ids: Iterable[str]) -> None:
+        await self.collection.update_many({'_id': {'$in': list(job_ids)}}, {'$set': {'notified': True}})
+
+    def start(self, workers: Optional[int] = None) -> None:
+        """
+        Compete for the `payouts` lease and run `workers` workers whenever it's held,
+        unless this process is configured not to send payouts at all.
+        """
+
+        if (CONFIG.env('PAYOUT_WORKER') or '').lower() in ('0', 'false'):
+            return
+        if self._leader is None or self._leader.done():
+            self._leader = asyncio.create_task(self.lease.hold(lambda: self._take_over(workers), self._hand_over))
+
+    async def stop(self) -> None:
+        if self._leader is not None:
+            self._leader.cancel()
+            await asyncio.gather(self._leader, return_exceptions=True)
+            self._leader = None
+        await self._hand_over()
+
+    async def _take_over(self, workers: Optional[int]) -> None:
+        # whoever held the lease before may have left transactions pending, they're reconciled before sending more
+        await self.crypto.nonces.setup()
+        self.crypto.disperse_allowance = None  # and may have used some of the allowance
+        self.start_workers(workers)
+
+    async def _hand_over(self) -> None:
+        await self.stop_workers()
+        await self.crypto.nonces.stop()
+
+    def start_workers(self, workers: Optional[int] = None) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        for _ in range((workers or CONFIG.payout_workers or 1) - len(self._workers)):
+            self._workers.append(asyncio.create_task(self._work()))
+
+    async def stop_workers(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.recover()
+                jobs: list[dict] = await self._claim(CONFIG.payout_batch_size or 200)
+                if jobs:
+                    await self._process(jobs)
+                    continue
+            except Exception as e:
+                logger.log(logging.ERROR, f'Payout worker failed: {e!r}')
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=CONFIG.payout_poll_interval or 5)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self, limit: int) -> list[dict]:
+        candidates: list[dict] = await self.collection.find({'status': 'queued'}, {'_id': 1}) \
+            .sort('created_at', 1).limit(limit).to_list(length=None)
+        if not candidates:
+            return []
+        claim: str = f'{self.worker_id}:{uuid.uuid4().hex}'
+        # only the jobs still queued are taken, so a job can't be claimed by two workers
+        await self.collection.update_many({'_id': {'$in': [job['_id'] for job in candidates]}, 'status': 'queued'},
+                                          {'$set': {'status': 'sending', 'claim': claim,
+                                                    'claimed_until': time.time() + (CONFIG.payout_claim_timeout or 300)},
+                                           '$inc': {'attempts': 1}})
+        return await self.collection.find({'claim': claim, 'status': 'sending'},
+                                          CLAIMED_JOB_PROJECTION).to_list(length=None)
+
+    async def _process(self, jobs: list[dict]) -> None:
+        started_at: float = time.perf_counter()
+        tx_hashes: list = await self.crypto.bulk_transfer_erc20(((job['address'], int(job['amount'])) for job in jobs),
+                                                                check_balance=False,
+                                                                jobs=[job['_id'] for job in jobs])
+        for i, (job, tx_hash) in enumerate(zip(jobs, tx_hashes)):
+            # a send can fail after its transaction was recorded, in which case it's still on its way
+            if not tx_hash and (record := await self.crypto.nonces.find_by_job(job['_id'])) is not None:
+                tx_hashes[i] = record['hash']
+        max_attempts: int = CONFIG.payout_max_attempts or 3
+        operations: list[UpdateOne] = []
+        for job, tx_hash in zip(jobs, tx_hashes):
+            if tx_hash:
+                update: dict = {'status': 'sent', 'tx_hash': tx_hash}
+            else:
+                update: dict = {'status': 'failed' if job['attempts'] >= max_attempts else 'queued'}
+            operations.append(UpdateOne({'_id': job['_id'], 'claim': job['claim']},
+                                        {'$set': {**update, 'updated_at': time.time()}}))
+        await self.collection.bulk_write(operations, ordered=False)
+        for job, tx_hash in zip(jobs, tx_hashes):
+            if tx_hash:
+                self.crypto.ledger.release(job['source'], int(job['amount']))  # it's been spent instead
+            if tx_hash or job['attempts'] >= max_attempts:
+                self._finished(job['_id'])
+        sent: int = sum(1 for tx_hash in tx_hashes if tx_hash)
+        failed: int = sum(1 for job, tx_hash in zip(jobs, tx_hashes) if not tx_hash and job['attempts'] >= max_attempts)
+        PAYOUTS_TOTAL.inc(sent, status='sent')
+        PAYOUTS_TOTAL.inc(failed, status='failed')
+        PAYOUTS_TOTAL.inc(len(jobs) - sent - failed, status='requeued')
+        PAYOUT_BATCH_SECONDS.observe(time.perf_counter() - started_at)
+        logger.log(logging.INFO, f'Sent {sent} of {len(jobs)} claimed payouts')
+
+    def _finished(self, job_id: str) -> None:
+        for future in self._waiters.get(job_id, ()):
+            if not future.done():
+                future.set_result(None)
+
+    async def recover(self) -> None:
+        """
+        Settle the jobs whose claim expired mid-send: if their transaction was recorded by the nonce manager it is
+        (or will be re-broadcast) on its way, so they're sent, otherwise nothing left the bot and they're re-queued.
+        """
+
+        async for job in self.collection.find({'status': 'sending', 'claimed_until': {'$lt': time.time()}},
+                                              {'claim': 1}):
+            record: Optional[dict] = await self.crypto.nonces.find_by_job(job['_id'])
+            update: dict = {'status': 'sent', 'tx_hash': record['hash']} if record else {'status': 'queued'}
+            result = await self.collection.update_one({'_id': job['_id'], 'claim': job['claim'], 'status': 'sending'},
+                                                      {'$set': {**update, 'updated_at': time.time()}})
+            if result.modified_count:
+                logger.log(logging.WARNING, f'Recovered payout job {job["_id"]} as {update["status"]}')
+                if record:
+                    self._finished(job['_id'])
@@ -7,7 +7,8 @@ from . import CONFIG
 
 __all__: tuple = ('invalid_address', 'no_associated_address_you',
                   'tip_notification', 'no_associated_address_user',
-                  'invalid_duration', 'insufficient_funds')
+                  'invalid_duration', 'insufficient_funds', 'payout_failed', 'payout_pending',
+                  'address_already_registered')
 
 
 async def invalid_address(ctx: ApplicationContext):
@@ -21,6 +22,15 @@ async def invalid_address(ctx: ApplicationContext):
     await ctx.respond(embed=embed)
 
 
+async def address_already_registered(ctx: ApplicationContext):
+    embed: discord.Embed = discord.Embed(
+        title='Uh oh!',
+        color=discord.Color.red(),
+        description=f'**That address is already registered** by another user! Please use your own address.'
+    )
+    await ctx.respond(embed=embed, ephemeral=True)
+
+
 async def no_associated_address_you(ctx: ApplicationContext, footer: str = ''):
     embed: discord.Embed = discord.Embed(
         title='Uh oh!',
@@ -45,14 +55,14 @@ async def no_associated_address_user(ctx: ApplicationContext, user: discord.Memb
     await ctx.respond(embed=embed)
 
 
-async def tip_notification(ctx: ApplicationContext, user: discord.Member, amount: Union[int, float], tx_hash: 'TxHash'):
+def tip_notification(ctx: ApplicationContext, user: discord.Member, amount: Union[int, float], tx_hash: 'TxHash'):
     embed: discord.Embed = discord.Embed(title=':tada:  You received a tip!',
                                          description=f'You **have been tipped** `{amount}{CONFIG.token_symbol}`'                                                     f' by {ctx.author.mention}!',
                                          color=0xec850a,
                                          url=ctx.bot.crypto.explorer(tx_hash))  # noqa
     embed.add_field(name='Transaction Hash', value=f'```c\n{tx_hash}```')
     embed.set_footer(text='Enjoy your gift, see ya around!', icon_url=ctx.bot.user.avatar.url)
-    await user.send(embed=embed)
+    ctx.bot.notifications.send(user.id, embed)  # noqa
 
 
 async def invalid_duration(ctx: ApplicationContext):
@@ -68,3 +78,18 @@ async def insufficient_funds(ctx: ApplicationContext, amount: Union[int, float])
                                          description=f'You **don\'t have enough funds** to send a TX with `{amount}{CONFIG.token_symbol}`!',
                                          color=discord.Color.red())
     await ctx.respond(embed=embed, ephemeral=True)
+
+
+async def payout_failed(ctx: ApplicationContext):
+    embed: discord.Embed = discord.Embed(title='Uh oh!',
+                                         description='**The transaction could not be sent.** Please try again later.',
+                                         color=discord.Color.red())
+    await ctx.respond(embed=embed)  # public, as a follow-up to the public defer of the payout
+
+
+async def payout_pending(ctx: ApplicationContext):
+    embed: discord.Embed = discord.Embed(title=':hourglass_flowing_sand:  Still sending...',
+                                         description='**The transaction is queued**, but hasn\'t been sent yet.'
+                                                     ' It will be sent as soon as possible - don\'t send it again!',
+                                         color=discord.Color.blurple())
+    await ctx.respond(embed=embed)  # public, as a follow-up to the public defer of the payout
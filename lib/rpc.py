@@ -0,0 +1,290 @@
+import json
+import time
+import asyncio
+import aiohttp
+import itertools
+from typing import Any, Optional, Union, Iterable
+from . import CONFIG
+
+__all__: tuple = ('RPCClient', 'RPCPool', 'RPCError', 'EndpointUnavailable')
+
+# read-only methods whose concurrent identical calls can safely share one response
+COALESCABLE_METHODS: frozenset = frozenset({
+    'eth_call', 'eth_gasPrice', 'eth_blockNumber', 'eth_chainId', 'eth_getBalance',
+    'eth_getTransactionCount', 'eth_getTransactionReceipt', 'eth_getTransactionByHash'
+})
+# methods whose order matters to the node's view of our nonce, so they must not hop between endpoints
+STICKY_METHODS: frozenset = frozenset({'eth_sendRawTransaction', 'eth_getTransactionCount'})
+HEDGED_METHODS: frozenset = frozenset({'eth_call'})
+# "limit exceeded" style JSON-RPC errors some providers return instead of an HTTP 429
+RATE_LIMIT_ERROR_CODES: frozenset = frozenset({-32005, -32090})
+
+
+class RPCError(Exception):
+    def __init__(self, code: int, message: str, data: Any = None):
+        super().__init__(f'JSON-RPC error {code}: {message}')
+        self.code: int = code
+        self.message: str = message
+        self.data: Any = data
+
+
+class EndpointUnavailable(Exception):
+    def __init__(self, url: str):
+        super().__init__(f'RPC endpoint {url} is unavailable')
+        self.url: str = url
+
+
+class RPCClient:
+    def __init__(self,
+                 url: str,
+                 max_concurrency: Optional[int] = None,
+                 timeout: Optional[float] = None,
+                 batch_window: Optional[float] = None,
+                 max_batch_size: Optional[int] = None):
+        """
+        A minimal asyncio JSON-RPC client for an Ethereum node.
+        Connections are kept alive and pooled by a single aiohttp session, and at most `max_concurrency`
+        requests are in flight to the endpoint at any time.
+        Requests issued within `batch_window` seconds of each other are sent together as one JSON-RPC batch,
+        and identical read-only requests that are already in flight are answered by the same response.
+        """
+
+        self.url: str = url
+        self.max_concurrency: int = max_concurrency or CONFIG.rpc_concurrency or 16
+        self.timeout: aiohttp.ClientTimeout = aiohttp.ClientTimeout(total=timeout or CONFIG.rpc_timeout or 15)
+        self.batch_window: float = batch_window if batch_window is not None else (CONFIG.rpc_batch_window or 0.005)
+        self.max_batch_size: int = max_batch_size or CONFIG.rpc_batch_size or 100
+        self._ids: itertools.count = itertools.count(1)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._inflight: dict[tuple[str, str], asyncio.Future] = {}
+        # the loop only keeps weak references to tasks, so the batches in flight are kept here
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # created lazily so that it's bound to the loop the bot actually runs on
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60),
+                timeout=self.timeout
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def request(self, method: str, params: Optional[list] = None) -> Any:
+        params = params or []
+        if method not in COALESCABLE_METHODS:
+            return await self._enqueue(method, params)
+        key: tuple[str, str] = (method, json.dumps(params, sort_keys=True))
+        if (future := self._inflight.get(key)) is None:
+            future = self._inflight[key] = asyncio.ensure_future(self._enqueue(method, params))
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def _enqueue(self, method: str, params: list) -> asyncio.Future:
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._pending.append(({'jsonrpc': '2.0', 'id': next(self._ids), 'method': method, 'params': params}, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            task: asyncio.Task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        try:
+            session: aiohttp.ClientSession = self.session
+            payload: Any = batch[0][0] if len(batch) == 1 else [request for request, _ in batch]
+            async with self._semaphore:
+                async with session.post(self.url, json=payload) as response:
+                    response.raise_for_status()
+                    body: Any = await response.json(content_type=None)
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        responses: dict[int, dict] = {r.get('id'): r for r in (body if isinstance(body, list) else [body])}
+        for request, future in batch:
+            if future.done():
+                continue
+            if (response := responses.get(request['id'])) is None:
+                future.set_exception(RPCError(0, f'No response to {request["method"]} in batch'))
+            elif (error := response.get('error')) is not None:
+                future.set_exception(RPCError(error.get('code', 0), error.get('message', ''), error.get('data')))
+            else:
+                future.set_result(response.get('result'))
+
+    async def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for _, future in self._pending:
+            future.cancel()
+        self._pending = []
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class RPCEndpoint:
+    __slots__: tuple = ('client', 'latency', 'failures', 'open_until')
+
+    def __init__(self, client: RPCClient):
+        self.client: RPCClient = client
+        self.latency: float = 0.0
+        self.failures: int = 0
+        self.open_until: float = 0.0
+
+    @property
+    def url(self) -> str:
+        return self.client.url
+
+    @property
+    def available(self) -> bool:
+        return self.open_until <= time.monotonic()
+
+    def record_success(self, latency: float, alpha: float) -> None:
+        self.latency = latency if not self.latency else alpha * latency + (1 - alpha) * self.latency
+        self.failures = 0
+
+    def record_failure(self, threshold: int, cooldown: float) -> None:
+        self.failures += 1
+        if self.failures >= threshold:
+            self.trip(cooldown)
+
+    def trip(self, cooldown: float) -> None:
+        self.open_until = time.monotonic() + cooldown
+
+
+class RPCPool:
+    def __init__(self, urls: Union[str, Iterable[str]]):
+        """
+        Routes JSON-RPC requests over several endpoints, preferring the one with the lowest latency (tracked as an
+        exponentially weighted moving average). Endpoints that keep failing or rate-limit us (HTTP 429) are taken out
+        of rotation for a while, requests fail over to the next best endpoint, and `eth_call`s are hedged - if the best
+        endpoint hasn't answered within `rpc_hedge_delay`, the same call is raced on the runner-up.
+        Nonce-sensitive methods stick to a single endpoint for as long as it stays healthy.
+        """
+
+        self.endpoints: list[RPCEndpoint] = [RPCEndpoint(RPCClient(url))
+                                             for url in ([urls] if isinstance(urls, str) else urls)]
+        self.alpha: float = CONFIG.rpc_latency_alpha or 0.2
+        self.failure_threshold: int = CONFIG.rpc_failure_threshold or 3
+        self.cooldown: float = CONFIG.rpc_cooldown or 30
+        self.hedge_delay: float = CONFIG.rpc_hedge_delay or 0.25
+        self._sticky: Optional[RPCEndpoint] = None
+
+    def ranked(self) -> list[RPCEndpoint]:
+        """
+        Available endpoints from fastest to slowest - or all of them, if every circuit is open.
+        """
+
+        available: list[RPCEndpoint] = [e for e in self.endpoints if e.available] or self.endpoints
+        return sorted(available, key=lambda e: e.latency)
+
+    async def _request_on(self, endpoint: RPCEndpoint, method: str, params: Optional[list]) -> Any:
+        started: float = time.monotonic()
+        try:
+            result: Any = await endpoint.client.request(method, params)
+        except RPCError as e:
+            if e.code in RATE_LIMIT_ERROR_CODES:
+                endpoint.trip(self.cooldown)
+                raise EndpointUnavailable(endpoint.url) from e
+            endpoint.record_success(time.monotonic() - started, self.alpha)
+            raise
+        except aiohttp.ClientResponseError as e:
+            if e.status == 429:
+                endpoint.trip(self.cooldown)
+            else:
+                endpoint.record_failure(self.failure_threshold, self.cooldown)
+            raise EndpointUnavailable(endpoint.url) from e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            endpoint.record_failure(self.failure_threshold, self.cooldown)
+            raise EndpointUnavailable(endpoint.url) from e
+        endpoint.record_success(time.monotonic() - started, self.alpha)
+        return result
+
+    async def request(self, method: str, params: Optional[list] = None) -> Any:
+        if method in STICKY_METHODS:
+            return await self._sticky_request(method, params)
+        if method in HEDGED_METHODS and len(self.endpoints) > 1:
+            return await self._hedged_request(method, params)
+        return await self._failover_request(self.ranked(), method, params)
+
+    async def _failover_request(self, endpoints: list[RPCEndpoint], method: str, params: Optional[list]) -> Any:
+        error: Optional[Exception] = None
+        for endpoint in endpoints:
+            try:
+                return await self._request_on(endpoint, method, params)
+            except EndpointUnavailable as e:
+                error = e
+        raise error or EndpointUnavailable('(none left)')
+
+    async def _sticky_request(self, method: str, params: Optional[list]) -> Any:
+        if self._sticky is None or not self._sticky.available:
+            self._sticky = self.ranked()[0]
+        try:
+            return await self._request_on(self._sticky, method, params)
+        except EndpointUnavailable:
+            # re-broadcasting the same signed transaction elsewhere is harmless, so move on to a new sticky endpoint
+            failed, self._sticky = self._sticky, None
+            return await self._sticky_failover([e for e in self.ranked() if e is not failed], method, params)
+
+    async def _sticky_failover(self, endpoints: list[RPCEndpoint], method: str, params: Optional[list]) -> Any:
+        error: Optional[Exception] = None
+        for endpoint in endpoints:
+            try:
+                result: Any = await self._request_on(endpoint, method, params)
+            except EndpointUnavailable as e:
+                error = e
+            else:
+                self._sticky = endpoint
+                return result
+        raise error or EndpointUnavailable('(none left)')
+
+    async def _hedged_request(self, method: str, params: Optional[list]) -> Any:
+        endpoints: list[RPCEndpoint] = self.ranked()
+        if len(endpoints) == 1:
+            return await self._failover_request(endpoints, method, params)
+        primary: asyncio.Task = asyncio.create_task(self._request_on(endpoints[0], method, params))
+        done, _ = await asyncio.wait({primary}, timeout=max(self.hedge_delay, 2 * endpoints[0].latency))
+        if done and primary.exception() is None:
+            return primary.result()
+        if done and not isinstance(primary.exception(), EndpointUnavailable):
+            raise primary.exception()
+        hedge: asyncio.Task = asyncio.create_task(self._failover_request(endpoints[1:], method, params))
+        pending: set[asyncio.Task] = {hedge} if done else {primary, hedge}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def close(self) -> None:
+        await asyncio.gather(*[endpoint.client.close() for endpoint in self.endpoints])
@@ -1,4 +1,6 @@
-__all__: tuple = ('shorten_address',)
+from eth_utils import to_checksum_address
+
+__all__: tuple = ('shorten_address', 'checksum_address')
 
 
 def shorten_address(address: str) -> str:
@@ -10,3 +12,13 @@ def shorten_address(address: str) -> str:
 
     chunk: int = int(len(address) / 5)
     return f'{address[:chunk]}...{address[-chunk:]}'
+
+
+def checksum_address(address: str) -> str:
+    """
+    Convert a (validated) address, with or without the 0x prefix, to its EIP-55 checksummed form.
+    :param address: The address to convert
+    :return: The checksummed address
+    """
+
+    return to_checksum_address(address if address.startswith('0x') else '0x' + address)
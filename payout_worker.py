@@ -0,0 +1,25 @@
+import os
+import asyncio
+import logging
+
+
+async def main():
+    from lib import DATABASE, CRYPTO
+    await DATABASE.connect()
+    await asyncio.gather(DATABASE.setup(), CRYPTO.setup())
+    CRYPTO.payouts.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await CRYPTO.payouts.stop()
+        await CRYPTO.close()
+
+
+if __name__ == '__main__':
+    if os.name != 'nt':
+        __import__('uvloop').install()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s:%(name)s]: %(message)s')
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
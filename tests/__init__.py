@@ -0,0 +1,6 @@
+"""
+Behaviour tests of the payout machinery, run against the stand-ins in `benchmarks.fakes` and an in-memory
+mongomock-motor database (see requirements-dev.txt):
+
+    python -m unittest discover tests
+"""
@@ -0,0 +1,82 @@
+import os
+import unittest
+from eth_account import Account
+from mongomock_motor import AsyncMongoMockClient
+
+# a throwaway key is enough for a fake chain, it's read from the environment on setup
+TEST_KEY: str = '0x' + '42' * 32
+os.environ['SPENDING_PRIVATE_KEY'] = TEST_KEY
+os.environ['SPENDING_ADDRESS'] = Account.from_key(TEST_KEY).address
+os.environ['DB_NAME'] = 'airdrop_tests'
+
+from lib import CONFIG, DATABASE, AirdropManager, ENTRANT_WRITES
+from lib.crypto import _Crypto
+from lib.rpc import RPCPool
+from benchmarks.fakes import FakeNode, FakeDiscordHTTP, FakeBot, FakeChannel
+
+__all__: tuple = ('DatabaseTestCase', 'ChainTestCase', 'AirdropTestCase', 'address', 'GUILD_ID', 'CHANNEL_ID')
+
+_MISSING: object = object()
+GUILD_ID: int = 900000000000000000
+CHANNEL_ID: int = 900000000000000001
+
+
+def address(n: int) -> str:
+    return Account.from_key((n + 1).to_bytes(32, 'big')).address
+
+
+class DatabaseTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.client: AsyncMongoMockClient = AsyncMongoMockClient()
+        DATABASE._client, DATABASE._db = self.client, self.client[os.environ['DB_NAME']]
+        self.addCleanup(setattr, DATABASE, '_db', None)
+        self.addCleanup(setattr, DATABASE, '_client', None)
+        self.db = DATABASE.db
+
+    def configure(self, **values) -> None:
+        """
+        Override config values for the duration of the test.
+        """
+
+        for key, value in values.items():
+            previous: object = CONFIG.__dict__.get(key, _MISSING)
+            setattr(CONFIG, key, value)
+            self.addCleanup(lambda k=key, v=previous: delattr(CONFIG, k) if v is _MISSING else setattr(CONFIG, k, v))
+
+
+class ChainTestCase(DatabaseTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.node: FakeNode = FakeNode()
+        await self.node.start()
+        self.crypto: _Crypto = _Crypto()
+        self.crypto.rpc = RPCPool(self.node.url)
+        await self.crypto.setup()
+
+    async def asyncTearDown(self) -> None:
+        await self.crypto.payouts.stop()
+        await self.crypto.nonces.stop()
+        if self.crypto.ledger._syncer is not None:
+            self.crypto.ledger._syncer.cancel()
+        if self.crypto.ledger._sync_task is not None:  # let a requested sync finish while the node is still up
+            await self.crypto.ledger._sync_task
+        await self.crypto.close()
+        await self.node.stop()
+
+
+class AirdropTestCase(ChainTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.http: FakeDiscordHTTP = FakeDiscordHTTP(latency=0)
+        self.bot: FakeBot = FakeBot(self.http, DATABASE, self.crypto)
+        self.channel: FakeChannel = FakeChannel(self.http, CHANNEL_ID, GUILD_ID)
+        self.bot.add_channel(self.channel)
+        self.manager: AirdropManager = AirdropManager(self.bot)  # noqa
+
+    async def asyncTearDown(self) -> None:
+        for task in (self.manager._sync, self.manager._scheduler, *self.manager._resolving.values()):
+            if task is not None:
+                task.cancel()
+        for airdrop_id in set(ENTRANT_WRITES._added) | set(ENTRANT_WRITES._removed) | set(ENTRANT_WRITES._timers):
+            ENTRANT_WRITES.discard(airdrop_id)
+        await super().asyncTearDown()
@@ -0,0 +1,224 @@
+import time
+import asyncio
+import unittest
+from types import SimpleNamespace
+from typing import Optional
+from unittest import mock
+from pymongo.errors import PyMongoError, OperationFailure
+from lib import Airdrop, NotificationQueue
+from lib.airdrops.entrant_buffer import ENTRANT_WRITES
+from benchmarks.fakes import FakeUser
+from .base import AirdropTestCase, address, GUILD_ID, CHANNEL_ID
+
+
+class NewAirdropTests(AirdropTestCase):
+    def context(self, interaction_id: int = 1) -> SimpleNamespace:
+        return SimpleNamespace(interaction=SimpleNamespace(id=interaction_id), respond=mock.AsyncMock(),
+                               channel=self.channel, author=FakeUser(self.http, 2), bot=self.bot)
+
+    async def test_reward_is_reserved_for_the_airdrop(self):
+        await self.manager.new_airdrop(self.context(), 10, 3600)
+        airdrop, = self.manager._state.values()
+        self.assertEqual(self.crypto.ledger._reservations, {airdrop.payout_source: self.crypto.to_contract_value(10)})
+
+    async def test_reservation_is_released_when_the_airdrop_cannot_be_added(self):
+        with mock.patch.object(self.manager, '_add_from_message', side_effect=PyMongoError('not primary')):
+            with self.assertRaises(PyMongoError):
+                await self.manager.new_airdrop(self.context(), 10, 3600)
+        self.assertEqual(self.crypto.ledger.reserved, 0)
+
+    async def test_unaffordable_airdrop_is_refused(self):
+        ctx: SimpleNamespace = self.context()
+        await self.manager.new_airdrop(ctx, self.crypto.to_human_value(self.crypto.ledger.balance) * 2, 3600)
+        self.assertEqual(self.manager._state, {})
+        self.assertEqual(self.crypto.ledger.reserved, 0)
+        ctx.respond.assert_awaited_once()
+
+
+class ResolveTests(AirdropTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        patcher = mock.patch('lib.airdrops.airdrop.CRYPTO', self.crypto)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        await self.crypto.nonces.setup()
+        self.crypto.payouts.start_workers()
+        self.bot.notifications = NotificationQueue(self.bot)  # noqa
+        self.addAsyncCleanup(self.stop_notifications)
+        await self.db.users.insert_many([{'_id': user_id, 'address': address(user_id),
+                                          'address_key': address(user_id).lower()} for user_id in (1, 2)])
+
+    async def stop_notifications(self) -> None:
+        for worker in self.bot.notifications._workers:
+            worker.cancel()
+
+    async def test_winners_are_marked_notified_once_their_dm_is_sent(self):
+        airdrop: Airdrop = Airdrop(GUILD_ID, CHANNEL_ID, 42, 10, int(time.time()), [1, 2])
+        await airdrop.resolve(self.bot)  # noqa
+        jobs: list[dict] = await self.crypto.payouts.collection.find().to_list(length=None)
+        self.assertEqual([(job['status'], job['notified']) for job in jobs], [('sent', False)] * 2)
+        self.bot.notifications.start()
+        await self.bot.notifications.join()
+        self.assertEqual(await self.crypto.payouts.collection.count_documents({'notified': True}), 2)
+
+
+class SchedulerTests(AirdropTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.resolved: list[int] = []
+        patcher = mock.patch.object(self.manager, '_resolve_due', self.record_resolve)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def record_resolve(self, airdrop: Airdrop) -> None:
+        self.resolved.append(airdrop.message_id)
+        del self.manager._resolving[airdrop.message_id]
+
+    def schedule(self, message_id: int, delay: float) -> None:
+        self.manager._state[message_id] = Airdrop(GUILD_ID, CHANNEL_ID, message_id, 1, int(time.time()) + 3600)
+        self.manager._schedule(message_id, time.time() + delay)
+
+    async def run_scheduler(self, duration: float = 0.15) -> None:
+        self.manager._scheduler = asyncio.create_task(self.manager._run_scheduler())
+        await asyncio.sleep(duration)
+
+    async def test_airdrops_are_resolved_in_deadline_order(self):
+        self.schedule(1, 0.06)
+        self.schedule(2, 0.02)
+        self.schedule(3, 0.04)
+        await self.run_scheduler()
+        self.assertEqual(self.resolved, [2, 3, 1])
+        self.assertEqual(self.manager._scheduled, {})
+
+    async def test_rescheduled_airdrop_is_resolved_once_at_its_new_deadline(self):
+        self.schedule(1, 0.02)
+        self.schedule(2, 0.04)
+        self.manager._schedule(1, time.time() + 0.08)
+        await self.run_scheduler()
+        self.assertEqual(self.resolved, [2, 1])
+
+    async def test_scheduling_an_earlier_deadline_wakes_the_scheduler(self):
+        self.schedule(1, 3600)
+        await self.run_scheduler(0.02)
+        self.schedule(2, 0.02)
+        await asyncio.sleep(0.08)
+        self.assertEqual(self.resolved, [2])
+
+    async def test_unscheduled_airdrop_is_not_resolved(self):
+        self.schedule(1, 0.02)
+        self.schedule(2, 0.04)
+        self.manager._unschedule(1)
+        await self.run_scheduler()
+        self.assertEqual(self.resolved, [2])
+        self.assertEqual(self.manager._deadlines, [])
+
+    async def test_airdrop_already_resolving_is_not_dispatched_again(self):
+        self.schedule(1, 0.02)
+        self.manager._resolving[1] = asyncio.create_task(asyncio.sleep(1))
+        await self.run_scheduler()
+        self.assertEqual(self.resolved, [])
+
+
+class FakeChangeStream:
+    def __init__(self, changes: list[dict], error: Optional[Exception] = None):
+        self.changes: list[dict] = changes
+        self.error: Optional[Exception] = error
+        self.resume_token: Optional[dict] = None
+
+    async def __aenter__(self) -> 'FakeChangeStream':
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        pass
+
+    async def __aiter__(self):
+        for change in self.changes:
+            self.resume_token = {'_data': change['_id']}
+            yield change
+        if self.error is not None:
+            raise self.error
+        await asyncio.Event().wait()
+
+
+class SyncTests(AirdropTestCase):
+    def airdrop_change(self, operation: str, message_id: int, **fields) -> dict:
+        change: dict = {'_id': f'{operation}:{message_id}', 'operationType': operation,
+                        'ns': {'coll': 'airdrops'}, 'documentKey': {'_id': message_id}}
+        if operation == 'insert':
+            change['fullDocument'] = Airdrop(GUILD_ID, CHANNEL_ID, message_id, 10, int(time.time()) + 3600,
+                                             **fields).to_db_dict()
+        elif operation == 'update':
+            change['updateDescription'] = {'updatedFields': fields}
+        return change
+
+    @staticmethod
+    def entrant_change(operation: str, message_id: int, user_id: int) -> dict:
+        return {'_id': f'{operation}:{message_id}:{user_id}', 'operationType': operation,
+                'ns': {'coll': 'airdrop_entrants'}, 'documentKey': {'_id': f'{message_id}:{user_id}'}}
+
+    def reserved(self, message_id: int) -> int:
+        return self.crypto.ledger._reservations.get(f'airdrop:{message_id}', 0)
+
+    async def test_airdrop_changes_are_applied(self):
+        self.manager._apply_change(self.airdrop_change('insert', 1))
+        self.assertEqual(self.reserved(1), self.crypto.to_contract_value(10))
+        end_time: int = int(time.time()) + 60
+        self.manager._apply_change(self.airdrop_change('update', 1, end_time=end_time))
+        self.assertEqual(self.manager._state[1].end_time, end_time)
+        self.assertEqual(self.manager._scheduled[1], end_time)
+        self.manager._apply_change(self.airdrop_change('delete', 1))
+        self.assertEqual(self.manager._state, {})
+        self.assertEqual(self.manager._scheduled, {})
+        self.assertEqual(self.reserved(1), 0)
+
+    async def test_entrant_changes_are_applied(self):
+        self.manager._apply_change(self.airdrop_change('insert', 1))
+        self.manager._apply_change(self.entrant_change('insert', 1, 7))
+        self.manager._apply_change(self.entrant_change('insert', 1, 5))
+        self.manager._apply_change(self.entrant_change('insert', 2, 5))  # not a live airdrop
+        self.assertEqual(list(self.manager._state[1].entrants), [5, 7])
+        self.manager._apply_change(self.entrant_change('delete', 1, 7))
+        self.assertEqual(list(self.manager._state[1].entrants), [5])
+
+    async def test_pending_entrant_writes_win_over_the_stream(self):
+        self.manager._apply_change(self.airdrop_change('insert', 1))
+        ENTRANT_WRITES.add(1, 7)
+        self.manager._apply_change(self.entrant_change('delete', 1, 7))
+        self.assertIn(7, ENTRANT_WRITES.overlay(1, self.manager._state[1].entrants))
+
+    async def test_invalidation_is_reported(self):
+        with self.assertRaises(OperationFailure):
+            self.manager._apply_change({'operationType': 'dropDatabase'})
+
+    async def test_stream_resumes_after_the_last_applied_change(self):
+        streams: list[FakeChangeStream] = [
+            FakeChangeStream([self.airdrop_change('insert', 1)], PyMongoError('connection reset')),
+            FakeChangeStream([self.airdrop_change('delete', 1)])
+        ]
+        self.configure(airdrop_sync_interval=0.01)
+        with mock.patch.object(self.db, 'watch', side_effect=streams) as watch:
+            self.manager._sync = asyncio.create_task(self.manager._run_sync(None))
+            await asyncio.sleep(0.1)
+        self.assertEqual(watch.call_args_list[1].kwargs['resume_after'], {'_data': 'insert:1'})
+        self.assertEqual(self.manager._state, {})
+        self.assertEqual(self.reserved(1), 0)
+
+    async def test_deltas_are_polled_without_change_streams(self):
+        self.configure(airdrop_sync_interval=0.02)
+        with mock.patch.object(self.db, 'watch', side_effect=OperationFailure('not a replica set', code=40573)):
+            await self.manager.update()
+            self.manager._sync = asyncio.create_task(self.manager._run_sync(None))
+            await asyncio.sleep(0.01)
+        await self.db.airdrops.insert_one(Airdrop(GUILD_ID, CHANNEL_ID, 1, 10, int(time.time()) + 3600).to_db_dict())
+        await self.db.airdrop_entrants.insert_one({'_id': '1:5', 'airdrop': 1, 'user': 5})
+        await asyncio.sleep(0.06)
+        self.assertEqual(list(self.manager._state[1].entrants), [5])
+        self.assertEqual(self.reserved(1), self.crypto.to_contract_value(10))
+        await self.db.airdrops.delete_one({'_id': 1})
+        await asyncio.sleep(0.06)
+        self.assertEqual(self.manager._state, {})
+        self.assertEqual(self.reserved(1), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
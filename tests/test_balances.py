@@ -0,0 +1,45 @@
+import asyncio
+import unittest
+from .base import ChainTestCase, address
+
+
+class BalanceCacheTests(ChainTestCase):
+    def lookups(self) -> tuple[int, int]:
+        return self.node.method_calls.get('eth_blockNumber', 0), self.node.method_calls.get('eth_call', 0)
+
+    async def test_fresh_balance_is_not_looked_up_again(self):
+        calls: tuple[int, int] = self.lookups()
+        self.assertEqual(await self.crypto.cached_erc20_balance(address(1)), self.node.balance)
+        self.assertEqual(await self.crypto.cached_erc20_balance(address(1).lower()), self.node.balance)
+        self.assertEqual(self.lookups(), (calls[0] + 1, calls[1] + 1))
+
+    async def test_stale_balance_is_kept_until_a_new_block(self):
+        self.configure(balance_cache_staleness=1e-6)
+        await self.crypto.cached_erc20_balance(address(1))
+        _, balance_calls = self.lookups()
+        await asyncio.sleep(0.01)
+        await self.crypto.cached_erc20_balance(address(1))
+        self.assertEqual(self.lookups()[1], balance_calls)
+        self.node.block += 1
+        self.node.balance -= 1
+        self.assertEqual(await self.crypto.cached_erc20_balance(address(1)), self.node.balance)
+        self.assertEqual(self.lookups()[1], balance_calls + 1)
+
+    async def test_concurrent_lookups_are_shared(self):
+        _, balance_calls = self.lookups()
+        balances: list[int] = await asyncio.gather(*[self.crypto.cached_erc20_balance(address(1)) for _ in range(5)])
+        self.assertEqual(balances, [self.node.balance] * 5)
+        self.assertEqual(self.lookups()[1], balance_calls + 1)
+        self.assertEqual(self.crypto._balance_lookups, {})
+
+    async def test_transfers_invalidate_both_balances(self):
+        await self.crypto.nonces.setup()
+        await self.crypto.cached_erc20_balance(address(1))
+        await self.crypto.cached_erc20_balance(self.crypto.spending_address)
+        await self.crypto.transfer_erc20(address(1), 10)
+        self.assertNotIn(address(1).lower(), self.crypto.balances)
+        self.assertNotIn(self.crypto.spending_address.lower(), self.crypto.balances)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import time
+import unittest
+from lib.cache import TTLCache, MISSING
+
+
+class TTLCacheTests(unittest.TestCase):
+    def test_cached_none_is_not_missing(self):
+        cache: TTLCache = TTLCache(10, 60)
+        cache.set('a', None)
+        self.assertIsNone(cache.get('a'))
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache: TTLCache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.peek('a'), cache.peek('b'), cache.peek('c')), (1, MISSING, 3))
+        self.assertEqual(len(cache), 2)
+
+    def test_peek_does_not_touch_the_order(self):
+        cache: TTLCache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.peek('a')
+        cache.set('c', 3)
+        self.assertNotIn('a', cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    def test_entries_expire(self):
+        cache: TTLCache = TTLCache(10, 0.05)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual(len(cache), 0)
+
+    def test_setting_again_renews_the_expiry(self):
+        cache: TTLCache = TTLCache(10, 0.1)
+        cache.set('a', 1)
+        time.sleep(0.06)
+        cache.set('a', 2)
+        time.sleep(0.06)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_no_ttl(self):
+        cache: TTLCache = TTLCache(10, None)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_pop(self):
+        cache: TTLCache = TTLCache(10, 60)
+        cache.set('a', 1)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertIs(cache.pop('a'), MISSING)
+
+
+if __name__ == '__main__':
+    unittest.main()
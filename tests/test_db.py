@@ -0,0 +1,83 @@
+import unittest
+from unittest import mock
+from lib import DATABASE, AddressAlreadyRegistered
+from lib.cache import MISSING
+from .base import DatabaseTestCase, address
+
+
+class AddressCacheTests(DatabaseTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        DATABASE.address_cache.clear()
+        DATABASE.user_id_cache.clear()
+        DATABASE.registered_users.clear()
+
+    async def test_addresses_are_cached(self):
+        await self.db.users.insert_one({'_id': 1, 'address': address(1), 'address_key': address(1).lower()})
+        self.assertEqual(await DATABASE.get_users_addresses([1, 2]), {1: address(1)})
+        await self.db.users.delete_many({})
+        self.assertEqual(await DATABASE.get_users_addresses([1, 2]), {1: address(1)})  # 2 is cached as unregistered
+        self.assertEqual(DATABASE.address_cache.peek(2), None)
+
+    async def test_registering_caches_both_ways(self):
+        await DATABASE.register_user(1, address(1))
+        self.assertEqual(await DATABASE.get_user_address(1), address(1))
+        self.assertEqual(await DATABASE.get_user_id_by_address(address(1)), 1)
+
+    async def test_changing_address_forgets_the_old_one(self):
+        await DATABASE.register_user(1, address(1))
+        self.assertEqual(await DATABASE.get_user_id_by_address(address(1)), 1)
+        DATABASE.address_cache.pop(1)  # evicted, the reverse entry is still there
+        await DATABASE.register_user(1, address(2))
+        self.assertIs(DATABASE.user_id_cache.peek(address(1).lower()), MISSING)
+        self.assertIsNone(await DATABASE.get_user_id_by_address(address(1)))
+        self.assertEqual(await DATABASE.get_user_id_by_address(address(2)), 1)
+
+
+class AddressMigrationTests(DatabaseTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        DATABASE.address_cache.clear()
+        DATABASE.user_id_cache.clear()
+        DATABASE.registered_users.clear()
+
+    async def test_old_addresses_are_checksummed(self):
+        await self.db.users.insert_many([{'_id': 1, 'address': address(1).lower()},
+                                         {'_id': 2, 'address': address(2).upper().replace('0X', '0x')},
+                                         {'_id': 3}])
+        await DATABASE.migrate_user_addresses(batch_size=1)
+        users: list[dict] = await self.db.users.find().sort('_id', 1).to_list(length=None)
+        self.assertEqual(users, [{'_id': 1, 'address': address(1), 'address_key': address(1).lower()},
+                                 {'_id': 2, 'address': address(2), 'address_key': address(2).lower()},
+                                 {'_id': 3}])
+        self.assertEqual(await DATABASE.get_user_id_by_address(address(2).lower()), 2)
+
+    async def test_duplicate_addresses_stop_the_migration(self):
+        await self.db.users.insert_many([{'_id': 1, 'address': address(1).lower()},
+                                         {'_id': 2, 'address': address(1)}])
+        with self.assertRaisesRegex(RuntimeError, 'users 1, 2'):
+            await DATABASE.migrate_user_addresses()
+
+    async def test_duplicates_are_not_checked_once_indexed(self):
+        await DATABASE.ensure_indexes()
+        await self.db.users.insert_one({'_id': 1, 'address': address(1).lower()})
+        with mock.patch.object(DATABASE, '_check_duplicate_addresses') as check:
+            await DATABASE.migrate_user_addresses()
+        check.assert_not_called()
+
+    async def test_addresses_are_registered_checksummed(self):
+        await DATABASE.register_user(1, address(1).lower())
+        self.assertEqual(await self.db.users.find_one({'_id': 1}),
+                         {'_id': 1, 'address': address(1), 'address_key': address(1).lower()})
+
+    async def test_address_can_only_be_registered_once(self):
+        await DATABASE.ensure_indexes()
+        await DATABASE.register_user(1, address(1))
+        with self.assertRaises(AddressAlreadyRegistered):
+            await DATABASE.register_user(2, address(1).lower())
+        await DATABASE.register_user(1, address(1).lower())  # re-registering your own address is fine
+        self.assertIsNone(await DATABASE.get_user_address(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from eth_abi import decode_abi
+from eth_utils import to_checksum_address
+from .base import ChainTestCase, address
+
+APPROVE_SELECTOR: str = '0x095ea7b3'
+
+
+class DisperseAllowanceTests(ChainTestCase):
+    async def asyncSetUp(self) -> None:
+        self.configure(testnet_disperse_address=address(99))
+        await super().asyncSetUp()
+        self.node.auto_mine = False
+        self.node.allowance = 100
+        await self.crypto.nonces.setup()
+
+    async def approvals(self) -> list[int]:
+        return [int(record['payload']['data'][-64:], 16)
+                async for record in self.crypto.nonces.collection.find().sort('nonce', 1)
+                if record['payload']['data'].startswith(APPROVE_SELECTOR)]
+
+    async def test_pending_disperses_count_against_the_allowance(self):
+        await self.crypto.bulk_transfer_erc20([(address(1), 40), (address(2), 40)])
+        self.assertEqual(await self.approvals(), [])
+        # the node still says 100, but only 20 of it is left once the first batch is mined
+        await self.crypto.bulk_transfer_erc20([(address(1), 25), (address(2), 25)])
+        self.assertEqual(await self.approvals(), [70])
+        self.assertEqual(self.crypto.disperse_allowance, 20)
+
+    async def test_approval_comes_before_the_disperses_it_covers(self):
+        self.crypto.nonces.release(self.crypto.nonces.allocate()[0])  # a gap the batch must not slot into
+        await self.crypto.bulk_transfer_erc20([(address(1), 100), (address(2), 100)])
+        records: list[dict] = await self.crypto.nonces.collection.find().sort('nonce', 1).to_list(length=None)
+        self.assertEqual([record['nonce'] for record in records], [1, 2])
+        self.assertTrue(records[0]['payload']['data'].startswith(APPROVE_SELECTOR))
+
+    async def test_refused_disperse_gives_its_allowance_back(self):
+        self.node.rejection = 'insufficient funds for gas * price + value'
+        self.assertEqual(await self.crypto.bulk_transfer_erc20([(address(1), 40), (address(2), 40)]), [None, None])
+        self.assertEqual(self.crypto.disperse_allowance, 100)
+
+
+    async def test_failed_approval_fails_the_whole_batch(self):
+        self.node.allowance = 0
+        self.node.rejection = 'insufficient funds for gas * price + value'
+        self.assertEqual(await self.crypto.bulk_transfer_erc20([(address(1), 40), (address(2), 40)]), [None, None])
+        self.assertIsNone(self.crypto.disperse_allowance)
+        self.assertEqual(await self.crypto.nonces.collection.count_documents({}), 0)
+        self.node.rejection = None
+        self.node.allowance = 100
+        self.assertTrue(all(await self.crypto.bulk_transfer_erc20([(address(1), 40), (address(2), 40)])))
+
+    async def test_transfers_are_chunked_to_fit_the_gas_limit(self):
+        self.configure(disperse_gas_limit=60000 + 2 * 40000, disperse_base_gas=60000, disperse_gas_per_recipient=40000)
+        transfers: list[tuple[str, int]] = [(address(i), i) for i in range(1, 6)]
+        tx_hashes: list = await self.crypto.bulk_transfer_erc20(transfers)
+        selector, input_types, _ = self.crypto._function_abi(self.crypto.disperse, 'disperseToken')
+        chunks: list[tuple[list[tuple[str, int]], int]] = []
+        async for record in self.crypto.nonces.collection.find().sort('nonce', 1):
+            data: bytes = bytes.fromhex(record['payload']['data'][2:])
+            self.assertEqual(data[:4], selector)
+            token, recipients, amounts = decode_abi(input_types, data[4:])
+            self.assertEqual(to_checksum_address(token), self.crypto.contract.address)
+            chunks.append(([(to_checksum_address(to), amount) for to, amount in zip(recipients, amounts)],
+                           record['payload']['gas']))
+        self.assertEqual(chunks, [(transfers[0:2], 140000), (transfers[2:4], 140000), (transfers[4:], 100000)])
+        self.assertEqual(len(set(tx_hashes)), 3)
+        self.assertEqual(tx_hashes[0], tx_hashes[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+from unittest import mock
+from pymongo.errors import PyMongoError
+from lib import DATABASE
+from lib.airdrops.entrant_buffer import EntrantWriteBuffer
+from lib.airdrops.entrants import EntrantSet
+from .base import DatabaseTestCase
+
+
+class EntrantWriteBufferTests(DatabaseTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.buffer: EntrantWriteBuffer = EntrantWriteBuffer(DATABASE, window=3600)
+        self.addCleanup(self.discard_all)
+
+    def discard_all(self) -> None:
+        for airdrop_id in set(self.buffer._timers) | set(self.buffer._added) | set(self.buffer._removed):
+            self.buffer.discard(airdrop_id)
+
+    async def entrants(self, airdrop_id: int) -> list[int]:
+        return [user async for _, user in DATABASE.iter_airdrop_entrants([airdrop_id])]
+
+    async def test_flush_writes_joins_and_leaves_together(self):
+        await DATABASE.update_airdrop_entrants(1, added=[10])
+        for user_id in (11, 12, 13):
+            self.buffer.add(1, user_id)
+        self.buffer.remove(1, 10)
+        self.assertEqual(self.buffer.pending, 4)
+        with mock.patch.object(DATABASE, 'update_airdrop_entrants', wraps=DATABASE.update_airdrop_entrants) as write:
+            await self.buffer.flush(1)
+        write.assert_awaited_once()
+        self.assertEqual(await self.entrants(1), [11, 12, 13])
+        self.assertEqual(self.buffer.pending, 0)
+        self.assertNotIn(1, self.buffer._timers)
+
+    async def test_flushed_after_the_window(self):
+        self.buffer.window = 0.05
+        self.buffer.add(1, 10)
+        self.assertEqual(await self.entrants(1), [])
+        await asyncio.sleep(0.15)
+        self.assertEqual(await self.entrants(1), [10])
+
+    async def test_later_change_wins(self):
+        self.buffer.add(1, 10)
+        self.buffer.remove(1, 10)
+        self.buffer.add(1, 11)
+        self.buffer.remove(1, 11)
+        self.buffer.add(1, 11)
+        self.assertEqual((self.buffer._added[1], self.buffer._removed[1]), ({11}, {10}))
+
+    async def test_overlay_applies_unwritten_changes(self):
+        self.buffer.add(1, 20)
+        self.buffer.remove(1, 10)
+        self.buffer.add(2, 30)
+        entrants: EntrantSet = self.buffer.overlay(1, EntrantSet([10, 15]))
+        self.assertEqual(list(entrants), [15, 20])
+        self.assertTrue(self.buffer.is_pending(1, 10))
+        self.assertFalse(self.buffer.is_pending(1, 15))
+
+    async def test_discard_forgets_an_airdrop(self):
+        self.buffer.add(1, 10)
+        self.buffer.add(2, 20)
+        timer: asyncio.Task = self.buffer._timers[1]
+        self.buffer.discard(1)
+        await asyncio.sleep(0)
+        self.assertTrue(timer.cancelled())
+        self.assertEqual(self.buffer.pending, 1)
+        await self.buffer.flush_all()
+        self.assertEqual(await self.entrants(1), [])
+        self.assertEqual(await self.entrants(2), [20])
+
+    async def test_failed_flush_keeps_the_changes(self):
+        self.buffer.add(1, 10)
+        self.buffer.remove(1, 11)
+        with mock.patch.object(DATABASE, 'update_airdrop_entrants', side_effect=PyMongoError('not primary')):
+            with self.assertRaises(PyMongoError):
+                await self.buffer.flush(1)
+        self.assertEqual((self.buffer._added[1], self.buffer._removed[1]), ({10}, {11}))
+        self.assertIn(1, self.buffer._timers)  # re-armed
+        await self.buffer.flush(1)
+        self.assertEqual(await self.entrants(1), [10])
+
+    async def test_changes_made_during_a_failed_flush_win(self):
+        self.buffer.add(1, 10)
+
+        async def fail(*_) -> None:
+            self.buffer.remove(1, 10)  # the user left while the write was in flight
+            raise PyMongoError('not primary')
+
+        with mock.patch.object(DATABASE, 'update_airdrop_entrants', side_effect=fail):
+            with self.assertRaises(PyMongoError):
+                await self.buffer.flush(1)
+        self.assertEqual((self.buffer._added.get(1, set()), self.buffer._removed[1]), (set(), {10}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+from lib.airdrops.entrants import EntrantSet
+
+
+class EntrantSetTests(unittest.TestCase):
+    def test_membership(self):
+        entrants: EntrantSet = EntrantSet([5, 3, 9, 3])
+        self.assertEqual(len(entrants), 3)
+        self.assertIn(3, entrants)
+        self.assertNotIn(4, entrants)
+        self.assertFalse(EntrantSet())
+
+    def test_iterates_in_order(self):
+        entrants: EntrantSet = EntrantSet([50, 10, 30])
+        entrants.add(20)
+        entrants.add(60)
+        entrants.discard(30)
+        self.assertEqual(list(entrants), [10, 20, 50, 60])
+
+    def test_pending_changes_before_compaction(self):
+        entrants: EntrantSet = EntrantSet([1, 2, 3])
+        entrants.add(4)
+        entrants.add(4)
+        entrants.discard(2)
+        entrants.discard(2)
+        entrants.discard(7)
+        self.assertEqual(len(entrants), 3)
+        self.assertEqual((2 in entrants, 4 in entrants), (False, True))
+        entrants.add(2)  # undoes the pending removal
+        entrants.discard(4)  # and the pending addition
+        self.assertEqual(len(entrants), 3)
+        self.assertEqual((entrants._added, entrants._removed), (set(), set()))
+        self.assertEqual(list(entrants), [1, 2, 3])
+
+    def test_compacts_once_enough_changes_are_pending(self):
+        entrants: EntrantSet = EntrantSet(range(0, 100, 2), compact_threshold=4)
+        for user_id in (1, 3, 5):
+            entrants.add(user_id)
+        self.assertEqual(len(entrants._added), 3)
+        entrants.discard(0)
+        self.assertEqual((entrants._added, entrants._removed), (set(), set()))
+        self.assertEqual(list(entrants)[:4], [1, 2, 3, 4])
+        self.assertEqual(len(entrants), 52)
+
+    def test_remove_raises_for_non_members(self):
+        entrants: EntrantSet = EntrantSet([1])
+        entrants.remove(1)
+        with self.assertRaises(KeyError):
+            entrants.remove(1)
+
+    def test_from_sorted(self):
+        entrants: EntrantSet = EntrantSet.from_sorted([1, 5, 9])
+        self.assertIn(5, entrants)
+        self.assertEqual(list(entrants), [1, 5, 9])
+
+    def test_large_ids(self):
+        user_id: int = 2 ** 63 + 12345  # snowflakes are unsigned 64-bit
+        entrants: EntrantSet = EntrantSet([user_id])
+        self.assertIn(user_id, entrants)
+
+    def test_update_and_difference_update(self):
+        entrants: EntrantSet = EntrantSet([1, 2])
+        entrants.update([2, 3, 4])
+        entrants.difference_update([1, 4])
+        self.assertEqual(list(entrants), [2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import asyncio
+import unittest
+from lib.leases import Lease
+from .base import DatabaseTestCase
+
+
+class LeaseTests(DatabaseTestCase):
+    async def test_only_one_owner_holds_it(self):
+        first, second = Lease('test', 30, 'first'), Lease('test', 30, 'second')
+        self.assertTrue(await first.acquire())
+        self.assertFalse(await second.acquire())
+        self.assertTrue(await first.acquire())  # renewed
+        self.assertTrue(first.held)
+        self.assertFalse(second.held)
+
+    async def test_expired_lease_is_taken_over(self):
+        first, second = Lease('test', 0.05, 'first'), Lease('test', 0.05, 'second')
+        self.assertTrue(await first.acquire())
+        await asyncio.sleep(0.1)
+        self.assertFalse(first.held)
+        self.assertTrue(await second.acquire())
+        self.assertFalse(await first.acquire())
+
+    async def test_released_lease_is_free(self):
+        first, second = Lease('test', 30, 'first'), Lease('test', 30, 'second')
+        await first.acquire()
+        await first.release()
+        self.assertFalse(first.held)
+        self.assertTrue(await second.acquire())
+
+    async def test_hold_hands_over_when_cancelled(self):
+        lease: Lease = Lease('test', 0.3, 'first')
+        acquired: asyncio.Event = asyncio.Event()
+        lost: asyncio.Event = asyncio.Event()
+
+        async def on_acquired() -> None:
+            acquired.set()
+
+        async def on_lost() -> None:
+            lost.set()
+
+        holder: asyncio.Task = asyncio.create_task(lease.hold(on_acquired, on_lost))
+        await asyncio.wait_for(acquired.wait(), timeout=1)
+        self.assertFalse(await Lease('test', 0.3, 'second').acquire())
+        holder.cancel()
+        await asyncio.gather(holder, return_exceptions=True)
+        self.assertTrue(lost.is_set())
+        self.assertTrue(await Lease('test', 0.3, 'second').acquire())
+
+    async def test_failed_take_over_releases_the_lease(self):
+        lease: Lease = Lease('test', 0.3, 'first')
+        lost: asyncio.Event = asyncio.Event()
+
+        async def on_acquired() -> None:
+            raise RuntimeError('setup failed')
+
+        async def on_lost() -> None:
+            lost.set()
+
+        holder: asyncio.Task = asyncio.create_task(lease.hold(on_acquired, on_lost))
+        try:
+            await asyncio.wait_for(lost.wait(), timeout=1)
+            self.assertIsNone(await self.db.leases.find_one({'_id': 'test'}))
+        finally:
+            holder.cancel()
+            await asyncio.gather(holder, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
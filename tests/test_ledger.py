@@ -0,0 +1,51 @@
+import unittest
+from lib.ledger import BalanceLedger
+
+
+class BalanceLedgerTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.ledger: BalanceLedger = BalanceLedger(None)  # noqa, syncing isn't tested here
+        self.ledger.balance = 100
+
+    def test_reserve(self):
+        self.assertTrue(self.ledger.reserve('a', 60))
+        self.assertFalse(self.ledger.reserve('b', 50))
+        self.assertEqual((self.ledger.reserved, self.ledger.available), (60, 40))
+
+    def test_reserving_a_reserved_key_is_a_no_op(self):
+        self.ledger.reserve('a', 60)
+        self.assertTrue(self.ledger.reserve('a', 1000))
+        self.assertEqual(self.ledger.reserved, 60)
+
+    def test_forced_reservation(self):
+        self.ledger.reserve('a', 60)
+        self.assertTrue(self.ledger.reserve('b', 50, force=True))
+        self.assertEqual(self.ledger.available, -10)
+        self.assertFalse(self.ledger.can_afford(1))
+
+    def test_move(self):
+        self.ledger.reserve('a', 60)
+        self.ledger.move('a', 'b')
+        self.ledger.release('a')
+        self.assertEqual(self.ledger.reserved, 60)
+        self.ledger.release('b')
+        self.assertEqual(self.ledger.reserved, 0)
+
+    def test_partial_release(self):
+        self.ledger.reserve('a', 60)
+        self.ledger.release('a', 20)
+        self.assertEqual(self.ledger.reserved, 40)
+        self.ledger.release('a', 100)  # never more than what's left
+        self.assertEqual(self.ledger.reserved, 0)
+        self.ledger.release('a', 10)
+        self.assertEqual(self.ledger.reserved, 0)
+
+    def test_spend(self):
+        self.ledger.reserve('a', 60)
+        self.ledger.spend(30)
+        self.ledger.release('a', 30)
+        self.assertEqual((self.ledger.balance, self.ledger.reserved, self.ledger.available), (70, 30, 40))
+
+
+if __name__ == '__main__':
+    unittest.main()
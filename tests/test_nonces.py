@@ -0,0 +1,151 @@
+import asyncio
+import unittest
+from unittest import mock
+from pymongo.errors import PyMongoError
+from lib.nonces import MAX_RECEIPT_MISSES
+from lib.rpc import RPCError
+from .base import ChainTestCase, address
+
+
+class NonceManagerTests(ChainTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.node.auto_mine = False
+        await self.crypto.nonces.setup()
+
+    async def pay(self, job_id: str) -> str:
+        await self.db.payout_jobs.insert_one({'_id': job_id, 'status': 'sending', 'tx_hash': None})
+        tx_hash, = await self.crypto.bulk_transfer_erc20([(address(1), 10)], jobs=[job_id])
+        await self.db.payout_jobs.update_one({'_id': job_id}, {'$set': {'status': 'sent', 'tx_hash': tx_hash}})
+        return tx_hash
+
+    async def job(self, job_id: str) -> dict:
+        return await self.db.payout_jobs.find_one({'_id': job_id})
+
+    async def record(self, nonce: int) -> dict:
+        return await self.crypto.nonces.collection.find_one({'nonce': nonce})
+
+    async def test_mined_transaction_settles_successfully(self):
+        tx_hash: str = await self.pay('job')
+        self.node.mine()
+        await self.crypto.nonces.check_pending()
+        record: dict = await self.record(0)
+        self.assertTrue(record['mined'])
+        self.assertTrue(record['succeeded'])
+        self.assertEqual((await self.job('job'))['status'], 'sent')
+        self.assertEqual(await self.crypto.nonces.find_by_job('job'), {'_id': record['_id'], 'hash': tx_hash,
+                                                                       'nonce': 0})
+
+    async def test_restart_rebroadcasts_pending_transactions(self):
+        tx_hash: str = await self.pay('job')
+        self.node.pool.clear()  # the node forgot about it, e.g. it restarted too
+        self.node.transactions.clear()
+        await self.crypto.nonces.stop()
+        await self.crypto.nonces.setup()
+        self.assertEqual(self.node.pool, {0: tx_hash})
+        self.assertEqual(self.crypto.nonces.allocate(), [1])
+
+    async def test_refused_nonce_is_reused(self):
+        self.node.rejection = 'insufficient funds for gas * price + value'
+        with self.assertRaises(RPCError):
+            await self.crypto.transfer_erc20(address(1), 10)
+        self.node.rejection = None
+        await self.crypto.transfer_erc20(address(1), 10)
+        self.assertEqual(list(self.node.pool), [0])
+
+    async def test_nonce_is_released_when_the_transaction_cannot_be_recorded(self):
+        collection = mock.Mock(replace_one=mock.AsyncMock(side_effect=PyMongoError('not primary')))
+        with mock.patch.object(type(self.crypto.nonces), 'collection', new_callable=mock.PropertyMock,
+                               return_value=collection):
+            with self.assertRaises(PyMongoError):
+                await self.crypto.transfer_erc20(address(1), 10)
+        self.assertEqual(self.node.pool, {})
+        await self.crypto.transfer_erc20(address(1), 10)
+        self.assertEqual(list(self.node.pool), [0])
+
+    async def test_gap_is_filled_with_an_empty_transaction(self):
+        await self.pay('first')
+        gas_price: int = await self.crypto.gas_price()
+        refused, accepted = self.crypto.nonces.allocate(2)
+        self.node.rejection = 'insufficient funds for gas * price + value'
+        with self.assertRaises(RPCError):
+            await self.crypto._transfer_erc20(address(1), 10, refused, gas_price)
+        self.node.rejection = None
+        await self.crypto._transfer_erc20(address(1), 10, accepted, gas_price)
+        self.node.mine()
+        self.assertEqual(self.node.nonce, 1)  # nonce 2 waits behind the gap
+        await self.crypto.nonces.check_pending()
+        filler: dict = await self.record(1)
+        self.assertEqual(filler['payload']['to'], self.crypto.spending_address)
+        self.assertEqual(filler['payload']['value'], 0)
+        self.node.mine()
+        self.assertEqual(self.node.nonce, 3)
+        self.assertEqual(self.crypto.nonces.allocate(), [3])
+
+    async def test_gas_bumps_are_capped(self):
+        self.configure(stuck_transaction_timeout=1e-6, max_gas_bumps=2)
+        await self.pay('job')
+        first: dict = await self.record(0)
+        for _ in range(4):
+            await asyncio.sleep(0.01)
+            await self.crypto.nonces.check_pending()
+        record: dict = await self.record(0)
+        self.assertEqual(record['bumps'], 2)
+        self.assertEqual(len(record['replaced']), 2)
+        self.assertEqual(record['replaced'][0], first['hash'])
+        self.assertEqual(self.node.pool[0], record['hash'])
+
+    async def test_gas_price_is_capped(self):
+        await self.pay('job')
+        first: dict = await self.record(0)
+        self.configure(stuck_transaction_timeout=1e-6, max_gas_price=first['gas_price'] + 1)
+        for _ in range(3):
+            await asyncio.sleep(0.01)
+            await self.crypto.nonces.check_pending()
+        record: dict = await self.record(0)
+        self.assertEqual(record['gas_price'], first['gas_price'] + 1)
+        self.assertEqual(record['bumps'], 1)
+
+    async def test_replacement_updates_the_jobs(self):
+        self.configure(stuck_transaction_timeout=1e-6)
+        tx_hash: str = await self.pay('job')
+        await asyncio.sleep(0.01)
+        await self.crypto.nonces.check_pending()
+        record: dict = await self.record(0)
+        self.assertNotEqual(record['hash'], tx_hash)
+        self.assertEqual((await self.job('job'))['tx_hash'], record['hash'])
+
+    async def test_replaced_transaction_can_still_be_the_mined_one(self):
+        self.configure(stuck_transaction_timeout=1e-6)
+        tx_hash: str = await self.pay('job')
+        await asyncio.sleep(0.01)
+        await self.crypto.nonces.check_pending()
+        self.node.pool[0] = tx_hash  # the original made it into a block after all
+        self.node.mine()
+        await self.crypto.nonces.check_pending()
+        job: dict = await self.job('job')
+        self.assertEqual((job['status'], job['tx_hash']), ('sent', tx_hash))
+        self.assertTrue((await self.record(0))['succeeded'])
+
+    async def test_reverted_transaction_fails_its_jobs(self):
+        self.node.reverting.add(0)
+        await self.pay('job')
+        self.node.mine()
+        await self.crypto.nonces.check_pending()
+        self.assertEqual((await self.job('job'))['status'], 'failed')
+        self.assertFalse((await self.record(0))['succeeded'])
+        self.assertIsNone(await self.crypto.nonces.find_by_job('job'))
+
+    async def test_nonce_used_elsewhere_fails_its_jobs(self):
+        await self.pay('job')
+        self.node.pool.clear()
+        self.node.nonce = 1  # some other transaction of the spending address was mined with it
+        for _ in range(MAX_RECEIPT_MISSES - 1):
+            await self.crypto.nonces.check_pending()
+            self.assertEqual((await self.job('job'))['status'], 'sent')
+        await self.crypto.nonces.check_pending()
+        self.assertEqual((await self.job('job'))['status'], 'failed')
+
+
+if __name__ == '__main__':
+    unittest.main()
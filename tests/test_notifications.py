@@ -0,0 +1,50 @@
+import discord
+import unittest
+from unittest import mock
+from lib import NotificationQueue
+from benchmarks.fakes import FakeDiscordHTTP, FakeBot, FakeUser
+
+
+class NotificationQueueTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.http: FakeDiscordHTTP = FakeDiscordHTTP(latency=0, retry_after=0, library_retries=0)
+        self.queue: NotificationQueue = NotificationQueue(FakeBot(self.http, None, None), workers=2)  # noqa
+        self.queue.max_retries = 1
+        self.queue.start()
+        self.delivered: list[int] = []
+        self.addAsyncCleanup(self.stop)
+
+    async def stop(self) -> None:
+        for worker in self.queue._workers:
+            worker.cancel()
+
+    def on_delivered(self, user_id: int):
+        async def callback() -> None:
+            self.delivered.append(user_id)
+        return callback
+
+    async def test_callback_runs_once_delivered(self):
+        for user_id in range(5):
+            self.queue.send(user_id, discord.Embed(), self.on_delivered(user_id))
+        await self.queue.join()
+        self.assertEqual(sorted(self.delivered), list(range(5)))
+        self.assertEqual(self.http.requests['POST /channels/{dm}/messages'], 5)
+
+    async def test_callback_does_not_run_when_sending_fails(self):
+        self.http.rate_limit_chance = 1
+        self.queue.send(1, discord.Embed(), self.on_delivered(1))
+        await self.queue.join()
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(self.http.rate_limited, self.queue.max_retries + 1)
+
+    async def test_closed_dms_count_as_delivered(self):
+        forbidden: discord.Forbidden = discord.Forbidden(mock.Mock(status=403, reason='Forbidden'),
+                                                         {'code': 50007, 'message': 'Cannot send messages'})
+        with mock.patch.object(FakeUser, 'send', side_effect=forbidden):
+            self.queue.send(1, discord.Embed(), self.on_delivered(1))
+            await self.queue.join()
+        self.assertEqual(self.delivered, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import time
+import asyncio
+import unittest
+from .base import ChainTestCase, address
+
+
+class PayoutQueueTests(ChainTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.configure(payout_poll_interval=0.05)
+        self.payouts = self.crypto.payouts
+        await self.crypto.nonces.setup()
+
+    async def test_a_source_is_paid_once(self):
+        self.payouts.start_workers()
+        first: list[dict] = await self.payouts.pay('tip:1', [(1, address(1), 10), (2, address(2), 10)], timeout=5)
+        again: list[dict] = await self.payouts.pay('tip:1', [(1, address(1), 10), (2, address(2), 10)], timeout=5)
+        self.assertEqual([job['status'] for job in first], ['sent', 'sent'])
+        self.assertEqual(first, again)
+        self.assertEqual(self.node.nonce, 2)
+        self.assertEqual(await self.payouts.collection.count_documents({}), 2)
+
+    async def test_missing_jobs_count_as_failed(self):
+        job, = await self.payouts.wait(['tip:1:1'], timeout=1)
+        self.assertEqual((job['status'], job['tx_hash']), ('failed', None))
+
+    async def test_waiting_without_workers_times_out(self):
+        started_at: float = time.monotonic()
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.payouts.pay('tip:1', [(1, address(1), 10)], timeout=0.2)
+        self.assertLess(time.monotonic() - started_at, 1)
+        self.assertEqual((await self.payouts.collection.find_one({}))['status'], 'queued')
+        self.assertEqual(self.crypto.ledger.reserved, 0)
+
+    async def test_expired_claims_are_recovered(self):
+        job_ids: list[str] = await self.payouts.enqueue('tip:1', [(1, address(1), 10), (2, address(2), 10)])
+        jobs: list[dict] = await self.payouts._claim(2)
+        # the first one's transaction was recorded before its worker died, the second one's never was
+        tx_hash, = await self.crypto.bulk_transfer_erc20([(address(1), 10)], jobs=[job_ids[0]])
+        await self.payouts.collection.update_many({'_id': {'$in': [job['_id'] for job in jobs]}},
+                                                  {'$set': {'claimed_until': time.time() - 1}})
+        await self.payouts.recover()
+        first, second = [await self.payouts.collection.find_one({'_id': job_id}) for job_id in job_ids]
+        self.assertEqual((first['status'], first['tx_hash']), ('sent', tx_hash))
+        self.assertEqual((second['status'], second['tx_hash']), ('queued', None))
+
+    async def test_unexpired_claims_are_left_alone(self):
+        await self.payouts.enqueue('tip:1', [(1, address(1), 10)])
+        await self.payouts._claim(1)
+        await self.payouts.recover()
+        self.assertEqual((await self.payouts.collection.find_one({}))['status'], 'sending')
+
+
+    async def test_group_payout_splits_in_contract_units(self):
+        self.payouts.start_workers()
+        tx_hashes: list = await self.crypto.group_payout([address(1), address(2), address(3)], 10, 'tip:1')
+        self.assertTrue(all(tx_hashes))
+        self.assertEqual(sorted([job['amount'] async for job in self.payouts.collection.find()]), ['3', '3', '3'])
+
+    async def test_group_payout_to_nobody(self):
+        self.assertEqual(await self.crypto.group_payout({}, 10, 'tip:1'), [])
+        self.assertEqual(await self.payouts.collection.count_documents({}), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
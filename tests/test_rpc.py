@@ -0,0 +1,165 @@
+import asyncio
+import aiohttp
+import unittest
+from lib.rpc import RPCClient, RPCPool, RPCError, EndpointUnavailable
+from benchmarks.fakes import FakeNode
+
+
+class NodeTestCase(unittest.IsolatedAsyncioTestCase):
+    async def start_node(self, **kwargs) -> FakeNode:
+        node: FakeNode = FakeNode(**kwargs)
+        await node.start()
+        self.addAsyncCleanup(node.stop)
+        return node
+
+    def client(self, node: FakeNode, **kwargs) -> RPCClient:
+        client: RPCClient = RPCClient(node.url, **kwargs)
+        self.addAsyncCleanup(client.close)
+        return client
+
+
+class RPCClientTests(NodeTestCase):
+    async def test_result(self):
+        node: FakeNode = await self.start_node(chain_id=5)
+        self.assertEqual(await self.client(node).request('eth_chainId'), '0x5')
+
+    async def test_errors_are_raised(self):
+        node: FakeNode = await self.start_node()
+        with self.assertRaises(RPCError) as context:
+            await self.client(node).request('eth_unknown')
+        self.assertEqual(context.exception.code, -32601)
+
+    async def test_http_errors_are_raised(self):
+        node: FakeNode = await self.start_node()
+        node.http_status = 502
+        with self.assertRaises(aiohttp.ClientResponseError) as context:
+            await self.client(node).request('eth_chainId')
+        self.assertEqual(context.exception.status, 502)
+
+    async def test_session_is_reused(self):
+        node: FakeNode = await self.start_node()
+        client: RPCClient = self.client(node)
+        await client.request('eth_chainId')
+        session: aiohttp.ClientSession = client.session
+        await client.request('eth_blockNumber')
+        self.assertIs(client.session, session)
+
+
+class BatchingTests(NodeTestCase):
+    async def test_concurrent_requests_share_a_batch(self):
+        node: FakeNode = await self.start_node()
+        client: RPCClient = self.client(node)
+        results: list = await asyncio.gather(*[client.request('eth_getTransactionReceipt', [f'0x{i:064x}'])
+                                               for i in range(10)])
+        self.assertEqual(results, [None] * 10)
+        self.assertEqual((node.requests, node.calls), (1, 10))
+
+    async def test_batches_are_bounded(self):
+        node: FakeNode = await self.start_node()
+        client: RPCClient = self.client(node, max_batch_size=4)
+        await asyncio.gather(*[client.request('eth_getTransactionReceipt', [f'0x{i:064x}']) for i in range(10)])
+        self.assertEqual((node.requests, node.calls), (3, 10))
+
+    async def test_identical_reads_are_coalesced(self):
+        node: FakeNode = await self.start_node()
+        client: RPCClient = self.client(node)
+        results: list = await asyncio.gather(*[client.request('eth_gasPrice') for _ in range(5)])
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(node.calls, 1)
+        await client.request('eth_gasPrice')  # only requests in flight are shared, nothing is cached
+        self.assertEqual(node.calls, 2)
+
+    async def test_other_methods_are_not_coalesced(self):
+        node: FakeNode = await self.start_node()
+        client: RPCClient = self.client(node)
+        await asyncio.gather(*[client.request('eth_sendTransaction', [{}]) for _ in range(2)],
+                             return_exceptions=True)
+        self.assertEqual(node.calls, 2)
+
+    async def test_one_failed_call_does_not_fail_the_batch(self):
+        node: FakeNode = await self.start_node()
+        client: RPCClient = self.client(node)
+        results: list = await asyncio.gather(client.request('eth_unknown'), client.request('eth_blockNumber'),
+                                             return_exceptions=True)
+        self.assertIsInstance(results[0], RPCError)
+        self.assertEqual(results[1], '0x1')
+        self.assertEqual(node.requests, 1)
+
+    async def test_close_cancels_requests_in_flight(self):
+        node: FakeNode = await self.start_node(latency=5)
+        client: RPCClient = self.client(node)
+        request: asyncio.Task = asyncio.create_task(client.request('eth_chainId'))
+        await asyncio.sleep(0.1)
+        await client.close()
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(request, timeout=1)
+        self.assertEqual(client._tasks, set())
+
+
+class RPCPoolTests(NodeTestCase):
+    async def asyncSetUp(self) -> None:
+        self.fast: FakeNode = await self.start_node()
+        self.slow: FakeNode = await self.start_node()
+        self.pool: RPCPool = RPCPool([self.fast.url, self.slow.url])
+        self.addAsyncCleanup(self.pool.close)
+        self.pool.endpoints[0].latency, self.pool.endpoints[1].latency = 0.001, 0.002
+        self.pool.hedge_delay = 0.05
+
+    async def test_fastest_endpoint_is_preferred(self):
+        await self.pool.request('eth_blockNumber')
+        self.assertEqual((self.fast.calls, self.slow.calls), (1, 0))
+        self.pool.endpoints[0].latency = 1
+        await self.pool.request('eth_blockNumber')
+        self.assertEqual((self.fast.calls, self.slow.calls), (1, 1))
+
+    async def test_failing_endpoint_fails_over_and_is_taken_out_of_rotation(self):
+        self.fast.http_status = 502
+        for _ in range(self.pool.failure_threshold):
+            self.assertEqual(await self.pool.request('eth_blockNumber'), '0x1')
+        self.assertFalse(self.pool.endpoints[0].available)
+        requests: int = self.fast.requests
+        await self.pool.request('eth_blockNumber')
+        self.assertEqual(self.fast.requests, requests)
+
+    async def test_rate_limited_endpoint_is_taken_out_of_rotation_right_away(self):
+        self.fast.http_status = 429
+        self.assertEqual(await self.pool.request('eth_blockNumber'), '0x1')
+        self.assertFalse(self.pool.endpoints[0].available)
+        self.assertTrue(self.pool.endpoints[1].available)
+
+    async def test_json_rpc_errors_do_not_fail_over(self):
+        with self.assertRaises(RPCError):
+            await self.pool.request('eth_unknown')
+        self.assertEqual(self.slow.calls, 0)
+        self.assertTrue(self.pool.endpoints[0].available)
+
+    async def test_every_endpoint_failing(self):
+        self.fast.http_status = self.slow.http_status = 502
+        with self.assertRaises(EndpointUnavailable):
+            await self.pool.request('eth_blockNumber')
+
+    async def test_slow_calls_are_hedged(self):
+        self.fast.latency = 2
+        result: str = await asyncio.wait_for(self.pool.request('eth_call', [{'data': '0x313ce567'}, 'latest']),
+                                             timeout=1)
+        self.assertEqual(int(result, 16), 18)
+        self.assertEqual(self.slow.calls, 1)
+
+    async def test_quick_calls_are_not_hedged(self):
+        await self.pool.request('eth_call', [{'data': '0x313ce567'}, 'latest'])
+        self.assertEqual(self.slow.requests, 0)
+
+    async def test_nonce_methods_stick_to_one_endpoint(self):
+        await self.pool.request('eth_getTransactionCount', ['0x0', 'pending'])
+        self.pool.endpoints[0].latency = 1  # no longer the fastest, but still healthy
+        await self.pool.request('eth_getTransactionCount', ['0x0', 'latest'])
+        self.assertEqual((self.fast.calls, self.slow.calls), (2, 0))
+        self.fast.http_status = 502
+        await self.pool.request('eth_getTransactionCount', ['0x0', 'pending'])
+        self.fast.http_status = None
+        await self.pool.request('eth_getTransactionCount', ['0x0', 'latest'])
+        self.assertEqual(self.slow.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()